@@ -0,0 +1,137 @@
+"""Columnar representation of the atom sites of a crystal structure.
+
+Instead of one ATOM_SITE instance (with a nested ATOM_SCALED_COORDINATES
+instance) per site, the sites are held as contiguous NumPy arrays:
+
+  :positions:    N x 3 float64 array of fractional coordinates.
+  :occupancies:  N float64 array of site occupancies.
+  :species:      N integer array of indices into `species_names`.
+
+This keeps large supercells and disordered structures cheap to build
+and to operate on.  ATOM_SITE instances are only created when
+explicitly requested with AtomSites.materialize().
+
+Requires NumPy.
+"""
+import numpy as np
+
+import softcuds
+
+
+# Label of the ATOM_SITES instance in a CRYSTAL_STRUCTURE collection
+ATOM_SITES_LABEL = 'CRYSTAL_STRUCTURE.ATOM_SITES'
+
+
+class AtomSites(object):
+    """Columnar atom sites.
+
+    Parameters
+    ----------
+    positions : array_like
+        N x 3 array of fractional (scaled) coordinates.
+    species : sequence
+        N chemical symbols.  Interned into `species_names` and an integer
+        index array.
+    occupancies : None | array_like
+        N site occupancies.  Defaults to one for all sites.
+    """
+    def __init__(self, positions, species, occupancies=None):
+        self.positions = np.ascontiguousarray(positions, dtype=np.float64)
+        if self.positions.ndim != 2 or self.positions.shape[1] != 3:
+            raise ValueError('`positions` must be a N x 3 array, got shape '
+                             '%r' % (self.positions.shape, ))
+        n = len(self.positions)
+        self.species_names, self.species = np.unique(
+            np.asarray(species, dtype=str), return_inverse=True)
+        self.species = self.species.reshape(-1)
+        if occupancies is None:
+            self.occupancies = np.ones(n)
+        else:
+            self.occupancies = np.ascontiguousarray(occupancies,
+                                                    dtype=np.float64)
+        if len(self.species) != n or len(self.occupancies) != n:
+            raise ValueError('inconsistent number of atom sites')
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __repr__(self):
+        return '<%s: %d sites, species=%s>' % (
+            self.__class__.__name__, len(self), self.species_names.tolist())
+
+    @property
+    def symbols(self):
+        """Array with the chemical symbol of each site."""
+        return self.species_names[self.species]
+
+    @classmethod
+    def from_cifdata(cls, cifdata):
+        """Returns a new AtomSites instance from a CifData instance."""
+        positions = np.column_stack([
+            np.asarray(cifdata.atom_site_fract_x, dtype=np.float64),
+            np.asarray(cifdata.atom_site_fract_y, dtype=np.float64),
+            np.asarray(cifdata.atom_site_fract_z, dtype=np.float64),
+        ])
+        occupancies = getattr(cifdata, 'atom_site_occupancy', None)
+        return cls(positions, cifdata.atom_site_type_symbol, occupancies)
+
+    @classmethod
+    def from_collection(cls, ci, base=ATOM_SITES_LABEL):
+        """Returns a new AtomSites instance from the materialized ATOM_SITE
+        instances under label `base` in CUDS instance collection `ci`.
+
+        Site i of the returned instance is ATOM_SITE[i].  A ValueError is
+        raised if `ci` only holds a subset of the sites, e.g. after
+        materializing selected indices with materialize()."""
+        indices = softcuds.find_indices(ci, base, 'ATOM_SITE')
+        n = len(indices)
+        if indices != list(range(n)):
+            missing = sorted(set(range(indices[-1] + 1)).difference(indices))
+            raise ValueError(
+                'cannot create AtomSites from a partial collection, '
+                'missing ATOM_SITE indices: %s' % ', '.join(
+                    str(i) for i in missing[:10]))
+        positions = np.empty((n, 3))
+        occupancies = np.empty(n)
+        species = []
+        for i in range(n):
+            label = '%s.ATOM_SITE[%d]' % (base, indices[i])
+            site = ci.get_instance(label)
+            coords = ci.get_instance(label + '.ATOM_SCALED_COORDINATES')
+            positions[i] = coords.soft_get_property('SCALED_POSITION')
+            occupancies[i] = site.soft_get_property('OCCUPANCY')
+            species.append(site.soft_get_property('CHEMICAL_SPECIE'))
+        return cls(positions, species, occupancies)
+
+    def materialize(self, ci, cuds_collection, indices=None,
+                    base=ATOM_SITES_LABEL):
+        """Creates ATOM_SITE instances in CUDS instance collection `ci`
+        under label `base` and returns a list of their labels.
+
+        Only the sites in `indices` are created.  By default all sites
+        are created.  Sites that are already present in `ci` are
+        updated."""
+        if indices is None:
+            indices = range(len(self))
+        existing = set(softcuds.find_relations(ci, base, 'has-attribute'))
+        labels = []
+        symbols = self.species_names.tolist()
+        for i in indices:
+            i = int(i)
+            label = '%s.ATOM_SITE[%d]' % (base, i)
+            coords_label = label + '.ATOM_SCALED_COORDINATES'
+            if label not in existing:
+                softcuds.add_cuds_instance(
+                    ci, cuds_collection, 'ATOM_SITE', parent=base,
+                    index=[i])
+            site = ci.get_instance(label)
+            site.soft_set_property('OCCUPANCY', float(self.occupancies[i]))
+            site.soft_set_property('CHEMICAL_SPECIE',
+                                   symbols[self.species[i]])
+            ci.add(label, site)
+            coords = ci.get_instance(coords_label)
+            coords.soft_set_property('SCALED_POSITION',
+                                     self.positions[i].tolist())
+            ci.add(coords_label, coords)
+            labels.append(label)
+        return labels
@@ -0,0 +1,110 @@
+"""Generators of synthetic CIF files for the benchmarks.
+
+The structures are supercells of the rutile VO2 structure in
+VO2_rutile.cif, so they exercise the same tags as the real data, but
+with an arbitrary number of atom sites.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import math
+
+
+# Directory holding this file
+thisdir = os.path.dirname(os.path.abspath(__file__))
+
+# The template CIF file
+template = os.path.join(os.path.dirname(thisdir), 'VO2_rutile.cif')
+
+
+def read_template(path=template):
+    """Returns a (header, columns, rows) tuple for the CIF file `path`.
+
+    `header` is the text before the atom site loop, `columns` the list
+    of atom site tags and `rows` a list of lists of the values of each
+    atom site."""
+    with open(path) as f:
+        lines = f.read().splitlines()
+    i = lines.index('loop_')
+    header = lines[:i]
+    columns = []
+    rows = []
+    for line in lines[i + 1:]:
+        if line.startswith('_'):
+            columns.append(line.strip())
+        elif line.strip():
+            rows.append(line.split())
+    return header, columns, rows
+
+
+def get_supercell(nsites, nbase):
+    """Returns the (na, nb, nc) repetitions of a unit cell with `nbase`
+    atom sites needed for at least `nsites` sites."""
+    ncells = max(1, -(-nsites // nbase))
+    n = int(math.ceil(ncells ** (1. / 3) - 1e-9))
+    na, nb, nc = n, n, n
+    while (na - 1) * nb * nc >= ncells and na > 1:
+        na -= 1
+    while na * (nb - 1) * nc >= ncells and nb > 1:
+        nb -= 1
+    return na, nb, nc
+
+
+def generate_cif(nsites, blockname=None, path=template):
+    """Returns the text of a CIF file with `nsites` atom sites.
+
+    The atom sites listed in the CIF file `path` are repeated over a
+    supercell and truncated to `nsites` sites.  The cell parameters are
+    scaled accordingly."""
+    header, columns, rows = read_template(path)
+    na, nb, nc = get_supercell(nsites, len(rows))
+    ix = columns.index('_atom_site_fract_x')
+    ilabel = columns.index('_atom_site_label')
+    scale = {'_cell_length_a': na, '_cell_length_b': nb,
+             '_cell_length_c': nc}
+    out = []
+    for line in header:
+        words = line.split()
+        if line.startswith('data_') and blockname:
+            line = 'data_' + blockname
+        elif words and words[0] in scale:
+            line = '%-34s %.5f' % (words[0],
+                                   float(words[1]) * scale[words[0]])
+        elif words and words[0] == '_cell_volume':
+            line = '%-34s %.2f' % (words[0], float(words[1]) * na * nb * nc)
+        elif words and words[0] == '_cell_formula_units_Z':
+            line = '%-34s %d' % (words[0], int(words[1]) * na * nb * nc)
+        out.append(line)
+    out.append('loop_')
+    out.extend(columns)
+    n = 0
+    for a in range(na):
+        for b in range(nb):
+            for c in range(nc):
+                for row in rows:
+                    if n == nsites:
+                        break
+                    row = list(row)
+                    row[ilabel] = '%s%d' % (row[ilabel], n + 1)
+                    for k, m, shift in ((0, na, a), (1, nb, b), (2, nc, c)):
+                        x = float(row[ix + k])
+                        row[ix + k] = '%.5f' % ((x + shift) / m)
+                    out.append(' '.join(row))
+                    n += 1
+    out.append('')
+    return '\n'.join(out)
+
+
+def write_cif(filename, nsites, blockname=None):
+    """Writes a synthetic CIF file with `nsites` atom sites to
+    `filename`."""
+    with open(filename, 'w') as f:
+        f.write(generate_cif(nsites, blockname))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('Usage: %s NSITES' % sys.argv[0], file=sys.stderr)
+        sys.exit(1)
+    sys.stdout.write(generate_cif(int(sys.argv[1])))
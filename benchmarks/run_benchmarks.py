@@ -0,0 +1,451 @@
+"""Benchmarks of CUDS metadata generation, instantiation, CIF conversion
+and serialization.
+
+Usage::
+
+    python benchmarks/run_benchmarks.py [-o RESULTS.json] [--max-sites N]
+                                        [--compare BASELINE.json] [NAME ...]
+
+Each benchmark is timed `--repeat` times (fewer for slow runs, see
+`--max-time`) and the results are written as JSON, which can be
+compared to the results of an earlier run with `--compare`.  The
+optional NAME arguments are glob patterns selecting the benchmarks to
+run.
+
+The synthetic CIF files are generated with cifgen.py.  If softpy or
+PyCifRW are not installed, the stand-ins in benchmarks/standins are
+used, such that the benchmarks can run offline.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import gc
+import json
+import time
+import fnmatch
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+
+
+# Directory holding this file
+thisdir = os.path.dirname(os.path.abspath(__file__))
+
+# Root directory of the repository
+rootdir = os.path.dirname(thisdir)
+
+sys.path.insert(0, rootdir)
+sys.path.insert(0, thisdir)
+
+# Fall back to the stand-ins for missing dependencies
+standins = []
+for _module in ('softpy', 'CifFile'):
+    try:
+        __import__(_module)
+    except ImportError:
+        standins.append(_module)
+if standins:
+    sys.path.append(os.path.join(thisdir, 'standins'))
+
+import softcuds
+import cifgen
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# Number of atom sites to benchmark with
+SIZES = (1, 10, 100, 1000, 10000, 100000)
+
+# Registered benchmarks, list of (name, function, sized) tuples
+benchmarks = []
+
+
+def benchmark(name, sized=False):
+    """Decorator registering a benchmark.
+
+    The decorated function is called with a Context instance and, if
+    `sized` is true, the number of atom sites.  It should do all setup
+    and return a callable without arguments to be timed, or None if the
+    benchmark cannot run."""
+    def decorator(func):
+        benchmarks.append((name, func, sized))
+        return func
+    return decorator
+
+
+class Context(object):
+    """Shared, lazily created state of the benchmarks."""
+    def __init__(self, tmpdir):
+        self.tmpdir = tmpdir
+        self._cuds_collection = None
+        self._cifdata = {}
+        self._instances = {}
+
+    @property
+    def cuds_collection(self):
+        if self._cuds_collection is None:
+            self._cuds_collection = softcuds.get_cuds_collection()
+        return self._cuds_collection
+
+    def get_cif_file(self, nsites):
+        """Returns the name of a synthetic CIF file with `nsites` atom
+        sites."""
+        filename = os.path.join(self.tmpdir, 'sites%d.cif' % nsites)
+        if not os.path.exists(filename):
+            cifgen.write_cif(filename, nsites)
+        return filename
+
+    def get_cifdata(self, nsites):
+        """Returns a CifData instance with `nsites` atom sites."""
+        if nsites not in self._cifdata:
+            import cifdata
+            (_, data), = cifdata.read_cifdata(self.get_cif_file(nsites),
+                                              parser='fast')
+            self._cifdata[nsites] = data
+        return self._cifdata[nsites]
+
+    def get_instance_collection(self, nsites):
+        """Returns a converted CUDS instance collection with `nsites`
+        atom sites."""
+        if nsites not in self._instances:
+            import cifdata
+            self._instances[nsites] = cifdata.cif2cuds_converter(
+                self.get_cifdata(nsites), self.cuds_collection)
+        return self._instances[nsites]
+
+
+@benchmark('metadata.generate_cuds_entities')
+def bench_generate_cuds_entities(ctx):
+    cuds, cuba = softcuds.load_cuds_metadata()
+    return lambda: softcuds.generate_cuds_entities(cuds, cuba)
+
+
+@benchmark('metadata.get_cuds_entities.cached')
+def bench_get_cuds_entities_cached(ctx):
+    cache_dir = os.path.join(ctx.tmpdir, 'cache')
+    softcuds.get_cuds_entities(cache_dir=cache_dir)
+
+    def run():
+        # Load from the compiled cache, not from the in-process memo
+        softcuds._memo.clear()
+        return softcuds.get_cuds_entities(cache_dir=cache_dir)
+    return run
+
+
+@benchmark('metadata.get_cuds_collection')
+def bench_get_cuds_collection(ctx):
+    softcuds.get_cuds_entities()  # make sure that the cache is warm
+    return softcuds.get_cuds_collection
+
+
+@benchmark('instantiate.eager', sized=True)
+def bench_instantiate_eager(ctx, nsites):
+    cc = ctx.cuds_collection
+    dimensions = {'CRYSTAL_STRUCTURE.ATOM_SITES.ATOM_SITE': [nsites]}
+    return lambda: softcuds.get_cuds_instance_collection(
+        cc, 'CRYSTAL_STRUCTURE', dimensions=dimensions)
+
+
+@benchmark('instantiate.lazy', sized=True)
+def bench_instantiate_lazy(ctx, nsites):
+    cc = ctx.cuds_collection
+    dimensions = {'CRYSTAL_STRUCTURE.ATOM_SITES.ATOM_SITE': [nsites]}
+    return lambda: softcuds.get_cuds_instance_collection(
+        cc, 'CRYSTAL_STRUCTURE', dimensions=dimensions, lazy=True)
+
+
+@benchmark('convert.read_cif.fast', sized=True)
+def bench_read_cif_fast(ctx, nsites):
+    import cifdata
+    filename = ctx.get_cif_file(nsites)
+    return lambda: cifdata.read_cifdata(filename, parser='fast')
+
+
+@benchmark('convert.read_cif.pycifrw', sized=True)
+def bench_read_cif_pycifrw(ctx, nsites):
+    if 'CifFile' in standins:
+        return None
+    import cifdata
+    filename = ctx.get_cif_file(nsites)
+    return lambda: cifdata.read_cifdata(filename, parser='pycifrw')
+
+
+@benchmark('convert.cif2cuds_converter', sized=True)
+def bench_cif2cuds_converter(ctx, nsites):
+    import cifdata
+    data = ctx.get_cifdata(nsites)
+    cc = ctx.cuds_collection
+    return lambda: cifdata.cif2cuds_converter(data, cc)
+
+
+@benchmark('convert.expand_symmetry', sized=True)
+def bench_expand_symmetry(ctx, nsites):
+    try:
+        import numpy
+    except ImportError:
+        return None
+    import symmetry
+    import atomsites
+    sites = atomsites.AtomSites.from_cifdata(ctx.get_cifdata(nsites))
+    # Low symmetry (P-1), such that the number of sites dominates
+    ops = [symmetry.parse_symop(xyz) for xyz in ('x,y,z', '-x,-y,-z')]
+    rotations = numpy.array([r for r, t in ops])
+    translations = numpy.array([t for r, t in ops])
+    return lambda: symmetry.expand_sites(sites, rotations, translations)
+
+
+@benchmark('crystal.neighbor_list', sized=True)
+def bench_neighbor_list(ctx, nsites):
+    try:
+        import numpy
+    except ImportError:
+        return None
+    import crystal
+    import symmetry
+    import atomsites
+    data = ctx.get_cifdata(nsites)
+    sites = atomsites.AtomSites.from_cifdata(data)
+    lattice = symmetry.cell_to_lattice(
+        data.cell_length_a, data.cell_length_b, data.cell_length_c,
+        data.cell_angle_alpha, data.cell_angle_beta, data.cell_angle_gamma)
+    return lambda: crystal.neighbor_list(sites.positions, lattice, 3.0)
+
+
+@benchmark('serialize.yaml', sized=True)
+def bench_serialize_yaml(ctx, nsites):
+    ci = ctx.get_instance_collection(nsites)
+    return lambda: softcuds.serialize_cuds_instance_collection(ci, 'yaml')
+
+
+@benchmark('serialize.json', sized=True)
+def bench_serialize_json(ctx, nsites):
+    ci = ctx.get_instance_collection(nsites)
+    return lambda: softcuds.serialize_cuds_instance_collection(ci, 'json')
+
+
+@benchmark('graph.get_cuds_graph')
+def bench_get_cuds_graph(ctx):
+    try:
+        import pydot
+    except ImportError:
+        return None
+    cc = softcuds.get_cuds_collection(include_parent=False)
+    # Build the graph each time instead of using the cached one
+    return lambda: softcuds.CUDSGraph(cc).to_pydot().to_string()
+
+
+@benchmark('graph.get_cuds_dot')
+def bench_get_cuds_dot(ctx):
+    cc = softcuds.get_cuds_collection(include_parent=False)
+    return lambda: softcuds.CUDSGraph(cc).to_dot()
+
+
+def measure(func, repeat=5, max_time=10.0):
+    """Calls `func` up to `repeat` times and returns a list of the times
+    of each call in seconds.
+
+    No new calls are started when the total time exceeds `max_time`."""
+    times = []
+    total = 0.0
+    gcold = gc.isenabled()
+    try:
+        while len(times) < repeat and (not times or total < max_time):
+            gc.collect()
+            gc.disable()
+            t = timer()
+            func()
+            times.append(timer() - t)
+            total += times[-1]
+            if gcold:
+                gc.enable()
+    finally:
+        if gcold:
+            gc.enable()
+    return times
+
+
+def get_metadata():
+    """Returns a dict describing the environment of the benchmark run."""
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=rootdir,
+            stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    versions = {}
+    for module in ('softpy', 'CifFile', 'yaml', 'numpy', 'pydot'):
+        if module in standins:
+            versions[module] = 'stand-in'
+            continue
+        try:
+            mod = __import__(module)
+        except ImportError:
+            versions[module] = None
+        else:
+            versions[module] = getattr(mod, '__version__', 'unknown')
+    return dict(
+        commit=commit,
+        date=datetime.now().isoformat(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        versions=versions,
+        yaml_libyaml=hasattr(__import__('yaml'), 'CDumper'),
+    )
+
+
+def run(patterns=None, sizes=SIZES, repeat=5, max_time=10.0,
+        verbose=True):
+    """Runs the benchmarks and returns a list of result dicts.
+
+    Parameters
+    ----------
+    patterns : None | sequence
+        Glob patterns selecting the benchmarks to run.  Default is to
+        run all benchmarks.
+    sizes : sequence
+        Numbers of atom sites to run the sized benchmarks with.
+    repeat : int
+        Maximum number of times to time each benchmark.
+    max_time : float
+        Stop repeating a benchmark when the total time exceeds this
+        number of seconds.
+    verbose : bool
+        Whether to print the results as they come.
+    """
+    results = []
+    tmpdir = tempfile.mkdtemp(prefix='cif-demo-bench-')
+    ctx = Context(tmpdir)
+    try:
+        for name, func, sized in benchmarks:
+            if patterns and not any(fnmatch.fnmatch(name, p)
+                                    for p in patterns):
+                continue
+            for nsites in (sizes if sized else [None]):
+                args = (ctx, nsites) if sized else (ctx, )
+                f = func(*args)
+                result = dict(name=name, nsites=nsites)
+                if f is None:
+                    result['skipped'] = True
+                else:
+                    times = measure(f, repeat, max_time)
+                    result.update(
+                        times=times,
+                        min=min(times),
+                        median=sorted(times)[len(times) // 2],
+                    )
+                results.append(result)
+                if verbose:
+                    print_result(result)
+    finally:
+        import shutil
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return results
+
+
+def format_name(result):
+    if result['nsites'] is None:
+        return result['name']
+    return '%s[%d]' % (result['name'], result['nsites'])
+
+
+def print_result(result):
+    if result.get('skipped'):
+        print('%-42s %12s' % (format_name(result), 'skipped'))
+    else:
+        print('%-42s %12.6f s  (%d runs)' % (
+            format_name(result), result['min'], len(result['times'])))
+    sys.stdout.flush()
+
+
+def compare(results, baseline, threshold=1.2):
+    """Prints a comparison of `results` with `baseline` and returns a
+    list of names of benchmarks that are more than a factor `threshold`
+    slower than the baseline."""
+    base = {(r['name'], r['nsites']): r for r in baseline['results']}
+    regressions = []
+    print()
+    print('%-42s %12s %12s %8s' % ('benchmark', 'baseline', 'current',
+                                    'ratio'))
+    for result in results:
+        old = base.get((result['name'], result['nsites']))
+        if result.get('skipped') or not old or old.get('skipped'):
+            continue
+        ratio = result['min'] / old['min'] if old['min'] else float('inf')
+        flag = ''
+        if ratio > threshold:
+            flag = '  SLOWER'
+            regressions.append(format_name(result))
+        elif ratio < 1. / threshold:
+            flag = '  faster'
+        print('%-42s %12.6f %12.6f %8.2f%s' % (
+            format_name(result), old['min'], result['min'], ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run the cif-demo benchmarks.')
+    parser.add_argument(
+        'patterns', metavar='NAME', nargs='*',
+        help='Glob pattern selecting the benchmarks to run.  Default is '
+        'to run all.')
+    parser.add_argument(
+        '--output', '-o', metavar='FILE',
+        help='Write the results as JSON to this file.')
+    parser.add_argument(
+        '--max-sites', type=int, default=max(SIZES), metavar='N',
+        help='Largest number of atom sites to benchmark with.  '
+        'Default: %d.' % max(SIZES))
+    parser.add_argument(
+        '--repeat', '-r', type=int, default=5, metavar='N',
+        help='Number of times to time each benchmark.  Default: 5.')
+    parser.add_argument(
+        '--max-time', type=float, default=10.0, metavar='SECONDS',
+        help='Do not repeat a benchmark when its total time exceeds '
+        'this.  Default: 10.')
+    parser.add_argument(
+        '--quick', action='store_true',
+        help='Only run with up to 1000 atom sites and no repetitions.')
+    parser.add_argument(
+        '--compare', '-c', metavar='FILE',
+        help='Compare with the results in this JSON file.')
+    parser.add_argument(
+        '--threshold', type=float, default=1.2,
+        help='Report benchmarks that are slower than the compared '
+        'results by more than this factor.  Default: 1.2.')
+    parser.add_argument(
+        '--list', action='store_true',
+        help='Only list the available benchmarks.')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, func, sized in benchmarks:
+            print(name)
+        return 0
+
+    max_sites = min(args.max_sites, 1000) if args.quick else args.max_sites
+    repeat = 1 if args.quick else args.repeat
+    sizes = [n for n in SIZES if n <= max_sites]
+    if standins:
+        print('using stand-ins for: %s' % ', '.join(standins))
+
+    metadata = get_metadata()
+    results = run(args.patterns, sizes, repeat, args.max_time)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(metadata=metadata, results=results), f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('\n%d benchmarks are slower: %s' % (
+                len(regressions), ', '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,21 @@
+"""Minimal stand-in for PyCifRW.
+
+Implements ReadCif() on top of the fastcif module, so only the tags
+needed by cifdata are read.  It is used by the benchmarks when PyCifRW
+is not installed.
+"""
+import fastcif
+
+
+class CifFile(dict):
+    """Maps lower-case block names to CifBlock instances."""
+    def __getitem__(self, name):
+        return dict.__getitem__(self, name.lower())
+
+
+def ReadCif(filename):
+    """Returns a CifFile with all data blocks in `filename`."""
+    cf = CifFile()
+    for name, block in fastcif.read_cif(filename):
+        cf[name.lower()] = block
+    return cf
@@ -0,0 +1,167 @@
+"""Minimal pure Python stand-in for softpy.
+
+Only implements the subset of the softpy API used by softcuds and
+cifdata, with all data held in memory.  It is used by the benchmarks
+when softpy is not installed, so the benchmarks can run offline.  Note
+that the timings then do not include any overhead of the SOFT C
+library.
+"""
+import os
+import json
+import uuid as _uuid
+
+
+# Registered metadata databases
+_metadbs = []
+
+
+def uuid_from_entity(name, version, namespace):
+    """Returns an UUID for the entity with the given name, version and
+    namespace."""
+    return str(_uuid.uuid5(_uuid.NAMESPACE_URL,
+                           '%s/%s/%s' % (namespace, version, name)))
+
+
+class JSONMetaDB(object):
+    """Metadata database holding the entities in the JSON file object
+    `f`."""
+    def __init__(self, f):
+        self.entities = json.load(f)
+
+
+class JSONDirMetaDB(object):
+    """Metadata database holding the entities in the JSON files in
+    directory `path`."""
+    def __init__(self, path):
+        self.path = path
+        self.entities = []
+        if os.path.isdir(path):
+            for fname in sorted(os.listdir(path)):
+                if not fname.endswith('.json'):
+                    continue
+                with open(os.path.join(path, fname)) as f:
+                    try:
+                        d = json.load(f)
+                    except ValueError:
+                        continue
+                if isinstance(d, dict) and 'name' in d:
+                    self.entities.append(d)
+
+
+def register_metadb(db):
+    """Registers metadata database `db`."""
+    _metadbs.append(db)
+
+
+def find_entity(name, version, namespace):
+    """Returns the dict describing the given entity."""
+    for db in reversed(_metadbs):
+        for d in db.entities:
+            if (d['name'], d['version'], d['namespace']) == (
+                    name, version, namespace):
+                return d
+    raise KeyError('no such entity: %s/%s/%s' % (namespace, version, name))
+
+
+class Metadata(object):
+    """Metadata of an entity."""
+    def __init__(self, d):
+        self.name = d['name']
+        self.version = d['version']
+        self.namespace = d['namespace']
+        self.description = d.get('description', '')
+
+    def get_uuid(self):
+        return uuid_from_entity(self.name, self.version, self.namespace)
+
+
+class BaseEntity(object):
+    """Base class for entities."""
+    soft_metadata = None
+    soft_property_names = ()
+
+    def __init__(self, uuid=None, **kw):
+        self.__dict__['_uuid'] = uuid or str(_uuid.uuid4())
+        for name in self.soft_property_names:
+            self.__dict__[name] = kw.get(name)
+
+    @classmethod
+    def soft_get_property_names(cls):
+        return list(cls.soft_property_names)
+
+    def soft_get_property(self, name):
+        return self.__dict__[name]
+
+    def soft_set_property(self, name, value):
+        if name not in self.soft_property_names:
+            raise KeyError(name)
+        self.__dict__[name] = value
+
+    def soft_get_id(self):
+        return self._uuid
+
+    def soft_get_meta_description(self):
+        return self.soft_metadata.description
+
+
+def entity(*args):
+    """Returns a new entity class.
+
+    Called either with a dict (or JSON string) describing the entity or
+    with the name, version and namespace of an entity in a registered
+    metadata database."""
+    if len(args) == 1:
+        d = args[0]
+        if not isinstance(d, dict):
+            d = json.loads(d)
+    else:
+        d = find_entity(*args)
+    attrs = dict(
+        name=d['name'],
+        soft_metadata=Metadata(d),
+        soft_property_names=tuple(p['name'] for p in d.get('properties', [])),
+    )
+    return type(str(d['name']), (BaseEntity, ), attrs)
+
+
+class Collection(object):
+    """A collection of labeled instances and relations between them."""
+    def __init__(self, uuid=None, driver=None, uri=None, options=None):
+        self.uuid = uuid or str(_uuid.uuid4())
+        self._instances = {}
+        self._relations = {}
+
+    def get_uuid(self):
+        return self.uuid
+
+    def add(self, label, instance):
+        self._instances[label] = instance
+
+    def add_relation(self, subject, predicate, object_):
+        self._relations.setdefault((subject, predicate), set()).add(object_)
+        self._relations.setdefault(
+            (object_, '^' + predicate), set()).add(subject)
+
+    def find_relations(self, subject, predicate):
+        return set(self._relations.get((subject, predicate), ()))
+
+    def get_labels(self):
+        return list(self._instances)
+
+    def get_instance(self, label):
+        return self._instances[label]
+
+    def save(self, storage):
+        pass
+
+
+class Storage(object):
+    """Dummy storage.  Nothing is stored."""
+    def __init__(self, driver=None, uri=None, options=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
@@ -0,0 +1,101 @@
+"""Command line interface for converting a CIF file to a serialized
+CUDS instance collection.
+
+Usage::
+
+    python cif2cuds.py [-b BLOCK] [-f yaml|json|binary] [-o OUTFILE]
+                       [--expand] CIFFILE
+
+Without CIFFILE, the VO2_rutile.cif example next to this file is
+converted.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+
+
+# Directory holding this file
+thisdir = os.path.dirname(os.path.abspath(__file__))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Convert a CIF file to a CUDS instance collection.')
+    parser.add_argument(
+        'filename', metavar='CIFFILE', nargs='?',
+        default=os.path.join(thisdir, 'VO2_rutile.cif'),
+        help='CIF file to convert.  Default: the VO2_rutile.cif example.')
+    parser.add_argument(
+        '--block', '-b', metavar='NAME',
+        help='Only convert the data block with this name.')
+    parser.add_argument(
+        '--parser', choices=['pycifrw', 'fast'], default='pycifrw',
+        help='CIF parser to use.  Default: "pycifrw".')
+    parser.add_argument(
+        '--format', '-f', choices=['yaml', 'json', 'binary'],
+        default='yaml', help='Output format.  Default: "yaml".')
+    parser.add_argument(
+        '--output', '-o', metavar='OUTFILE',
+        help='File to write to.  Default is standard output.  Required '
+        'for the binary format.')
+    parser.add_argument(
+        '--expand', '-e', action='store_true',
+        help='Expand the atom sites to the full unit cell by applying the '
+        'space-group operations.  Requires NumPy.')
+    parser.add_argument(
+        '--tolerance', type=float, metavar='TOL',
+        help='Distance in Angstrom below which symmetry images are merged '
+        'with --expand.  Default: 1e-3.')
+    args = parser.parse_args(argv)
+
+    import cifdata
+    import softcuds
+
+    if args.format == 'binary' and not args.output:
+        parser.error('the binary format requires --output')
+
+    cuds_collection = softcuds.get_cuds_collection()
+    blocks = [(name, block, cifdata.populate_cifdata(block))
+              for name, block in cifdata.read_cif_blocks(
+                  args.filename, args.block, args.parser)]
+    if not blocks:
+        print('no data blocks in %s' % args.filename, file=sys.stderr)
+        return 1
+    if len(blocks) > 1 and args.format == 'binary':
+        parser.error('the binary format can only hold one data block, '
+                     'use --block')
+
+    def convert(block, data):
+        symops = None
+        if args.expand:
+            import symmetry
+            symops = symmetry.get_symops(block)
+        return cifdata.cif2cuds_converter(data, cuds_collection,
+                                          expand=args.expand, symops=symops,
+                                          tol=args.tolerance)
+
+    if args.format == 'binary':
+        import cudsbinary
+        (_, block, data), = blocks
+        ci = convert(block, data)
+        with open(args.output, 'wb') as f:
+            cudsbinary.write_cuds_binary(ci, f)
+        return 0
+
+    f = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for _, block, data in blocks:
+            ci = convert(block, data)
+            softcuds.write_cuds_instance_collection(ci, f, args.format)
+            if args.format == 'json':
+                f.write('\n')
+    finally:
+        if f is not sys.stdout:
+            f.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,362 @@
+"""Batch conversion of CIF files to serialized CUDS instance collections.
+
+The CIF files are converted in a pool of worker processes.  Each worker
+builds the CUDS metadata collection once and reuses it for all the
+structures it converts.  Results are passed to an output sink in the
+order they complete.  A file that fails to convert is recorded as a
+failure and does not stop the batch.
+
+Usage::
+
+    python cifbatch.py -o OUTDIR [-j NPROCS] PATH_OR_GLOB ...
+
+Directories are searched recursively for files matching --pattern.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import glob
+import fnmatch
+import argparse
+import traceback
+import multiprocessing
+
+
+# CUDS metadata collection of the current worker process
+_cuds_collection = None
+
+
+def iter_cif_files(paths, pattern='*.cif'):
+    """Yields CIF file names found in `paths`.
+
+    Each element in `paths` may be a file name, a directory (searched
+    recursively for files matching `pattern`) or a glob pattern.  Each
+    file is only yielded once."""
+    seen = set()
+
+    def visit(filename):
+        if filename not in seen:
+            seen.add(filename)
+            return True
+        return False
+
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for fname in sorted(fnmatch.filter(filenames, pattern)):
+                    filename = os.path.join(dirpath, fname)
+                    if visit(filename):
+                        yield filename
+        elif os.path.isfile(path):
+            if visit(path):
+                yield path
+        else:
+            for filename in sorted(glob.glob(path)):
+                if os.path.isdir(filename):
+                    for f in iter_cif_files([filename], pattern):
+                        if visit(f):
+                            yield f
+                elif visit(filename):
+                    yield filename
+
+
+def get_input_root(paths):
+    """Returns the deepest directory containing all CIF files found in
+    `paths` (see iter_cif_files()), as an absolute path."""
+    dirs = []
+    for path in paths:
+        if os.path.isdir(path):
+            dirs.append(path)
+        else:
+            # The directory part of a glob pattern before its first
+            # wildcard, or the directory of a file
+            head = os.path.dirname(path)
+            while glob.has_magic(head):
+                head = os.path.dirname(head)
+            dirs.append(head)
+    parts = os.path.commonprefix([
+        os.path.abspath(d or os.curdir).split(os.sep) for d in dirs])
+    return os.sep.join(parts) or os.sep
+
+
+def _failure(filename, block, exc):
+    """Returns a result dict describing the failure of converting data
+    block `block` of CIF file `filename` with exception `exc`."""
+    return dict(filename=filename, block=block, status='error',
+                error=''.join(traceback.format_exception_only(
+                    type(exc), exc)).strip())
+
+
+def init_worker():
+    """Initialise a worker process by building the CUDS metadata
+    collection."""
+    global _cuds_collection
+    import softcuds
+    _cuds_collection = softcuds.get_cuds_collection()
+
+
+def convert_file(filename, blockname=None, parser='pycifrw', validate=False,
+                 check_output=False):
+    """Converts CIF file `filename` and returns a list of result dicts,
+    one per converted data block.
+
+    Each result dict has the keys:
+      :filename: The name of the CIF file.
+      :block:    Name of the data block or None if the file could not be
+                 read.
+      :status:   Either "ok" or "error".
+      :output:   The serialized CUDS instance collection (if ok).
+      :error:    A string describing the error (on error).
+
+    `parser` selects the CIF parser, see cifdata.read_cif_blocks().
+    If `validate` is true, each converted collection is validated
+    against the collection schema and its property values against their
+    entities (see validation.py), and invalid ones are reported as
+    errors.  If `check_output` is true, the serialized output is parsed
+    again and compared with the collection, which costs about as much
+    as the conversion itself.
+    """
+    import softcuds
+    import cifdata
+
+    if _cuds_collection is None:
+        init_worker()
+
+    # Blocks are read one at a time, such that large files with many
+    # data blocks do not have to fit in memory
+    results = []
+    try:
+        for block, cifblock in cifdata.iter_cif_blocks(filename, blockname,
+                                                       parser):
+            try:
+                data = cifdata.populate_cifdata(cifblock)
+                ci = cifdata.cif2cuds_converter(
+                    data, cuds_collection=_cuds_collection)
+                if validate:
+                    import validation
+                    validation.validate_collection(ci)
+                    validation.validate_instances(ci)
+                output = softcuds.serialize_cuds_instance_collection(ci)
+                if check_output:
+                    import validation
+                    validation.validate_document(output, ci)
+            except Exception as exc:
+                results.append(_failure(filename, block, exc))
+            else:
+                results.append(dict(filename=filename, block=block,
+                                    status='ok', output=output))
+    except Exception as exc:
+        results.append(_failure(filename, blockname, exc))
+    if not results:
+        results.append(_failure(filename, blockname,
+                                ValueError('no data blocks in CIF file')))
+    return results
+
+
+def _convert(args):
+    """Helper for Pool.imap_unordered()."""
+    filename, blockname, parser, validate, check_output = args
+    try:
+        return convert_file(filename, blockname, parser, validate,
+                            check_output)
+    except Exception as exc:
+        return [dict(filename=filename, block=blockname, status='error',
+                     error=repr(exc))]
+
+
+def convert_files(paths, sink, processes=None, blockname=None,
+                  pattern='*.cif', chunksize=1, parser='pycifrw',
+                  validate=False, check_output=False):
+    """Converts all CIF files found in `paths` and passes the results
+    to `sink`.
+
+    Parameters
+    ----------
+    paths : sequence
+        File names, directories or glob patterns.  See iter_cif_files().
+    sink : callable
+        Called with a result dict (see convert_file()) for each converted
+        data block, in completion order.  The sink may turn the result
+        into a failure by setting its status to "error".
+    processes : None | int
+        Number of worker processes.  Defaults to the number of CPUs.  If
+        zero, the files are converted in the current process.
+    blockname : None | string
+        If given, only convert data blocks with this name.
+    pattern : string
+        Glob pattern for files to convert in directories.
+    chunksize : int
+        Number of files sent to a worker at a time.
+    parser : "pycifrw" | "fast"
+        The CIF parser to use, see cifdata.read_cif_blocks().
+    validate : bool
+        Whether to validate the converted collections, see convert_file().
+    check_output : bool
+        Whether to check the serialized output, see convert_file().
+
+    Returns
+    -------
+    nok : int
+        Number of successfully converted data blocks.
+    failures : list
+        List of result dicts for the failed conversions.
+    """
+    tasks = ((filename, blockname, parser, validate, check_output)
+             for filename in iter_cif_files(paths, pattern))
+    nok = 0
+    failures = []
+
+    def handle(results):
+        nok = 0
+        for result in results:
+            sink(result)
+            if result['status'] == 'ok':
+                nok += 1
+            else:
+                failures.append(result)
+        return nok
+
+    if processes == 0:
+        for task in tasks:
+            nok += handle(_convert(task))
+    else:
+        pool = multiprocessing.Pool(processes, initializer=init_worker)
+        try:
+            for results in pool.imap_unordered(_convert, tasks, chunksize):
+                nok += handle(results)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    return nok, failures
+
+
+class DirectorySink(object):
+    """Output sink writing each successful result to a YAML file in
+    directory `outdir`.
+
+    The file is named after the path of the CIF file relative to
+    directory `root` and the data block, such that a/x.cif and b/x.cif
+    are written to a/x-BLOCK.yml and b/x-BLOCK.yml.  `root` is typically
+    obtained with get_input_root().  If not given, or for CIF files
+    outside of it, only the base name of the CIF file is used.  Failures
+    are appended as JSON lines to `outdir`/failures.jsonl.
+
+    A result whose file was already written, since its CIF file has
+    several data blocks with the same name, or another CIF file maps to
+    the same name, is not written, but turned into a failure in place,
+    such that callers calling the sink before inspecting the status
+    count it as such."""
+    def __init__(self, outdir, root=None):
+        self.outdir = outdir
+        self.root = os.path.abspath(root) if root is not None else None
+        self.sources = {}  # maps written file names to their source
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+
+    def get_output_name(self, filename, block):
+        """Returns the name of the output file of data block `block` of
+        CIF file `filename`, relative to the output directory."""
+        source = os.path.abspath(filename)
+        relpath = os.path.basename(source)
+        if self.root is not None:
+            path = os.path.relpath(source, self.root)
+            if path != os.pardir and not path.startswith(os.pardir + os.sep):
+                relpath = path
+        return '%s-%s.yml' % (os.path.splitext(relpath)[0], block)
+
+    def __call__(self, result):
+        if result['status'] == 'ok':
+            fname = self.get_output_name(result['filename'], result['block'])
+            source = os.path.abspath(result['filename'])
+            other = self.sources.get(fname)
+            if other is None:
+                self.sources[fname] = source
+            else:
+                if other == source:
+                    error = 'duplicate data block %s in %s' % (
+                        result['block'], source)
+                else:
+                    error = 'output file %s already written for %s' % (
+                        fname, other)
+                del result['output']
+                result.update(status='error', error=error)
+        if result['status'] == 'ok':
+            path = os.path.join(self.outdir, fname)
+            dirname = os.path.dirname(path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(path, 'w') as f:
+                f.write(result['output'])
+        else:
+            with open(os.path.join(self.outdir, 'failures.jsonl'), 'a') as f:
+                f.write(json.dumps(result) + '\n')
+
+
+class JSONLinesSink(object):
+    """Output sink writing each result as a line of JSON to the file
+    object `f`."""
+    def __init__(self, f):
+        self.f = f
+
+    def __call__(self, result):
+        self.f.write(json.dumps(result) + '\n')
+        self.f.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Convert CIF files to CUDS instance collections.')
+    parser.add_argument(
+        'paths', metavar='PATH', nargs='+',
+        help='CIF file, directory or glob pattern.')
+    parser.add_argument(
+        '--output', '-o', metavar='OUTDIR',
+        help='Directory to write the YAML output to.  By default, the '
+        'results are written as JSON lines to standard output.')
+    parser.add_argument(
+        '--processes', '-j', type=int, metavar='N',
+        help='Number of worker processes.  Defaults to the number of CPUs.')
+    parser.add_argument(
+        '--block', '-b', metavar='NAME',
+        help='Only convert data blocks with this name.')
+    parser.add_argument(
+        '--pattern', default='*.cif',
+        help='Glob pattern for files in directories.  Default: "*.cif".')
+    parser.add_argument(
+        '--parser', choices=['pycifrw', 'fast'], default='pycifrw',
+        help='CIF parser to use.  "fast" only extracts the needed tags.  '
+        'Default: "pycifrw".')
+    parser.add_argument(
+        '--validate', action='store_true',
+        help='Validate the converted collections and their property '
+        'values and report invalid ones as failures.')
+    parser.add_argument(
+        '--check-output', action='store_true',
+        help='Parse the YAML output again and compare it with the '
+        'converted collection.  Doubles the run time.')
+    args = parser.parse_args(argv)
+
+    if args.output:
+        sink = DirectorySink(args.output, get_input_root(args.paths))
+    else:
+        sink = JSONLinesSink(sys.stdout)
+    nok, failures = convert_files(args.paths, sink,
+                                  processes=args.processes,
+                                  blockname=args.block,
+                                  pattern=args.pattern,
+                                  parser=args.parser,
+                                  validate=args.validate,
+                                  check_output=args.check_output)
+    print('converted %d data blocks, %d failures' % (nok, len(failures)),
+          file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,14 @@
 """
-Simple example script that reads CIF data into an abstract syntax tree
+Simple library that reads CIF data into an abstract syntax tree
 using PyCifRW and populates an cifdata instance with this data.
 
 If the _atom_site_type_symbol is not defined in the CIF data, it is
 derived from _atom_site_label.
 
+Importing this module has no side effects.  The metadata databases
+are registered and the CifData class is created on first use, see
+get_cifdata_class().  The command line interface is in cif2cuds.py.
+
 Todo
 ----
 Convert this to a proper SOFT storage plugin.
@@ -12,52 +16,149 @@ Convert this to a proper SOFT storage plugin.
 import os
 import re
 
-import yaml
-from CifFile import ReadCif
-
-import softpy
-
 import softcuds
+import instrument
 
 
 # Directory holding this file
-thisdir = os.path.dirname(__file__)
+thisdir = os.path.dirname(os.path.abspath(__file__))
 
-# Load SOFT metadata database
-softpy.register_metadb(softpy.JSONDirMetaDB(
-    os.path.join(thisdir, 'metadata')))
+# Whether the metadata databases are registered, see init_metadata()
+_metadb_registered = False
 
-# Load CUDS metadata database (created by softcuds.py)
-softpy.register_metadb(softpy.JSONDirMetaDB(
-    os.path.join(thisdir, 'metadata', 'cuds_entities', '1.0')))
+# The CifData entity class, created by get_cifdata_class()
+_CifData = None
 
 
+def init_metadata():
+    """Registers the SOFT metadata database with the cifdata entity and
+    the database with the CUDS entities (created by softcuds.py).
 
-# Read cif data
-cf = ReadCif('VO2_rutile.cif')
-rut = cf['VO2_rut_ini']
+    Called by get_cifdata_class().  Does nothing if the databases are
+    already registered."""
+    global _metadb_registered
+    if _metadb_registered:
+        return
+    import softpy
+    softpy.register_metadb(softpy.JSONDirMetaDB(
+        os.path.join(thisdir, 'metadata')))
+    softpy.register_metadb(softpy.JSONDirMetaDB(
+        os.path.join(thisdir, 'metadata', 'cuds_entities', '1.0')))
+    _metadb_registered = True
 
 
-# Create a Python class representation of cifdata-0.1
-CifData = softpy.entity('cifdata', '0.1', 'http://emmc.info/meta')
+def get_cifdata_class():
+    """Returns the Python class representation of cifdata-0.1.
 
-# Create uninitialised CifData instance
-cifdata = CifData()
+    The class is created on the first call."""
+    global _CifData
+    if _CifData is None:
+        import softpy
+        init_metadata()
+        _CifData = softpy.entity('cifdata', '0.1', 'http://emmc.info/meta')
+    return _CifData
+
+
+def __getattr__(name):
+    # Lazy module attribute for backward compatibility (Python 3.7+)
+    if name == 'CifData':
+        return get_cifdata_class()
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+def get_space_group_symbol(block):
+    """Returns the Hall or Hermann-Mauguin symbol of the space group in
+    CIF data block `block`, or an empty string if it has none."""
+    import fastcif
+    cifkeys = {k.lower(): k for k in block.keys()}
+    for tag in fastcif.SYMBOL_TAGS:
+        value = block[cifkeys[tag]] if tag in cifkeys else None
+        if value and value not in ('?', '.'):
+            return value
+    return ''
+
+
+def populate_cifdata(block):
+    """Returns a new CifData instance initialised from the CIF data
+    block `block`."""
+    # Create uninitialised CifData instance
+    cifdata = get_cifdata_class()()
+
+    # Initialise the instance from the cif file
+    cifkeys = [k.lower() for k in block.keys()]  # newer versions of PyCifRW
+                                                 # changed all keys to
+                                                 # lower-case
+    for name in cifdata.soft_get_property_names():
+        tag = '_' + name.lower()
+        if tag in cifkeys:
+            value = block[tag]
+        elif name == 'atom_site_type_symbol':
+            value = [re.match('[A-Z][a-z]{0,2}', l).group()
+                     for l in block['_atom_site_label']]
+        elif name == 'space_group_symbol':
+            value = get_space_group_symbol(block)
+        else:
+            raise KeyError('cannot derive "%s" from cif data' % name)
+        cifdata.soft_set_property(name, value)
+    return cifdata
+
+
+def read_cif_blocks(filename, blockname=None, parser='pycifrw'):
+    """Reads CIF file `filename` and returns a list of (blockname, block)
+    tuples.
+
+    If `blockname` is given, only that data block is returned.
+    Otherwise all data blocks in the file are returned.
+
+    `parser` selects the CIF parser.  It may be "pycifrw" for a full
+    parse with PyCifRW or "fast" for the streaming tag extractor in
+    fastcif, which only reads the tags needed by populate_cifdata()."""
+    if parser == 'fast':
+        import fastcif
+        with instrument.phase('parse'):
+            return fastcif.read_cif(filename, blockname)
+    elif parser != 'pycifrw':
+        raise ValueError('unknown CIF parser: %r' % parser)
+    from CifFile import ReadCif
+    with instrument.phase('parse'):
+        cf = ReadCif(filename)
+        names = [blockname] if blockname else list(cf.keys())
+        return [(name, cf[name]) for name in names]
+
+
+def iter_cif_blocks(filename, blockname=None, parser='pycifrw', index=None):
+    """Like read_cif_blocks(), but yields the (blockname, block) tuples
+    one at a time.
+
+    With the "fast" parser the file is streamed, so only one data block
+    is held in memory at a time, and `index` may be given to seek
+    directly to the data block(s) in `blockname`, see fastcif.iter_cif().
+    PyCifRW always parses the whole file first."""
+    if parser == 'fast':
+        import fastcif
+        return fastcif.iter_cif(filename, blockname, index=index)
+    return iter(read_cif_blocks(filename, blockname, parser))
 
-# Initialise the instance from the cif file
-cifkeys = [k.lower() for k in rut.keys()]  # newer versions of PyCifRW
-                                           # changed all keys to lower-case
-for name in cifdata.soft_get_property_names():
-    tag = '_' + name.lower()
-    if tag in cifkeys:
-        value = rut[tag]
-    elif name == 'atom_site_type_symbol':
-        value = [re.match('[A-Z][a-z]{0,2}', l).group()
-                 for l in rut['_atom_site_label']]
-    else:
-        raise KeyError('cannot derive "%s" from cif data' % name)
-    cifdata.soft_set_property(name, value)
 
+def iter_cifdata(filename, blockname=None, parser='pycifrw', index=None):
+    """Like iter_cif_blocks(), but yields (blockname, cifdata) tuples,
+    where `cifdata` is a CifData instance."""
+    blocks = iter_cif_blocks(filename, blockname, parser, index)
+    while True:
+        # With the fast parser, each block is parsed when requested
+        with instrument.phase('parse'):
+            item = next(blocks, None)
+        if item is None:
+            return
+        name, block = item
+        yield name, populate_cifdata(block)
+
+
+def read_cifdata(filename, blockname=None, parser='pycifrw'):
+    """Like read_cif_blocks(), but returns a list of (blockname, cifdata)
+    tuples, where `cifdata` is a CifData instance."""
+    return [(name, populate_cifdata(block))
+            for name, block in read_cif_blocks(filename, blockname, parser)]
 
 
 def set_attributes(collection, label, **kw):
@@ -69,14 +170,12 @@ def set_attributes(collection, label, **kw):
     collection.add(label, instance)
 
 
-
-# Define converter from CifData to CUDS
-def cif2cuds_converter(cifdata):
-    """Returns a list of instances of CUDS element entities representing
-    the data in `cifdata`."""
-    uuid = softpy.uuid_from_entity('CUDS', '1.0', 'http://emmc.info/meta')
-    cuds_collection = softcuds.get_cuds_collection()
-    nsites = len(cifdata.atom_site_type_symbol)
+def new_crystal_structure(cifdata, nsites, cuds_collection=None):
+    """Returns a new CUDS instance collection of a CRYSTAL_STRUCTURE with
+    `nsites` atom sites and with the space group and lattice parameters
+    set from `cifdata`."""
+    if cuds_collection is None:
+        cuds_collection = softcuds.get_cuds_collection()
     ci = softcuds.get_cuds_instance_collection(
         cuds_collection=cuds_collection,
         name='CRYSTAL_STRUCTURE',
@@ -99,37 +198,106 @@ def cif2cuds_converter(cifdata):
             cifdata.cell_angle_beta,
             cifdata.cell_angle_gamma,
         ])
-    occupancy = getattr(cifdata, 'atom_site_occupancy', [1.0] * nsites)
-    for i in range(nsites):
-        set_attributes(
-            ci, 'CRYSTAL_STRUCTURE.ATOM_SITES.ATOM_SITE[%d]' % i,
-            OCCUPANCY=occupancy[i],
-            CHEMICAL_SPECIE=cifdata.atom_site_type_symbol[i],
-        )
-        set_attributes(
-            ci, 'CRYSTAL_STRUCTURE.ATOM_SITES.ATOM_SITE[%d].ATOM_SCALED_COORDINATES' % i,
-            SCALED_POSITION=[
-                cifdata.atom_site_fract_x[i],
-                cifdata.atom_site_fract_y[i],
-                cifdata.atom_site_fract_z[i],
-            ])
-
     return ci
 
 
+def expand_atom_sites(cifdata, symops=None, tol=None, check=True):
+    """Returns an atomsites.AtomSites instance with the atom sites in
+    `cifdata` expanded to the full unit cell.
+
+    `symops` is a (rotations, translations) tuple with the space-group
+    operations, for instance as returned by symmetry.get_block_symops().
+    If not given, the operations of the space group in `cifdata` are
+    looked up with spglib, by its symbol if the CIF file gives one and
+    otherwise by its number.  Images closer than `tol` Angstrom are
+    merged.  If `check` is true, the number of images of each site is
+    checked against the _atom_site_symmetry_multiplicity values.
 
+    Requires NumPy."""
+    import atomsites
+    import symmetry
+    if symops is None:
+        symops = symmetry.get_symops(
+            spacegroup=getattr(cifdata, 'space_group_symbol', None) or
+            cifdata.symmetry_Int_Tables_number)
+    if tol is None:
+        tol = symmetry.TOLERANCE
+    lattice = symmetry.cell_to_lattice(
+        cifdata.cell_length_a, cifdata.cell_length_b, cifdata.cell_length_c,
+        cifdata.cell_angle_alpha, cifdata.cell_angle_beta,
+        cifdata.cell_angle_gamma)
+    multiplicities = None
+    if check:
+        multiplicities = getattr(cifdata, 'atom_site_symmetry_multiplicity',
+                                 None)
+    rotations, translations = symops
+    sites, _ = symmetry.expand_sites(
+        atomsites.AtomSites.from_cifdata(cifdata), rotations, translations,
+        tol, lattice, multiplicities, list(cifdata.atom_site_label))
+    return sites
 
-#----------------
-# Some testing...
-#----------------
 
-# Print content of cifdata
-#print()
-#for name in cifdata.soft_get_property_names():
-#    print('%38s = %-r' % (name, getattr(cifdata, name)))
+# Define converter from CifData to CUDS
+def cif2cuds_converter(cifdata, cuds_collection=None, expand=False,
+                       symops=None, tol=None):
+    """Returns a list of instances of CUDS element entities representing
+    the data in `cifdata`.
 
-# Create a collection representing a CUDS crystal structure for the cif data
-ci = cif2cuds_converter(cifdata)
+    `cuds_collection` is the CUDS metadata collection to instantiate
+    from.  It is created with softcuds.get_cuds_collection() if not
+    given, which may be expensive when converting many structures.
 
-# Serialize the CUDS instance
-print(softcuds.serialize_cuds_instance_collection(ci))
+    By default only the atom sites of the asymmetric unit are converted.
+    If `expand` is true, they are expanded to the full unit cell, see
+    expand_atom_sites() for `symops` and `tol`."""
+    if expand:
+        sites = expand_atom_sites(cifdata, symops, tol)
+        symbols = sites.symbols.tolist()
+        occupancy = sites.occupancies.tolist()
+        positions = sites.positions.tolist()
+    else:
+        symbols = cifdata.atom_site_type_symbol
+        occupancy = getattr(cifdata, 'atom_site_occupancy',
+                            [1.0] * len(symbols))
+        positions = list(zip(cifdata.atom_site_fract_x,
+                             cifdata.atom_site_fract_y,
+                             cifdata.atom_site_fract_z))
+    nsites = len(symbols)
+    instrument.count('atom sites', nsites)
+    with instrument.phase('collection'):
+        ci = new_crystal_structure(cifdata, nsites, cuds_collection)
+    with instrument.phase('properties'):
+        for i in range(nsites):
+            set_attributes(
+                ci, 'CRYSTAL_STRUCTURE.ATOM_SITES.ATOM_SITE[%d]' % i,
+                OCCUPANCY=occupancy[i],
+                CHEMICAL_SPECIE=symbols[i],
+            )
+            set_attributes(
+                ci, 'CRYSTAL_STRUCTURE.ATOM_SITES.ATOM_SITE[%d].ATOM_SCALED_COORDINATES' % i,
+                SCALED_POSITION=list(positions[i]))
+
+    return ci
+
+
+def cif2cuds_columnar(cifdata, cuds_collection=None, expand=False,
+                      symops=None, tol=None):
+    """Columnar version of cif2cuds_converter().
+
+    Returns a (ci, sites) tuple, where `ci` is a CUDS instance
+    collection of a CRYSTAL_STRUCTURE without any ATOM_SITE instances
+    and `sites` is an atomsites.AtomSites instance holding the atom
+    sites as NumPy arrays.  Call ``sites.materialize(ci, ...)`` to
+    create the ATOM_SITE instances that are needed.  If `expand` is
+    true, `sites` holds the full unit cell, see cif2cuds_converter().
+
+    Requires NumPy."""
+    import atomsites
+    if cuds_collection is None:
+        cuds_collection = softcuds.get_cuds_collection()
+    ci = new_crystal_structure(cifdata, 0, cuds_collection)
+    if expand:
+        sites = expand_atom_sites(cifdata, symops, tol)
+    else:
+        sites = atomsites.AtomSites.from_cifdata(cifdata)
+    return ci, sites
@@ -0,0 +1,435 @@
+"""Asyncio pipeline converting CIF files to serialized CUDS instance
+collections.
+
+The conversion is split into the stages
+
+  :read:       Read the data blocks of the CIF files, one at a time.
+  :convert:    Populate a CifData instance and convert it with
+               cifdata.cif2cuds_converter().
+  :serialize:  Serialize the instance collection with
+               softcuds.serialize_cuds_instance_collection().
+
+Each stage runs its blocking work in an executor and the stages are
+connected with bounded queues.  A stage that falls behind fills its
+input queue, which suspends the stages before it (backpressure), so at
+most a few data blocks are in flight at any time.  File I/O of one file
+thus overlaps with the conversion of the previous ones.
+
+Example::
+
+    pipeline = Pipeline(parser='fast')
+    await pipeline.run(filenames, sink)
+    print(pipeline.metrics.snapshot())
+
+The results passed to the sink are the same dicts as produced by
+cifbatch.convert_file(), so the sinks of cifbatch can be used.  A data
+block that fails to convert is passed on as a failure and does not stop
+the pipeline.
+
+Cancelling run() cancels all stages and closes the CIF file being read,
+by the executor thread reading it once the current data block is read.
+Other work already submitted to the executor runs to completion, but
+its result is discarded.
+
+The executor must be thread based, since instance collections are
+passed between the stages.  Use cifbatch for conversion in multiple
+processes.
+
+Usage::
+
+    python cifpipeline.py [-o OUTDIR] PATH_OR_GLOB ...
+
+Requires Python 3.7 or later.
+"""
+import sys
+import time
+import asyncio
+import argparse
+import threading
+import concurrent.futures
+
+import cifbatch
+from cifbatch import _failure
+
+
+timer = time.perf_counter
+
+# Names of the pipeline stages, in order
+STAGES = ('read', 'convert', 'serialize')
+
+# End of stream marker
+_DONE = object()
+
+
+class StageMetrics(object):
+    """Metrics of a pipeline stage.
+
+    Attributes
+    ----------
+    name : string
+        Name of the stage.
+    count : int
+        Number of items processed.
+    errors : int
+        Number of items that failed in this stage.
+    busy : float
+        Total time in seconds spent in the executor.
+    queue : None | asyncio.Queue
+        The input queue of the stage.
+    peak_depth : int
+        Largest observed number of items in the input queue.
+    """
+    def __init__(self, name, queue=None):
+        self.name = name
+        self.count = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.queue = queue
+        self.peak_depth = 0
+
+    @property
+    def depth(self):
+        """Current number of items in the input queue."""
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def observe(self):
+        """Updates the peak queue depth."""
+        self.peak_depth = max(self.peak_depth, self.depth)
+
+
+class PipelineMetrics(object):
+    """Throughput and queue depth metrics of a running or finished
+    pipeline.
+
+    Attributes
+    ----------
+    stages : dict
+        Maps stage names to StageMetrics instances.
+    start, stop : None | float
+        Start and stop time of the pipeline as returned by timer().
+    """
+    def __init__(self):
+        self.stages = {name: StageMetrics(name) for name in STAGES}
+        self.start = None
+        self.stop = None
+
+    @property
+    def elapsed(self):
+        """Wall time in seconds since the pipeline was started."""
+        if self.start is None:
+            return 0.0
+        return (self.stop if self.stop is not None else timer()) - self.start
+
+    def snapshot(self):
+        """Returns the current metrics as a dict that can be serialised
+        as JSON."""
+        elapsed = self.elapsed
+        stages = {}
+        for name, stage in self.stages.items():
+            stage.observe()
+            stages[name] = dict(
+                count=stage.count,
+                errors=stage.errors,
+                busy=stage.busy,
+                throughput=stage.count / elapsed if elapsed else 0.0,
+                queue_depth=stage.depth,
+                queue_peak=stage.peak_depth,
+                queue_maxsize=(stage.queue.maxsize
+                               if stage.queue is not None else None),
+            )
+        return dict(elapsed=elapsed, running=self.stop is None and
+                    self.start is not None, stages=stages)
+
+
+class _BlockReader(object):
+    """Reads the data blocks of CIF file `filename` one at a time in
+    executor threads.
+
+    The blocks are read by calling next_block() in the executor.
+    close() may be called from any thread.  If a data block is being
+    read, the file is closed by the reading thread once it is done,
+    since closing a running generator fails."""
+    def __init__(self, filename, blockname=None, parser='pycifrw'):
+        self.filename = filename
+        self.blockname = blockname
+        self.parser = parser
+        self.blocks = None
+        self.cancelled = threading.Event()
+        self._lock = threading.Lock()
+
+    def next_block(self):
+        """Returns the next (blockname, block) tuple or _DONE if there
+        are no more data blocks or the reader is closed."""
+        import cifdata
+        with self._lock:
+            if self.cancelled.is_set():
+                item = _DONE
+            else:
+                if self.blocks is None:
+                    self.blocks = cifdata.iter_cif_blocks(
+                        self.filename, self.blockname, self.parser)
+                item = next(self.blocks, _DONE)
+        # close() may have been called while reading
+        if self.cancelled.is_set():
+            self.close()
+        return item
+
+    def close(self):
+        """Closes the CIF file, unless another thread is reading it, in
+        which case that thread closes it when done."""
+        self.cancelled.set()
+        if self._lock.acquire(False):
+            try:
+                if hasattr(self.blocks, 'close'):
+                    self.blocks.close()
+            finally:
+                self._lock.release()
+
+
+class Pipeline(object):
+    """Asyncio pipeline converting CIF files.
+
+    Parameters
+    ----------
+    cuds_collection : None | softpy.Collection
+        The CUDS metadata collection.  Built on first use if not given.
+    blockname : None | string
+        If given, only convert data blocks with this name.
+    parser : "pycifrw" | "fast"
+        The CIF parser to use, see cifdata.read_cif_blocks().  Only the
+        "fast" parser streams the data blocks of a file.
+    format : "yaml" | "json"
+        Serialization format.
+    maxsize : int
+        Maximum number of items in each queue between the stages.
+    workers : int
+        Number of concurrent workers of the convert and serialize
+        stages.  The read stage always has one.
+    executor : None | concurrent.futures.Executor
+        Thread based executor to run the stages in.  By default a
+        ThreadPoolExecutor is created for each call to run().
+    """
+    def __init__(self, cuds_collection=None, blockname=None,
+                 parser='pycifrw', format='yaml', maxsize=4, workers=1,
+                 executor=None):
+        self.cuds_collection = cuds_collection
+        self.blockname = blockname
+        self.parser = parser
+        self.format = format
+        self.maxsize = maxsize
+        self.workers = workers
+        self.executor = executor
+        self.metrics = PipelineMetrics()
+
+    async def _call(self, stage, func, *args):
+        """Runs `func` in the executor and records the time in the
+        metrics of `stage`."""
+        loop = asyncio.get_running_loop()
+        t = timer()
+        try:
+            return await loop.run_in_executor(self._executor, func, *args)
+        finally:
+            stage.busy += timer() - t
+
+    async def _read(self, filenames, outq):
+        """Read stage, puts (filename, blockname, block) tuples in
+        `outq`.
+
+        The file names are also taken from `filenames` in the executor,
+        since it may be a generator searching directories, like
+        cifbatch.iter_cif_files()."""
+        stage = self.metrics.stages['read']
+        filenames = iter(filenames)
+        while True:
+            filename = await self._call(stage, next, filenames, _DONE)
+            if filename is _DONE:
+                break
+            reader = _BlockReader(filename, self.blockname, self.parser)
+            try:
+                nblocks = 0
+                while True:
+                    item = await self._call(stage, reader.next_block)
+                    if item is _DONE:
+                        break
+                    nblocks += 1
+                    stage.count += 1
+                    await outq.put((filename, ) + tuple(item))
+                    self.metrics.stages['convert'].observe()
+                if not nblocks:
+                    raise ValueError('no data blocks in CIF file')
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                stage.errors += 1
+                await outq.put(_failure(filename, self.blockname, exc))
+            finally:
+                reader.close()
+        await outq.put(_DONE)
+
+    def _convert_block(self, block):
+        import cifdata
+        data = cifdata.populate_cifdata(block)
+        return cifdata.cif2cuds_converter(data, self.cuds_collection)
+
+    def _serialize(self, ci):
+        import softcuds
+        return softcuds.serialize_cuds_instance_collection(ci, self.format)
+
+    async def _stage(self, name, func, inq, outq):
+        """Runs `self.workers` workers calling `func` in the executor for
+        each (filename, blockname, value) tuple in `inq` and putting
+        (filename, blockname, result) tuples in `outq`.  Failures are
+        passed on unchanged."""
+        stage = self.metrics.stages[name]
+
+        async def worker():
+            while True:
+                stage.observe()
+                item = await inq.get()
+                if item is _DONE:
+                    inq.put_nowait(_DONE)  # let the other workers stop
+                    return
+                if not isinstance(item, dict):
+                    filename, block, value = item
+                    try:
+                        value = await self._call(stage, func, value)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as exc:
+                        stage.errors += 1
+                        item = _failure(filename, block, exc)
+                    else:
+                        item = (filename, block, value)
+                    stage.count += 1
+                await outq.put(item)
+
+        await asyncio.gather(*[worker() for _ in range(self.workers)])
+        await outq.put(_DONE)
+
+    async def _drain(self, inq, sink):
+        """Passes the results in `inq` to `sink`."""
+        while True:
+            item = await inq.get()
+            if item is _DONE:
+                return
+            if isinstance(item, dict):
+                result = item
+            else:
+                filename, block, output = item
+                result = dict(filename=filename, block=block, status='ok',
+                              output=output)
+            ret = sink(result)
+            if asyncio.iscoroutine(ret):
+                await ret
+
+    async def run(self, filenames, sink):
+        """Converts the CIF files in the iterable `filenames` and passes
+        a result dict for each data block to `sink` (see
+        cifbatch.convert_file()).  `sink` may be a plain function or a
+        coroutine function.
+
+        Returns the PipelineMetrics."""
+        import softcuds
+        self.metrics = metrics = PipelineMetrics()
+        metrics.start = timer()
+        queues = [asyncio.Queue(self.maxsize) for _ in STAGES]
+        for name, queue in zip(STAGES[1:] + ('sink', ), queues):
+            if name in metrics.stages:
+                metrics.stages[name].queue = queue
+        self._executor = self.executor
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                1 + 2 * self.workers)
+        tasks = []
+        try:
+            if self.cuds_collection is None:
+                loop = asyncio.get_running_loop()
+                self.cuds_collection = await loop.run_in_executor(
+                    self._executor, softcuds.get_cuds_collection)
+            tasks = [
+                asyncio.ensure_future(self._read(filenames, queues[0])),
+                asyncio.ensure_future(self._stage(
+                    'convert', self._convert_block, queues[0], queues[1])),
+                asyncio.ensure_future(self._stage(
+                    'serialize', self._serialize, queues[1], queues[2])),
+                asyncio.ensure_future(self._drain(queues[2], sink)),
+            ]
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if self.executor is None:
+                self._executor.shutdown(wait=False)
+            self._executor = None
+            metrics.stop = timer()
+        return metrics
+
+
+async def convert_files(paths, sink, pattern='*.cif', **kw):
+    """Converts all CIF files found in `paths` (see
+    cifbatch.iter_cif_files()) with a new Pipeline and passes the results
+    to `sink`.  The keyword arguments are passed to Pipeline.
+
+    Returns the PipelineMetrics."""
+    pipeline = Pipeline(**kw)
+    return await pipeline.run(cifbatch.iter_cif_files(paths, pattern), sink)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Convert CIF files to CUDS instance collections with '
+        'an asyncio pipeline.')
+    parser.add_argument(
+        'paths', metavar='PATH', nargs='+',
+        help='CIF file, directory or glob pattern.')
+    parser.add_argument(
+        '--output', '-o', metavar='OUTDIR',
+        help='Directory to write the YAML output to.  By default, the '
+        'results are written as JSON lines to standard output.')
+    parser.add_argument(
+        '--block', '-b', metavar='NAME',
+        help='Only convert data blocks with this name.')
+    parser.add_argument(
+        '--pattern', default='*.cif',
+        help='Glob pattern for files in directories.  Default: "*.cif".')
+    parser.add_argument(
+        '--parser', choices=['pycifrw', 'fast'], default='fast',
+        help='CIF parser to use.  Default: "fast".')
+    parser.add_argument(
+        '--maxsize', type=int, default=4, metavar='N',
+        help='Maximum number of items in each queue.  Default: 4.')
+    parser.add_argument(
+        '--workers', '-j', type=int, default=1, metavar='N',
+        help='Number of workers of the convert and serialize stages.  '
+        'Default: 1.')
+    args = parser.parse_args(argv)
+
+    if args.output:
+        sink = cifbatch.DirectorySink(args.output,
+                                      cifbatch.get_input_root(args.paths))
+    else:
+        sink = cifbatch.JSONLinesSink(sys.stdout)
+    failures = []
+
+    def record(result):
+        sink(result)
+        if result['status'] != 'ok':
+            failures.append(result)
+
+    metrics = asyncio.run(convert_files(
+        args.paths, record, pattern=args.pattern, blockname=args.block,
+        parser=args.parser, maxsize=args.maxsize, workers=args.workers))
+    for name in STAGES:
+        d = metrics.snapshot()['stages'][name]
+        sys.stderr.write('%-10s %6d items %8.2f items/s  busy %8.3f s  '
+                         'peak queue %d/%s\n' % (
+                             name, d['count'], d['throughput'], d['busy'],
+                             d['queue_peak'], d['queue_maxsize']))
+    sys.stderr.write('%d failures in %.3f s\n' % (len(failures),
+                                                  metrics.elapsed))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""Supercells and periodic neighbor lists of crystal structures.
+
+The functions in this module operate on atomsites.AtomSites instances
+and 3 x 3 lattice matrices (with the lattice vectors as rows), such
+that structures with 10^5 and more atoms can be handled without
+creating per-site Python objects.  A CRYSTAL_STRUCTURE instance
+collection is converted to this representation with get_crystal().
+
+Neighbor lists are computed with a cell-list algorithm: the atoms are
+sorted into bins of at least the cutoff in each lattice direction, and
+only atoms in neighboring bins are compared.  Run time and memory use
+are therefore linear in the number of atoms for a fixed density.
+
+Requires NumPy.
+"""
+import numpy as np
+
+import atomsites
+import symmetry
+
+
+# Label of the LATTICE_PARAMETERS instance in a CRYSTAL_STRUCTURE
+# collection
+LATTICE_PARAMETERS_LABEL = 'CRYSTAL_STRUCTURE.LATTICE_PARAMETERS'
+
+
+def get_lattice(ci, label=LATTICE_PARAMETERS_LABEL):
+    """Returns the lattice matrix of CUDS instance collection `ci` built
+    from the LATTICE_PARAMETER property of instance `label`."""
+    params = ci.get_instance(label).soft_get_property('LATTICE_PARAMETER')
+    return symmetry.cell_to_lattice(*[float(p) for p in params])
+
+
+def lattice_to_cell(lattice):
+    """Returns the cell lengths and angles (in degree) of `lattice` as a
+    list [a, b, c, alpha, beta, gamma]."""
+    lattice = np.asarray(lattice, dtype=float)
+    lengths = np.sqrt(np.einsum('ij,ij->i', lattice, lattice))
+    angles = []
+    for i, j in ((1, 2), (2, 0), (0, 1)):
+        cos = np.dot(lattice[i], lattice[j]) / (lengths[i] * lengths[j])
+        angles.append(float(np.degrees(np.arccos(np.clip(cos, -1.0, 1.0)))))
+    return lengths.tolist() + angles
+
+
+def get_crystal(ci, base=atomsites.ATOM_SITES_LABEL,
+                label=LATTICE_PARAMETERS_LABEL):
+    """Returns a (sites, lattice) tuple for the CRYSTAL_STRUCTURE in CUDS
+    instance collection `ci`, where `sites` is an atomsites.AtomSites
+    instance and `lattice` the lattice matrix."""
+    return (atomsites.AtomSites.from_collection(ci, base),
+            get_lattice(ci, label))
+
+
+def make_supercell(sites, lattice, repeat):
+    """Returns a (sites, lattice) tuple with the `repeat` = (n, m, k)
+    supercell of atom sites `sites` in `lattice`.
+
+    The sites of the supercell are ordered with the original site index
+    varying fastest, followed by the repetitions along c, b and a."""
+    repeat = np.asarray(repeat, dtype=int).reshape(3)
+    if np.any(repeat < 1):
+        raise ValueError('supercell repetitions must be positive, got %r'
+                         % (tuple(repeat), ))
+    shifts = np.indices(repeat).reshape(3, -1).T
+    positions = (sites.positions[None, :, :] + shifts[:, None, :]) / repeat
+    ncells = len(shifts)
+    new = atomsites.AtomSites(positions.reshape(-1, 3),
+                              np.tile(sites.symbols, ncells),
+                              np.tile(sites.occupancies, ncells))
+    return new, np.asarray(lattice, dtype=float) * repeat[:, None]
+
+
+def neighbor_list(positions, lattice, cutoff, self_interaction=False):
+    """Returns the periodic neighbor list of atoms at fractional
+    coordinates `positions` within distance `cutoff`.
+
+    The result is a (i, j, distances, offsets) tuple of arrays with one
+    entry per (directed) pair, such that both (i, j) and (j, i) are
+    included.  `offsets` is a P x 3 integer array with the lattice
+    translation of atom j, i.e. the vector from atom i to its neighbor
+    is ``(positions[j] + offsets - positions[i]) @ lattice``.  An atom
+    is only its own neighbor through a nonzero lattice translation,
+    unless `self_interaction` is true."""
+    positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+    lattice = np.asarray(lattice, dtype=float)
+    cutoff = float(cutoff)
+    if cutoff <= 0:
+        raise ValueError('cutoff must be positive')
+    n = len(positions)
+
+    # Wrap into the cell, keeping track of the translations
+    wrap = np.floor(positions)
+    frac = positions - wrap
+
+    # Number of bins and search range along each lattice direction.
+    # The heights of the cell are the distances between opposite faces.
+    volume = abs(np.linalg.det(lattice))
+    cross = np.cross(lattice[[1, 2, 0]], lattice[[2, 0, 1]])
+    heights = volume / np.sqrt(np.einsum('ij,ij->i', cross, cross))
+    nbins = np.maximum(1, np.floor(heights / cutoff)).astype(int)
+    # Keep the number of bins proportional to the number of atoms
+    while np.prod(nbins) > max(1, n) and np.any(nbins > 1):
+        nbins[np.argmax(nbins)] -= 1
+    reach = np.ceil(cutoff * nbins / heights).astype(int)
+
+    bins = np.minimum((frac * nbins).astype(int), nbins - 1)
+    flat = np.ravel_multi_index(bins.T, nbins)
+    order = np.argsort(flat, kind='stable')
+    counts = np.bincount(flat, minlength=np.prod(nbins))
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    cart = np.dot(frac, lattice)
+
+    result_i, result_j, result_d, result_s = [], [], [], []
+    for delta in np.indices(2 * reach + 1).reshape(3, -1).T - reach:
+        target = bins + delta
+        shift = np.floor_divide(target, nbins)
+        tflat = np.ravel_multi_index((target - shift * nbins).T, nbins)
+        c = counts[tflat]
+        total = c.sum()
+        if not total:
+            continue
+        # Expand to all (i, j) candidate pairs without a Python loop
+        i = np.repeat(np.arange(n), c)
+        first = np.repeat(starts[tflat] - np.cumsum(c) + c, c)
+        j = order[first + np.arange(total)]
+        s = shift[i]
+        vec = cart[j] + np.dot(s, lattice) - cart[i]
+        d2 = np.einsum('ij,ij->i', vec, vec)
+        mask = d2 <= cutoff * cutoff
+        if not self_interaction:
+            mask &= (i != j) | np.any(s != 0, axis=1)
+        result_i.append(i[mask])
+        result_j.append(j[mask])
+        result_d.append(np.sqrt(d2[mask]))
+        result_s.append(s[mask])
+
+    if not result_i:
+        return (np.empty(0, dtype=int), np.empty(0, dtype=int),
+                np.empty(0), np.empty((0, 3), dtype=int))
+    i = np.concatenate(result_i)
+    j = np.concatenate(result_j)
+    offsets = (np.concatenate(result_s) + wrap[i] - wrap[j]).astype(int)
+    return i, j, np.concatenate(result_d), offsets
+
+
+def get_bonds(positions, lattice, cutoff):
+    """Like neighbor_list(), but returns each pair only once, as a
+    (i, j, distances, offsets) tuple with ``i <= j``."""
+    i, j, d, offsets = neighbor_list(positions, lattice, cutoff)
+    # Of the two directions, keep i < j, and for i == j the one with
+    # the lexicographically positive offset
+    positive = ((offsets[:, 0] > 0) |
+                ((offsets[:, 0] == 0) & (offsets[:, 1] > 0)) |
+                ((offsets[:, 0] == 0) & (offsets[:, 1] == 0) &
+                 (offsets[:, 2] > 0)))
+    keep = (i < j) | ((i == j) & positive)
+    return i[keep], j[keep], d[keep], offsets[keep]
@@ -0,0 +1,536 @@
+"""Compact binary serialization of CUDS instance collections.
+
+Unlike the YAML serialization in softcuds, where all property values
+are converted to strings, the binary format stores numeric property
+values as typed float64/int64 buffers and is therefore lossless.  All
+labels, element names, property names, relation predicates and string
+values are stored once in an interned string table, and the hierarchy
+of instances is stored as an array of parent indices.
+
+Layout
+------
+All integers are little endian and every section is padded to a
+multiple of 8 bytes, such that the buffers can be mapped directly into
+NumPy arrays::
+
+    header     magic "CUDSBIN\\0", uint32 format version, uint32 padding,
+               uint64 counts of strings, instances, relations, property
+               records, shape entries, floats, ints and string ids
+    strings    uint32 offsets[nstrings + 1], utf-8 blob
+    instances  uint32 label[n], uint32 element[n], int32 parent[n],
+               uint32 first_property[n + 1]
+    relations  uint32 subject[r], uint32 predicate[r], uint32 object[r]
+    properties uint32 name[p], uint8 type[p], uint8 ndim[p],
+               uint32 shape_start[p], uint64 start[p], uint64 count[p]
+    buffers    int64 shapes[], float64 floats[], int64 ints[],
+               uint32 string_ids[]
+
+The has-attribute relations between the instances are implied by the
+parent indices.  Other relations are stored explicitly.
+
+Requires NumPy for fast loading of large arrays, but works without it.
+"""
+import sys
+import json
+import struct
+from array import array
+from io import BytesIO
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import softcuds
+
+
+MAGIC = b'CUDSBIN\0'
+FORMAT_VERSION = 1
+
+# Property value types
+NONE, BOOL, INT, FLOAT, STR, JSON, INT_ARRAY, FLOAT_ARRAY, STR_ARRAY = range(9)
+
+# Flag added to the array types for values that were NumPy arrays
+NDARRAY = 0x80
+
+_header = struct.Struct('<8sII8Q')
+
+
+class CUDSBinaryError(Exception):
+    pass
+
+
+def _get_shape(value):
+    """Returns (shape, flat) for a rectangular nested list `value` or
+    None if `value` is not rectangular."""
+    if not isinstance(value, (list, tuple)):
+        return (), [value]
+    if not value:
+        return (0, ), []
+    sub = [_get_shape(v) for v in value]
+    if any(s is None for s in sub):
+        return None
+    shape = sub[0][0]
+    if any(s[0] != shape for s in sub):
+        return None
+    flat = []
+    for s in sub:
+        flat.extend(s[1])
+    return (len(value), ) + shape, flat
+
+
+def _encode_value(value):
+    """Returns (type, shape, flat values) for property value `value`."""
+    if value is None:
+        return NONE, (), []
+    if isinstance(value, bool):
+        return BOOL, (), [int(value)]
+    if isinstance(value, int):
+        return INT, (), [value]
+    if isinstance(value, float):
+        return FLOAT, (), [value]
+    if isinstance(value, str):
+        return STR, (), [value]
+    if np is not None and isinstance(value, np.ndarray):
+        kind = value.dtype.kind
+        shape = value.shape
+        if kind == 'f':
+            return FLOAT_ARRAY | NDARRAY, shape, value.ravel()
+        if kind in 'iub':
+            return INT_ARRAY | NDARRAY, shape, value.ravel()
+        if kind in 'US':
+            return STR_ARRAY | NDARRAY, shape, [str(v) for v in value.flat]
+        value = value.tolist()
+    if np is not None and isinstance(value, np.generic):
+        return _encode_value(value.item())
+    if isinstance(value, (list, tuple)):
+        shape_flat = _get_shape(value)
+        if shape_flat is not None:
+            shape, flat = shape_flat
+            types = set(type(v) for v in flat)
+            if types == {float}:
+                return FLOAT_ARRAY, shape, flat
+            if types == {int}:
+                return INT_ARRAY, shape, flat
+            if types == {str}:
+                return STR_ARRAY, shape, flat
+    try:
+        return JSON, (), [json.dumps(value)]
+    except TypeError:
+        raise CUDSBinaryError('cannot serialize property value of type %s'
+                              % type(value).__name__)
+
+
+class _StringTable(object):
+    """Interned string table."""
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+
+    def __call__(self, s):
+        """Returns the id of string `s`, adding it if needed."""
+        i = self.ids.get(s)
+        if i is None:
+            i = self.ids[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+
+class _Buffer(object):
+    """A growing buffer of numbers or string ids made up of chunks, which
+    may be lists or NumPy arrays."""
+    def __init__(self, typecode):
+        self.typecode = typecode
+        self.chunks = []
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def extend(self, values):
+        """Appends `values` and returns the index of the first one."""
+        start = self.length
+        self.chunks.append(values)
+        self.length += len(values)
+        return start
+
+    def tobytes(self):
+        """Returns the content as little endian bytes."""
+        return b''.join(_tobytes(self.typecode, chunk)
+                        for chunk in self.chunks)
+
+
+def _pad(buf):
+    """Returns padding bytes for aligning `buf` to 8 bytes."""
+    return b'\0' * (-len(buf) % 8)
+
+
+def _tobytes(typecode, values):
+    """Returns little endian bytes of `values` as an array of
+    `typecode`."""
+    if np is not None and isinstance(values, np.ndarray):
+        dtype = {'d': '<f8', 'q': '<i8', 'I': '<u4', 'i': '<i4',
+                 'B': 'u1', 'Q': '<u8'}[typecode]
+        return np.ascontiguousarray(values, dtype=dtype).tobytes()
+    a = array(typecode, values)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a.tobytes()
+
+
+def _get_element_name(instance):
+    """Returns the name of the CUDS element of `instance`.
+
+    Raises CUDSBinaryError if the name cannot be determined."""
+    if hasattr(instance, 'soft_get_element_name'):
+        name = instance.soft_get_element_name()
+    else:
+        meta = getattr(instance, 'soft_metadata', None)
+        name = getattr(meta, 'name', None)
+        if name is None and hasattr(instance, 'soft_get_meta_name'):
+            name = instance.soft_get_meta_name()
+    if not name:
+        raise CUDSBinaryError('cannot determine CUDS element of instance %r'
+                              % (instance, ))
+    return name
+
+
+def _get_hierarchy(ci, labels, index):
+    """Returns (parents, relations), where `parents` is a list with the
+    index of the parent of each instance (or -1) and `relations` a list
+    of all other relations in `ci`."""
+    parents = [-1] * len(labels)
+    relations = []
+
+    def add(subject, predicate, object_):
+        if (predicate == 'has-attribute' and subject in index and
+                object_ in index and parents[index[object_]] < 0):
+            parents[index[object_]] = index[subject]
+        else:
+            relations.append((subject, predicate, object_))
+
+    rindex = getattr(ci, 'relation_index', None)
+    if rindex is not None:
+        for (subject, predicate), objects in rindex.forward.items():
+            for object_ in objects:
+                add(subject, predicate, object_)
+    else:
+        for label in labels:
+            for child in softcuds.find_relations(ci, label, 'has-attribute'):
+                add(label, 'has-attribute', child)
+    return parents, relations
+
+
+def write_cuds_binary(ci, f):
+    """Writes CUDS instance collection `ci` in binary format to the binary
+    file object `f`."""
+    intern = _StringTable()
+    labels = ci.get_labels()
+    index = {label: i for i, label in enumerate(labels)}
+    parents, relations = _get_hierarchy(ci, labels, index)
+
+    # Instances and properties
+    label_ids = [intern(label) for label in labels]
+    element_ids = []
+    first_property = [0]
+    names, types, ndims, shape_starts, starts, counts = [], [], [], [], [], []
+    shapes = []
+    floats, ints, strids = _Buffer('d'), _Buffer('q'), _Buffer('I')
+    buffers = {BOOL: ints, INT: ints, INT_ARRAY: ints,
+               FLOAT: floats, FLOAT_ARRAY: floats,
+               STR: strids, STR_ARRAY: strids, JSON: strids}
+    elements = getattr(ci, 'elements', {})
+    for label in labels:
+        inst = ci.get_instance(label)
+        element = elements.get(label) or _get_element_name(inst)
+        element_ids.append(intern(element))
+        for name in inst.soft_get_property_names():
+            type_, shape, flat = _encode_value(inst.soft_get_property(name))
+            buf = buffers.get(type_ & ~NDARRAY)
+            if buf is None:
+                start = 0
+            elif buf is strids:
+                start = buf.extend([intern(v) for v in flat])
+            else:
+                start = buf.extend(flat)
+            names.append(intern(name))
+            types.append(type_)
+            ndims.append(len(shape))
+            shape_starts.append(len(shapes))
+            shapes.extend(shape)
+            starts.append(start)
+            counts.append(len(flat))
+        first_property.append(len(names))
+
+    # Relations and strings
+    rel_s = [intern(s) for s, p, o in relations]
+    rel_p = [intern(p) for s, p, o in relations]
+    rel_o = [intern(o) for s, p, o in relations]
+    blobs = [s.encode('utf-8') for s in intern.strings]
+    offsets = [0]
+    for b in blobs:
+        offsets.append(offsets[-1] + len(b))
+
+    sections = [
+        _tobytes('I', offsets),
+        b''.join(blobs),
+        _tobytes('I', label_ids),
+        _tobytes('I', element_ids),
+        _tobytes('i', parents),
+        _tobytes('I', first_property),
+        _tobytes('I', rel_s),
+        _tobytes('I', rel_p),
+        _tobytes('I', rel_o),
+        _tobytes('I', names),
+        _tobytes('B', types),
+        _tobytes('B', ndims),
+        _tobytes('I', shape_starts),
+        _tobytes('Q', starts),
+        _tobytes('Q', counts),
+        _tobytes('q', shapes),
+        floats.tobytes(),
+        ints.tobytes(),
+        strids.tobytes(),
+    ]
+    f.write(_header.pack(MAGIC, FORMAT_VERSION, 0, len(intern.strings),
+                         len(labels), len(relations), len(names),
+                         len(shapes), len(floats), len(ints), len(strids)))
+    for section in sections:
+        f.write(section)
+        f.write(_pad(section))
+
+
+def dumps(ci):
+    """Returns CUDS instance collection `ci` serialized in binary format
+    as a bytes object."""
+    f = BytesIO()
+    write_cuds_binary(ci, f)
+    return f.getvalue()
+
+
+class CUDSBinaryInstance(object):
+    """A read-only instance loaded from the binary format.
+
+    Property values are decoded on access."""
+    def __init__(self, reader, index):
+        self._reader = reader
+        self._index = index
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.soft_get_label())
+
+    def soft_get_label(self):
+        """Returns the label of this instance."""
+        return self._reader.labels[self._index]
+
+    def soft_get_element_name(self):
+        """Returns the name of the CUDS element of this instance."""
+        return self._reader.element_names[self._index]
+
+    def soft_get_property_names(self):
+        r = self._reader
+        return [r.strings[r.prop_names[i]]
+                for i in r.property_range(self._index)]
+
+    def soft_get_property(self, name):
+        r = self._reader
+        for i in r.property_range(self._index):
+            if r.strings[r.prop_names[i]] == name:
+                return r.decode_property(i)
+        raise KeyError(name)
+
+    def soft_get_properties(self):
+        """Returns a dict with all properties of this instance."""
+        r = self._reader
+        return {r.strings[r.prop_names[i]]: r.decode_property(i)
+                for i in r.property_range(self._index)}
+
+
+class CUDSBinaryCollection(object):
+    """A read-only CUDS instance collection loaded from the binary
+    format.
+
+    Supports the subset of the softpy.Collection API used by softcuds:
+    get_labels(), get_instance() and find_relations().  All relations,
+    including the has-attribute relations implied by the parent indices,
+    are held in a softcuds.RelationIndex.  Use to_collection() to build
+    a regular softpy.Collection.
+    """
+    def __init__(self, data):
+        data = memoryview(data)
+        if len(data) < _header.size:
+            raise CUDSBinaryError('truncated CUDS binary data')
+        (magic, version, _, nstrings, ninstances, nrelations, nprops,
+         nshapes, nfloats, nints, nstrids) = _header.unpack_from(data)
+        if magic != MAGIC:
+            raise CUDSBinaryError('not CUDS binary data')
+        if version != FORMAT_VERSION:
+            raise CUDSBinaryError('unsupported CUDS binary format version %d'
+                                  % version)
+        self._data = data
+        self._pos = _header.size
+
+        offsets = self._read('I', nstrings + 1)
+        blob = self._read_bytes(offsets[-1])
+        self.strings = [blob[offsets[i]:offsets[i + 1]].decode('utf-8')
+                        for i in range(nstrings)]
+        strings = self.strings
+
+        label_ids = self._read('I', ninstances)
+        element_ids = self._read('I', ninstances)
+        self.parents = self._read('i', ninstances)
+        self.first_property = self._read('I', ninstances + 1)
+        rel_s = self._read('I', nrelations)
+        rel_p = self._read('I', nrelations)
+        rel_o = self._read('I', nrelations)
+        self.prop_names = self._read('I', nprops)
+        self.prop_types = self._read('B', nprops)
+        self.prop_ndims = self._read('B', nprops)
+        self.prop_shape_starts = self._read('I', nprops)
+        self.prop_starts = self._read('Q', nprops)
+        self.prop_counts = self._read('Q', nprops)
+        self.shapes = self._read('q', nshapes)
+        self.floats = self._read('d', nfloats, asarray=True)
+        self.ints = self._read('q', nints, asarray=True)
+        self.string_ids = self._read('I', nstrids)
+
+        self.labels = [strings[i] for i in label_ids]
+        self.element_names = [strings[i] for i in element_ids]
+        self.index = {label: i for i, label in enumerate(self.labels)}
+        self.relation_index = softcuds.RelationIndex()
+        labels = self.labels
+        for i, parent in enumerate(self.parents):
+            if parent >= 0:
+                self.relation_index.add(labels[parent], 'has-attribute',
+                                        labels[i])
+        for s, p, o in zip(rel_s, rel_p, rel_o):
+            self.relation_index.add(strings[s], strings[p], strings[o])
+
+    def _read_bytes(self, n):
+        start = self._pos
+        self._pos += n + (-n % 8)
+        return self._data[start:start + n].tobytes()
+
+    def _read(self, typecode, n, asarray=False):
+        """Reads and returns an array of `n` items of type `typecode`.
+
+        If `asarray` is true and NumPy is available, a NumPy array
+        sharing memory with the data is returned.  Otherwise a list is
+        returned."""
+        a = array(typecode)
+        size = a.itemsize * n
+        start = self._pos
+        self._pos += size + (-size % 8)
+        if start + size > len(self._data):
+            raise CUDSBinaryError('truncated CUDS binary data')
+        buf = self._data[start:start + size]
+        if asarray and np is not None:
+            return np.frombuffer(buf, dtype=np.dtype(typecode).newbyteorder(
+                '<'))
+        if sys.version_info[0] < 3:
+            a.fromstring(buf.tobytes())
+        else:
+            a.frombytes(buf)
+        if sys.byteorder == 'big':
+            a.byteswap()
+        return a.tolist()
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __contains__(self, label):
+        return label in self.index
+
+    def get_labels(self):
+        return list(self.labels)
+
+    def get_instance(self, label):
+        try:
+            return CUDSBinaryInstance(self, self.index[label])
+        except KeyError:
+            raise KeyError('no instance labeled %r' % (label, ))
+
+    def find_relations(self, subject, predicate):
+        return set(self.relation_index.find(subject, predicate))
+
+    def property_range(self, index):
+        """Returns the range of property records of instance `index`."""
+        return range(self.first_property[index],
+                     self.first_property[index + 1])
+
+    def decode_property(self, i):
+        """Returns the decoded value of property record `i`."""
+        type_ = self.prop_types[i]
+        ndarray = type_ & NDARRAY
+        type_ &= ~NDARRAY
+        start = self.prop_starts[i]
+        stop = start + self.prop_counts[i]
+        if type_ == NONE:
+            return None
+        if type_ == BOOL:
+            return bool(self.ints[start])
+        if type_ == INT:
+            return int(self.ints[start])
+        if type_ == FLOAT:
+            return float(self.floats[start])
+        if type_ == STR:
+            return self.strings[self.string_ids[start]]
+        if type_ == JSON:
+            return json.loads(self.strings[self.string_ids[start]])
+        shape_start = self.prop_shape_starts[i]
+        shape = self.shapes[shape_start:shape_start + self.prop_ndims[i]]
+        if type_ == FLOAT_ARRAY:
+            flat = self.floats[start:stop]
+        elif type_ == INT_ARRAY:
+            flat = self.ints[start:stop]
+        elif type_ == STR_ARRAY:
+            flat = [self.strings[j] for j in self.string_ids[start:stop]]
+        else:
+            raise CUDSBinaryError('unknown property type %d' % type_)
+        if ndarray and np is not None:
+            return np.array(flat).reshape(shape)
+        if np is not None and isinstance(flat, np.ndarray):
+            if not shape:
+                return flat.tolist()
+            return flat.reshape(shape).tolist()
+        return _reshape(list(flat), shape)
+
+    def to_collection(self, cuds_collection, uuid=None):
+        """Returns a new softpy.Collection with all instances and
+        relations, where the instances are created from CUDS metadata
+        collection `cuds_collection`."""
+        import softpy
+        c = softpy.Collection(uuid=uuid)
+        c.relation_index = softcuds.RelationIndex()
+        for i, label in enumerate(self.labels):
+            instance = softcuds.new_cuds_instance(
+                cuds_collection, self.element_names[i], label)
+            for j in self.property_range(i):
+                instance.soft_set_property(self.strings[self.prop_names[j]],
+                                           self.decode_property(j))
+            c.add(label, instance)
+        for (subject, predicate), objects in (
+                self.relation_index.forward.items()):
+            for object_ in objects:
+                softcuds.add_relation(c, subject, predicate, object_)
+        return c
+
+
+def _reshape(flat, shape):
+    """Returns flat list `flat` reshaped to nested lists of `shape`."""
+    if len(shape) <= 1:
+        return flat
+    step = len(flat) // shape[0] if shape[0] else 0
+    return [_reshape(flat[k * step:(k + 1) * step], shape[1:])
+            for k in range(shape[0])]
+
+
+def read_cuds_binary(f):
+    """Reads a CUDS instance collection in binary format from the binary
+    file object `f` and returns it as a CUDSBinaryCollection."""
+    return CUDSBinaryCollection(f.read())
+
+
+def loads(data):
+    """Returns a CUDSBinaryCollection from bytes object `data`."""
+    return CUDSBinaryCollection(data)
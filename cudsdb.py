@@ -0,0 +1,308 @@
+"""SQLite store for CUDS entities and relations.
+
+As an alternative to the directory layout written by
+softcuds.write_cuds_entities(), with one JSON file per entity and a
+flat list of relations, this module keeps the entities and relation
+triples of one or more CUDS versions in a single SQLite file.  The
+relations are indexed on subject, predicate and object, so relation
+queries and loading a single entity are indexed lookups.
+
+Usage::
+
+    python cudsdb.py [-d DIR] DBFILE
+
+imports the entities and relations in DIR (default:
+metadata/cuds_entities) into DBFILE.
+"""
+from __future__ import print_function
+
+import os
+import re
+import sys
+import json
+import sqlite3
+import argparse
+
+import softcuds
+
+
+# Directory holding this file
+thisdir = os.path.dirname(os.path.abspath(__file__))
+
+# Bump this whenever the database schema changes
+SCHEMA_VERSION = 1
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS entities (
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    namespace TEXT NOT NULL,
+    description TEXT,
+    json TEXT NOT NULL,
+    PRIMARY KEY (name, version, namespace)
+);
+CREATE TABLE IF NOT EXISTS relations (
+    version TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    predicate TEXT NOT NULL,
+    object TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    PRIMARY KEY (version, subject, predicate, object)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS relations_object
+    ON relations (version, object, predicate);
+CREATE INDEX IF NOT EXISTS relations_predicate
+    ON relations (version, predicate);
+'''
+
+
+def version_key(version):
+    """Returns a key for sorting version strings by their numeric parts,
+    e.g. "1.9" before "1.10"."""
+    return [(0, int(part), '') if part.isdigit() else (1, 0, part)
+            for part in re.split(r'[.-]', version)]
+
+
+class CUDSDatabase(object):
+    """A SQLite store of CUDS entities and relations.
+
+    Parameters
+    ----------
+    path : string
+        Name of the SQLite file.  It is created if it does not exist.
+        Use ":memory:" for an in-memory database.
+    """
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self._latest = None
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(_schema)
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key='schema_version'").fetchone()
+        if row is None:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT INTO meta VALUES ('schema_version', ?)",
+                    (str(SCHEMA_VERSION), ))
+        elif int(row[0]) != SCHEMA_VERSION:
+            raise softcuds.CUDSError(
+                'unsupported schema version %s of CUDS database %s' % (
+                    row[0], path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Closes the database."""
+        self.conn.close()
+
+    def add_entities(self, entities):
+        """Adds the sequence of entity dicts `entities`.  Existing
+        entities with the same name, version and namespace are
+        replaced."""
+        with self.conn:
+            self._insert_entities(entities)
+
+    def add_relations(self, version, relations):
+        """Adds the sequence of (subject, predicate, object) triples
+        `relations` for CUDS version `version`.
+
+        The order of the relations is preserved in queries."""
+        self._latest = None
+        with self.conn:
+            self._insert_relations(version, relations)
+
+    def _insert_entities(self, entities):
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?)',
+            ((d['name'], d['version'], d['namespace'],
+              d.get('description'), json.dumps(d)) for d in entities))
+
+    def _insert_relations(self, version, relations):
+        start, = self.conn.execute(
+            'SELECT COUNT(*) FROM relations WHERE version=?',
+            (version, )).fetchone()
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO relations VALUES (?, ?, ?, ?, ?)',
+            ((version, s, p, o, start + i)
+             for i, (s, p, o) in enumerate(relations)))
+
+    def import_entities(self, version, entities, relations):
+        """Imports the (version, entities, relations) tuple returned by
+        softcuds.get_cuds_entities().
+
+        All entities and relations of CUDS version `version` already in
+        the database are replaced in a single transaction, such that
+        entities and relations removed from the source are removed from
+        the database as well."""
+        self._latest = None
+        with self.conn:
+            self.conn.execute('DELETE FROM entities WHERE version=?',
+                              (version, ))
+            self.conn.execute('DELETE FROM relations WHERE version=?',
+                              (version, ))
+            self._insert_entities(entities)
+            self._insert_relations(version, relations)
+
+    def import_directory(self, path=None):
+        """Imports the entities and relations written by
+        softcuds.write_cuds_entities() to directory `path`.  Defaults to
+        metadata/cuds_entities.  Returns a list of the imported
+        versions."""
+        if path is None:
+            path = os.path.join(thisdir, 'metadata', 'cuds_entities')
+        versions = []
+        for fname in sorted(os.listdir(path)):
+            if not (fname.startswith('relations-') and
+                    fname.endswith('.json')):
+                continue
+            version = fname[len('relations-'):-len('.json')]
+            with open(os.path.join(path, fname)) as f:
+                relations = json.load(f)
+            entities = []
+            dirname = os.path.join(path, version)
+            if os.path.isdir(dirname):
+                for ename in sorted(os.listdir(dirname)):
+                    if ename.endswith('.json'):
+                        with open(os.path.join(dirname, ename)) as f:
+                            entities.append(json.load(f))
+            self.import_entities(version, entities, relations)
+            versions.append(version)
+        return versions
+
+    def get_versions(self):
+        """Returns a list of the CUDS versions with relations, sorted by
+        version number, such that "1.9" comes before "1.10"."""
+        return sorted((row[0] for row in self.conn.execute(
+            'SELECT DISTINCT version FROM relations')), key=version_key)
+
+    def _default_version(self, version):
+        """Returns `version` or, if it is None, the latest CUDS version."""
+        if version is not None:
+            return version
+        if self._latest is None:
+            versions = self.get_versions()
+            if not versions:
+                raise softcuds.CUDSError('no CUDS version in database %s' %
+                                         self.path)
+            self._latest = versions[-1]
+        return self._latest
+
+    def get_entity(self, name, version=None,
+                   namespace='https://emmc.info/metadata'):
+        """Returns the dict describing entity `name`.  `version` defaults
+        to the latest CUDS version in the database."""
+        version = self._default_version(version)
+        row = self.conn.execute(
+            'SELECT json FROM entities '
+            'WHERE name=? AND version=? AND namespace=?',
+            (name, version, namespace)).fetchone()
+        if row is None:
+            raise KeyError('no entity %s/%s/%s' % (namespace, version, name))
+        return json.loads(row[0])
+
+    def get_entities(self, version=None,
+                     namespace='https://emmc.info/metadata'):
+        """Returns a list of dicts describing all entities of CUDS
+        version `version`."""
+        version = self._default_version(version)
+        return [json.loads(row[0]) for row in self.conn.execute(
+            'SELECT json FROM entities WHERE version=? AND namespace=? '
+            'ORDER BY name', (version, namespace))]
+
+    def find_relations(self, subject, predicate, version=None):
+        """Returns a list of objects of relations with `subject` and
+        `predicate`.
+
+        If `predicate` starts with "^", the subjects of relations with
+        `subject` as object are returned, like softcuds.find_relations().
+        """
+        version = self._default_version(version)
+        if predicate.startswith('^'):
+            sql = ('SELECT subject FROM relations '
+                   'WHERE version=? AND object=? AND predicate=? '
+                   'ORDER BY seq')
+            predicate = predicate[1:]
+        else:
+            sql = ('SELECT object FROM relations '
+                   'WHERE version=? AND subject=? AND predicate=? '
+                   'ORDER BY seq')
+        return [row[0] for row in self.conn.execute(
+            sql, (version, subject, predicate))]
+
+    def get_relations(self, version=None, predicate=None):
+        """Returns a list of (subject, predicate, object) triples.  If
+        `predicate` is given, only relations with this predicate are
+        returned."""
+        version = self._default_version(version)
+        if predicate is None:
+            cursor = self.conn.execute(
+                'SELECT subject, predicate, object FROM relations '
+                'WHERE version=? ORDER BY seq', (version, ))
+        else:
+            cursor = self.conn.execute(
+                'SELECT subject, predicate, object FROM relations '
+                'WHERE version=? AND predicate=? ORDER BY seq',
+                (version, predicate))
+        return [tuple(row) for row in cursor]
+
+    def get_relation_index(self, version=None):
+        """Returns a softcuds.RelationIndex with all relations of CUDS
+        version `version`."""
+        return softcuds.RelationIndex(self.get_relations(version))
+
+    def get_cuds_entities(self, version=None):
+        """Returns a (version, entities, relations) tuple like
+        softcuds.get_cuds_entities()."""
+        version = self._default_version(version)
+        return (version, self.get_entities(version),
+                [list(r) for r in self.get_relations(version)])
+
+
+def write_cuds_database(filename, include_parent=True):
+    """Writes all CUDS entities and relations to SQLite file `filename`.
+
+    If `include_parent` is true, the generated CUDS element entities
+    will also include attributes of their parent."""
+    with CUDSDatabase(filename) as db:
+        db.import_entities(*softcuds.get_cuds_entities(
+            include_parent=include_parent))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Import CUDS entities and relations into a SQLite '
+        'database.')
+    parser.add_argument('filename', metavar='DBFILE')
+    parser.add_argument(
+        '--directory', '-d', metavar='DIR',
+        help='Directory written by softcuds.write_cuds_entities().  '
+        'Default: metadata/cuds_entities.  If it does not exist, the '
+        'entities are generated from the CUDS metadata.')
+    args = parser.parse_args(argv)
+
+    path = args.directory or os.path.join(thisdir, 'metadata',
+                                          'cuds_entities')
+    with CUDSDatabase(args.filename) as db:
+        if os.path.isdir(path):
+            versions = db.import_directory(path)
+        else:
+            if args.directory:
+                parser.error('no such directory: %s' % path)
+            version, entities, relations = softcuds.get_cuds_entities()
+            db.import_entities(version, entities, relations)
+            versions = [version]
+        print('imported CUDS versions: %s' % ', '.join(versions),
+              file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
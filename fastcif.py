@@ -0,0 +1,464 @@
+"""A lightweight streaming extractor of CIF tags.
+
+Unlike PyCifRW, which parses the whole file into an abstract syntax
+tree, this module reads a CIF file line by line in a single pass and
+only keeps the values of the requested tags.  By default these are the
+tags corresponding to the properties of the cifdata entity (see
+metadata/cifdata.json), the space-group symbols and all `_atom_site_*`
+and symmetry operation loop columns.
+
+Values are returned typed.  Numbers with a standard uncertainty
+suffix, like "4.5546(2)", are returned as the number with the
+uncertainty stored separately in the `su` attribute of the block.
+The CIF null values "?" and "." are returned as None.
+
+The returned blocks are dicts with lower-case tag names as keys, so
+they can be passed directly to cifdata.populate_cifdata().
+
+Notes
+-----
+Only the CIF 1.1 syntax needed for data blocks is supported.  Save
+frames and global blocks are skipped.
+"""
+import os
+import re
+import json
+
+
+# Directory holding this file
+thisdir = os.path.dirname(__file__)
+
+# Loop columns with these prefixes are always extracted.  The symmetry
+# operations are needed for expanding the atom sites, see symmetry.py
+LOOP_PREFIXES = ('_atom_site_', '_space_group_symop_',
+                 '_symmetry_equiv_pos_')
+
+# Space-group symbol tags, in order of preference.  They are always
+# extracted, since they select the setting of the symmetry operations,
+# see symmetry.get_symops()
+SYMBOL_TAGS = ('_space_group_name_hall', '_symmetry_space_group_name_hall',
+               '_space_group_name_h-m_alt', '_symmetry_space_group_name_h-m')
+
+# Maps SOFT types to CIF value types
+type_mapping = {
+    'int32': int,
+    'int64': int,
+    'double': float,
+    'string': str,
+}
+
+# Regular expression matching a single CIF token
+_token_re = re.compile(r"""
+     '((?:[^']|'(?=\S))*)'(?=\s|$)     # single-quoted string
+   | "((?:[^"]|"(?=\S))*)"(?=\s|$)     # double-quoted string
+   | (\#.*)                            # comment
+   | (\S+)                             # bare word
+""", re.X)
+
+# Regular expression matching a number with optional standard uncertainty
+_number_re = re.compile(
+    r'^([+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)(?:\((\d+)\))?$')
+
+
+class CifBlock(dict):
+    """A CIF data block mapping lower-case tag names to values.
+
+    Attributes
+    ----------
+    name : string
+        Name of the data block (without the "data_" prefix).
+    su : dict
+        Maps tag names to standard uncertainties.  For loop columns, the
+        value is a list with None for values without uncertainty.
+    """
+    def __init__(self, name):
+        dict.__init__(self)
+        self.name = name
+        self.su = {}
+
+
+def get_cifdata_tags(path=None):
+    """Returns a dict mapping the CIF tags corresponding to the
+    properties of the cifdata entity to Python types.
+
+    `path` is the path to the entity JSON file and defaults to
+    metadata/cifdata.json."""
+    if path is None:
+        path = os.path.join(thisdir, 'metadata', 'cifdata.json')
+    with open(path) as f:
+        meta = json.load(f)
+    return {'_' + p['name'].lower(): type_mapping.get(p['type'], str)
+            for p in meta['properties']}
+
+
+def parse_value(value, type_=None):
+    """Returns a (value, su) tuple for string `value` converted to
+    `type_`.
+
+    If `type_` is None, the type is inferred from `value`.  `su` is the
+    standard uncertainty as a number or None if not given."""
+    if value in ('?', '.'):
+        return None, None
+    if type_ is str:
+        return value, None
+    m = _number_re.match(value)
+    if not m:
+        if type_ is None:
+            return value, None
+        raise ValueError('cannot convert %r to %s' % (value, type_.__name__))
+    number, su = m.groups()
+    if type_ is int or (type_ is None and not su and
+                        number.lstrip('+-').isdigit()):
+        if su:
+            return int(number), int(su)
+        return int(number), None
+    if su:
+        # The uncertainty applies to the last digits of the number
+        mantissa = number.split('e')[0].split('E')[0]
+        ndecimals = len(mantissa.split('.')[1]) if '.' in mantissa else 0
+        exponent = int(number[len(mantissa) + 1:]) if len(
+            mantissa) < len(number) else 0
+        return float(number), int(su) * 10.0**(exponent - ndecimals)
+    return float(number), None
+
+
+def tokenize(lines):
+    """Yields (token, quoted) tuples from an iterable of CIF lines.
+
+    `quoted` is true for quoted strings and text fields."""
+    lines = iter(lines)
+    for line in lines:
+        if line.startswith(';'):
+            # Semicolon-delimited text field
+            text = [line[1:].rstrip('\r\n')]
+            for line in lines:
+                if line.startswith(';'):
+                    break
+                text.append(line.rstrip('\r\n'))
+            yield '\n'.join(text).strip('\n'), True
+            rest = line[1:]
+            if rest.strip():
+                for token in tokenize([rest]):
+                    yield token
+            continue
+        for single, double, comment, bare in _token_re.findall(line):
+            if bare:
+                yield bare, False
+            elif comment:
+                break
+            else:
+                yield single or double, True
+
+
+def iter_blocks(lines, tags=None, loop_prefixes=LOOP_PREFIXES,
+                blockname=None):
+    """Yields CifBlock instances from an iterable of CIF lines.
+
+    Parameters
+    ----------
+    lines : iterable
+        Lines of CIF text, e.g. an open file.
+    tags : None | dict | sequence
+        The tags to extract.  May be a dict mapping tag names to types,
+        a sequence of tag names (types are inferred) or None, in which
+        case the tags returned by get_cifdata_tags() and SYMBOL_TAGS are
+        used.
+    loop_prefixes : sequence
+        Loop columns whose tag names start with any of these prefixes
+        are also extracted.
+    blockname : None | string | sequence
+        If given, only yield the block with this name (case insensitive)
+        or the blocks with these names, and stop reading when they have
+        been parsed.  The values of other blocks are not stored.
+    """
+    if tags is None:
+        tags = get_cifdata_tags()
+        tags.update((tag, str) for tag in SYMBOL_TAGS)
+    elif not isinstance(tags, dict):
+        tags = {tag: None for tag in tags}
+    tags = {tag.lower(): type_ for tag, type_ in tags.items()}
+    loop_prefixes = tuple(p.lower() for p in loop_prefixes)
+    if isinstance(blockname, str):
+        blockname = [blockname]
+    wanted_names = set(n.lower() for n in blockname) if blockname else None
+
+    def wanted(tag):
+        return tag in tags or tag.startswith(loop_prefixes)
+
+    block = None      # current block, None if it should be skipped
+    skip = True       # whether we are outside a wanted data block
+    tag = None        # tag waiting for a value
+    loop = None       # list of tags in the current loop header
+    columns = None    # list of value lists (or None) for loop tags
+    ncol = 0          # number of loop values read
+
+    def finish_loop():
+        """Stores the loop columns in the block."""
+        if loop and block is not None:
+            for t, col in zip(loop, columns):
+                if col is not None:
+                    type_ = tags.get(t)
+                    values, sus = [], []
+                    for v, quoted in col:
+                        value, su = ((v, None) if quoted else
+                                     parse_value(v, type_))
+                        values.append(value)
+                        sus.append(su)
+                    block[t] = values
+                    if any(su is not None for su in sus):
+                        block.su[t] = sus
+
+    for token, quoted in tokenize(lines):
+        lower = token.lower() if not quoted else None
+
+        if lower is not None and lower.startswith(
+                ('data_', 'global_', 'save_')):
+            if loop is not None:
+                finish_loop()
+                loop = None
+            if block is not None:
+                yield block
+                if wanted_names is not None:
+                    wanted_names.discard(block.name.lower())
+                    if not wanted_names:
+                        return
+            tag = None
+            if lower.startswith('data_'):
+                name = token[5:]
+                skip = bool(wanted_names is not None and
+                            name.lower() not in wanted_names)
+                block = None if skip else CifBlock(name)
+            else:
+                # Global blocks and save frames are not supported
+                skip = True
+                block = None
+            continue
+
+        if lower == 'loop_':
+            if loop is not None:
+                finish_loop()
+            loop = []
+            columns = []
+            ncol = 0
+            tag = None
+            continue
+
+        if lower is not None and token.startswith('_'):
+            if loop is not None:
+                if ncol == 0:
+                    # Still in the loop header
+                    loop.append(lower)
+                    columns.append([] if not skip and wanted(lower) else None)
+                    continue
+                finish_loop()
+                loop = None
+            tag = lower
+            continue
+
+        # Value
+        if loop is not None:
+            if loop:
+                col = columns[ncol % len(loop)]
+                if col is not None:
+                    col.append((token, quoted))
+                ncol += 1
+        elif tag is not None:
+            if not skip and wanted(tag):
+                value, su = ((token, None) if quoted else
+                             parse_value(token, tags.get(tag)))
+                block[tag] = value
+                if su is not None:
+                    block.su[tag] = su
+            tag = None
+
+    if loop is not None:
+        finish_loop()
+    if block is not None:
+        yield block
+
+
+def read_cif(filename, blockname=None, tags=None,
+             loop_prefixes=LOOP_PREFIXES):
+    """Reads CIF file `filename` and returns a list of (blockname,
+    block) tuples, where `block` is a CifBlock.
+
+    If `blockname` is given, only that data block is returned.  See
+    iter_blocks() for the other arguments.  Use iter_cif() to read
+    large files with many data blocks."""
+    blocks = list(iter_cif(filename, blockname, tags=tags,
+                           loop_prefixes=loop_prefixes))
+    if blockname and not blocks:
+        raise KeyError('no data block named %r in %s' % (blockname,
+                                                          filename))
+    return blocks
+
+
+def iter_cif(filename, blockname=None, tags=None,
+             loop_prefixes=LOOP_PREFIXES, index=None):
+    """Yields (blockname, block) tuples for the data blocks in CIF file
+    `filename` one at a time, where `block` is a CifBlock.
+
+    The file is read in a single streaming pass, so memory use is
+    bounded by the largest data block, not by the file size.
+
+    Parameters
+    ----------
+    filename : string
+        Name of the CIF file.
+    blockname : None | string | sequence
+        If given, only yield the data block(s) with this name.
+    tags, loop_prefixes
+        See iter_blocks().
+    index : None | bool | CifIndex
+        Byte-offset index of the data blocks, used together with
+        `blockname` to seek directly to the requested blocks instead of
+        scanning the file.  If true, the index is obtained with
+        get_index().  The blocks are then yielded in the order of
+        `blockname` and KeyError is raised for missing blocks.
+    """
+    if index and blockname:
+        if index is True:
+            index = get_index(filename)
+        names = [blockname] if isinstance(blockname, str) else blockname
+        with open(filename, 'rb') as f:
+            for name in names:
+                offset = index.get_offset(name)
+                f.seek(offset)
+                lines = (line.decode('utf-8', 'replace') for line in f)
+                for block in iter_blocks(lines, tags=tags,
+                                         loop_prefixes=loop_prefixes,
+                                         blockname=name):
+                    yield block.name, block
+        return
+    with open(filename) as f:
+        for block in iter_blocks(f, tags=tags, loop_prefixes=loop_prefixes,
+                                 blockname=blockname):
+            yield block.name, block
+
+
+class CifIndex(object):
+    """Byte-offset index of the data blocks in a CIF file.
+
+    Attributes
+    ----------
+    filename : string
+        Name of the indexed CIF file.
+    size, mtime : int, float
+        Size and modification time of the file when it was indexed.
+    blocks : list
+        List of (blockname, offset) tuples in file order, where `offset`
+        is the byte offset of the "data_" line.
+    """
+    def __init__(self, filename, size, mtime, blocks):
+        self.filename = filename
+        self.size = size
+        self.mtime = mtime
+        self.blocks = blocks
+        self.offsets = {}
+        for name, offset in blocks:
+            self.offsets.setdefault(name.lower(), offset)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __contains__(self, name):
+        return name.lower() in self.offsets
+
+    def get_names(self):
+        """Returns a list with the names of all data blocks."""
+        return [name for name, offset in self.blocks]
+
+    def get_offset(self, name):
+        """Returns the byte offset of data block `name`."""
+        try:
+            return self.offsets[name.lower()]
+        except KeyError:
+            raise KeyError('no data block named %r in %s' % (
+                name, self.filename))
+
+    def is_current(self):
+        """Returns whether the indexed file is unchanged."""
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return False
+        return st.st_size == self.size and st.st_mtime == self.mtime
+
+    @classmethod
+    def build(cls, filename):
+        """Scans CIF file `filename` and returns a new index of it.
+
+        Only lines are inspected, so this is much faster than parsing.
+        "data_" lines inside semicolon-delimited text fields are
+        ignored."""
+        st = os.stat(filename)
+        blocks = []
+        offset = 0
+        in_text = False
+        with open(filename, 'rb') as f:
+            for line in f:
+                if line.startswith(b';'):
+                    in_text = not in_text
+                elif not in_text:
+                    word = line.lstrip()
+                    if word[:5].lower() == b'data_':
+                        name = word.split(None, 1)[0][5:].decode('utf-8')
+                        blocks.append((name, offset))
+                offset += len(line)
+        return cls(filename, st.st_size, st.st_mtime, blocks)
+
+    def save(self, path):
+        """Saves the index as JSON to `path`."""
+        with open(path, 'w') as f:
+            json.dump(dict(filename=self.filename, size=self.size,
+                           mtime=self.mtime, blocks=self.blocks), f)
+
+    @classmethod
+    def load(cls, path):
+        """Loads an index saved with save()."""
+        with open(path) as f:
+            d = json.load(f)
+        return cls(d['filename'], d['size'], d['mtime'],
+                   [tuple(b) for b in d['blocks']])
+
+
+def get_index_path(filename):
+    """Returns the default path of the cached index of CIF file
+    `filename`.
+
+    The indices are cached in the cif-demo/blockidx directory of the
+    user cache directory ($XDG_CACHE_HOME, defaulting to ~/.cache), in
+    files named after a hash of the absolute path of the CIF file, such
+    that nothing is written next to the input files."""
+    import hashlib
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    key = hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest()
+    return os.path.join(cache_home, 'cif-demo', 'blockidx', key + '.json')
+
+
+def get_index(filename, path=None):
+    """Returns a CifIndex for CIF file `filename`.
+
+    The index is cached in `path`, which defaults to a file in the user
+    cache directory, see get_index_path().  A cached index is rebuilt if
+    the CIF file has changed.  Failure to write the cache is not an
+    error."""
+    if path is None:
+        path = get_index_path(filename)
+    try:
+        index = CifIndex.load(path)
+    except (IOError, OSError, ValueError, KeyError):
+        index = None
+    if index is not None and index.filename == filename and \
+       index.is_current():
+        return index
+    index = CifIndex.build(filename)
+    try:
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        index.save(path)
+    except (IOError, OSError):
+        pass
+    return index
@@ -0,0 +1,472 @@
+"""Opt-in timing and call count instrumentation of the CIF to CUDS
+pipeline.
+
+When enabled, the hot functions of softcuds, cifdata and fastcif (see
+TARGETS) are replaced with wrappers recording their wall time and
+number of calls in a call tree.  For functions returning generators,
+like the streaming CIF readers, the time spent producing the items is
+included as well.  The soft_set_property() method of the instance
+classes is wrapped as well.  Additional phases can be recorded with
+the phase() context manager.  When disabled, the original functions
+are restored, so there is no overhead at all.
+
+Example::
+
+    import instrument
+    with instrument.profiling() as profile:
+        ci = cifdata.cif2cuds_converter(data)
+        softcuds.serialize_cuds_instance_collection(ci)
+    profile.report()
+    with open('profile.folded', 'w') as f:
+        profile.write_folded(f)
+
+The folded output can be turned into a flame graph with e.g.
+flamegraph.pl or speedscope.
+
+Usage::
+
+    python instrument.py [-o PREFIX] CIFFILE
+
+converts CIFFILE with instrumentation enabled and prints a report.
+"""
+from __future__ import print_function
+
+import sys
+import json
+import time
+import types
+import argparse
+import threading
+import importlib
+from contextlib import contextmanager
+
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# Functions to instrument, maps module names to lists of function names.
+# Methods are given as "Class.method".
+TARGETS = {
+    'softcuds': [
+        'get_cuds_entities',
+        'get_cuds_model',
+        'generate_cuds_entities',
+        'resolve_cuds_elements',
+        'get_cuds_collection',
+        'get_cuds_instance_collection',
+        'add_cuds_instance',
+        'layout_cuds_instance',
+        'get_element_plan',
+        'new_cuds_instance',
+        'find_relations',
+        'add_relation',
+        'serialize_cuds_instance_collection',
+        'write_cuds_instance_collection',
+        '_write_yaml',
+        '_write_json',
+        'get_cuds_graph',
+        'get_cuds_dot',
+    ],
+    'cifdata': [
+        'read_cif_blocks',
+        'iter_cif_blocks',
+        'iter_cifdata',
+        'read_cifdata',
+        'populate_cifdata',
+        'new_crystal_structure',
+        'cif2cuds_converter',
+        'cif2cuds_columnar',
+        'set_attributes',
+        'get_cifdata_class',
+    ],
+    'fastcif': [
+        'read_cif',
+        'iter_cif',
+        'iter_blocks',
+        'get_index',
+    ],
+}
+
+# Instance methods to instrument on the classes of the created instances
+METHODS = ['soft_set_property']
+
+
+class Node(object):
+    """A node in the call tree.
+
+    Attributes
+    ----------
+    name : string
+        Name of the phase or function.
+    count : int
+        Number of calls.
+    time : float
+        Total wall time in seconds, including children.
+    children : dict
+        Maps names to child nodes.
+    """
+    __slots__ = ('name', 'count', 'time', 'children')
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.time = 0.0
+        self.children = {}
+
+    def child(self, name):
+        node = self.children.get(name)
+        if node is None:
+            # setdefault() is atomic, so concurrent threads get the same
+            # node
+            node = self.children.setdefault(name, Node(name))
+        return node
+
+    @property
+    def self_time(self):
+        """Wall time in seconds, excluding children."""
+        return self.time - sum(c.time for c in self.children.values())
+
+    def todict(self):
+        return dict(name=self.name, count=self.count, time=self.time,
+                    children=[c.todict() for c in self.children.values()])
+
+
+class Profile(object):
+    """Recorded timings and call counts.
+
+    The current position in the call tree is kept per thread, such
+    that calls in worker threads, like the executor threads of
+    cifpipeline, are recorded below the root instead of below whatever
+    another thread is doing.
+
+    Attributes
+    ----------
+    root : Node
+        Root of the call tree.
+    counters : dict
+        Maps names to counts recorded with count().
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Discards all recordings."""
+        self.root = Node('all')
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.counters = {}
+        self._start = timer()
+
+    @property
+    def current(self):
+        """The current node of the calling thread."""
+        return getattr(self._local, 'node', self.root)
+
+    @current.setter
+    def current(self, node):
+        self._local.node = node
+
+    def call(self, name, func, args=(), kw={}):
+        """Calls `func` with positional arguments `args` and keyword
+        arguments `kw` and records it as `name` in the call tree."""
+        parent = self.current
+        node = self.current = parent.child(name)
+        t = timer()
+        try:
+            return func(*args, **kw)
+        finally:
+            node.time += timer() - t
+            node.count += 1
+            self.current = parent
+
+    def iterate(self, name, iterator):
+        """Yields the items of `iterator`, adding the time spent producing
+        them to node `name` below the current node, without counting a
+        call."""
+        node = self.current.child(name)
+        while True:
+            outer = self.current
+            self.current = node
+            t = timer()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                node.time += timer() - t
+                self.current = outer
+            yield item
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager recording its body as `name` in the call
+        tree."""
+        parent = self.current
+        node = self.current = parent.child(name)
+        t = timer()
+        try:
+            yield node
+        finally:
+            node.time += timer() - t
+            node.count += 1
+            self.current = parent
+
+    def count(self, name, n=1):
+        """Adds `n` to counter `name`."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def iter_nodes(self):
+        """Yields (path, node) tuples for all nodes in the call tree,
+        except the root, where `path` is a tuple of names."""
+        stack = [((), self.root)]
+        while stack:
+            path, node = stack.pop()
+            if path:
+                yield path, node
+            for child in node.children.values():
+                stack.append((path + (child.name, ), child))
+
+    def get_totals(self):
+        """Returns a dict mapping names to dicts with the total number of
+        calls, the total time and the self time for each name in the
+        call tree.
+
+        Recursive calls are only included once in the total time."""
+        totals = {}
+        for path, node in self.iter_nodes():
+            d = totals.get(node.name)
+            if d is None:
+                d = totals[node.name] = dict(count=0, time=0.0,
+                                             self_time=0.0)
+            d['count'] += node.count
+            d['self_time'] += node.self_time
+            if node.name not in path[:-1]:
+                d['time'] += node.time
+        return totals
+
+    def todict(self):
+        """Returns the recordings as a dict that can be serialised as
+        JSON."""
+        self.root.time = timer() - self._start
+        return dict(totals=self.get_totals(), counters=dict(self.counters),
+                    tree=self.root.todict())
+
+    def write_json(self, f, indent=2):
+        """Writes the recordings as JSON to file object `f`."""
+        json.dump(self.todict(), f, indent=indent, sort_keys=True)
+
+    def write_folded(self, f):
+        """Writes the call tree to file object `f` in the folded stack
+        format used by flame graph tools.  Each line holds the
+        semicolon-separated path and the self time in microseconds."""
+        for path, node in sorted(self.iter_nodes()):
+            us = int(round(node.self_time * 1e6))
+            if us > 0:
+                f.write('%s %d\n' % (';'.join(path), us))
+
+    def report(self, f=None, limit=30):
+        """Writes a table of the `limit` names with the largest total
+        times and all counters to file object `f` (default stdout)."""
+        if f is None:
+            f = sys.stdout
+        totals = self.get_totals()
+        f.write('%-44s %10s %12s %12s\n' % ('name', 'calls', 'time [s]',
+                                              'self [s]'))
+        for name, d in sorted(totals.items(), key=lambda kv: -kv[1]['time'])[
+                :limit]:
+            f.write('%-44s %10d %12.6f %12.6f\n' % (
+                name, d['count'], d['time'], d['self_time']))
+        for name, n in sorted(self.counters.items()):
+            f.write('%-44s %10d\n' % (name, n))
+
+
+# The active profile, None when disabled
+profile = None
+
+# List of (object, attribute name, original value or None) for the
+# patched attributes, where None means that the attribute was inherited
+_patched = []
+
+# Classes whose methods have been patched
+_patched_classes = set()
+
+
+def is_enabled():
+    """Returns whether instrumentation is enabled."""
+    return profile is not None
+
+
+def _patch(obj, attr, value):
+    """Sets attribute `attr` of `obj` to `value` and records the original
+    value for disable()."""
+    _patched.append((obj, attr, obj.__dict__.get(attr)))
+    setattr(obj, attr, value)
+
+
+def _wrap_function(name, func, post=None):
+    """Returns a wrapper of `func` recording its calls as `name`.  If
+    given, `post` is called with the return value.
+
+    Returned generators are wrapped such that the time spent in them is
+    recorded as well."""
+    def wrapper(*args, **kw):
+        if profile is None:
+            return func(*args, **kw)
+        result = profile.call(name, func, args, kw)
+        if isinstance(result, types.GeneratorType):
+            result = profile.iterate(name, result)
+        if post is not None:
+            post(result)
+        return result
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    wrapper.__wrapped__ = func
+    return wrapper
+
+
+def instrument_class(cls):
+    """Wraps the methods listed in METHODS of class `cls`."""
+    if cls in _patched_classes or profile is None:
+        return
+    _patched_classes.add(cls)
+    for attr in METHODS:
+        method = getattr(cls, attr, None)
+        if method is not None:
+            _patch(cls, attr, _wrap_function(attr, method))
+
+
+def _instrument_instance_class(instance):
+    """Post hook wrapping the methods of the class of `instance`."""
+    if instance is not None:
+        instrument_class(type(instance))
+
+
+# Maps names in TARGETS to functions called with the return values
+POST_HOOKS = {
+    'softcuds.new_cuds_instance': _instrument_instance_class,
+    'cifdata.get_cifdata_class': instrument_class,
+}
+
+
+def enable(modules=None):
+    """Enables instrumentation and returns the new Profile.
+
+    `modules` is a list of names of modules in TARGETS to instrument.
+    Default is all of them that can be imported."""
+    global profile
+    if profile is not None:
+        disable()
+    profile = Profile()
+    for modname, names in TARGETS.items():
+        if modules is not None and modname not in modules:
+            continue
+        try:
+            module = importlib.import_module(modname)
+        except ImportError:
+            if modules is not None:
+                raise
+            continue
+        for name in names:
+            obj = module
+            attrs = name.split('.')
+            for attr in attrs[:-1]:
+                obj = getattr(obj, attr)
+            func = getattr(obj, attrs[-1], None)
+            if func is None:
+                continue
+            fullname = '%s.%s' % (modname, name)
+            _patch(obj, attrs[-1], _wrap_function(
+                fullname, func, POST_HOOKS.get(fullname)))
+    return profile
+
+
+def disable():
+    """Disables instrumentation, restores the original functions and
+    returns the Profile with the recordings."""
+    global profile
+    p = profile
+    profile = None
+    while _patched:
+        obj, attr, orig = _patched.pop()
+        if orig is None:
+            delattr(obj, attr)
+        else:
+            setattr(obj, attr, orig)
+    _patched_classes.clear()
+    return p
+
+
+@contextmanager
+def profiling(modules=None):
+    """Context manager enabling instrumentation within its body.  Yields
+    the Profile."""
+    p = enable(modules)
+    try:
+        yield p
+    finally:
+        disable()
+
+
+class _NullContext(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+_null_context = _NullContext()
+
+
+def phase(name):
+    """Returns a context manager recording its body as phase `name` if
+    instrumentation is enabled.  Otherwise it does nothing."""
+    if profile is None:
+        return _null_context
+    return profile.phase(name)
+
+
+def count(name, n=1):
+    """Adds `n` to counter `name` if instrumentation is enabled."""
+    if profile is not None:
+        profile.count(name, n)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Convert a CIF file with instrumentation enabled and '
+        'report where the time is spent.')
+    parser.add_argument('filename', metavar='CIFFILE')
+    parser.add_argument(
+        '--block', '-b', metavar='NAME',
+        help='Only convert the data block with this name.')
+    parser.add_argument(
+        '--parser', choices=['pycifrw', 'fast'], default='pycifrw',
+        help='CIF parser to use.  Default: "pycifrw".')
+    parser.add_argument(
+        '--output', '-o', metavar='PREFIX',
+        help='Write the recordings to PREFIX.json and the folded stacks '
+        'to PREFIX.folded.')
+    args = parser.parse_args(argv)
+
+    import cifdata
+    import softcuds
+    with profiling() as p:
+        with phase('convert'):
+            cuds_collection = softcuds.get_cuds_collection()
+            for block, data in cifdata.read_cifdata(
+                    args.filename, args.block, args.parser):
+                ci = cifdata.cif2cuds_converter(data, cuds_collection)
+                softcuds.serialize_cuds_instance_collection(ci)
+    p.report()
+    if args.output:
+        with open(args.output + '.json', 'w') as f:
+            p.write_json(f)
+        with open(args.output + '.folded', 'w') as f:
+            p.write_folded(f)
+
+
+if __name__ == '__main__':
+    # Run main() of the imported module, whose phase() and count() are
+    # the ones called by cifdata and softcuds
+    import instrument
+    instrument.main()
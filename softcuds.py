@@ -1,5 +1,10 @@
 """A Python module for working with CUDS metadata as entities and
 relations.
+
+The optional dependencies softpy, PyYAML and pydot, as well as the
+modules only needed for the metadata cache, are imported by the
+functions that need them, so importing this module is cheap and does
+no I/O.
 """
 from __future__ import print_function
 
@@ -10,20 +15,501 @@ import ast
 import re
 from io import StringIO, BytesIO
 
-import yaml
-
 
 # Directory holding this file
 thisdir = os.path.dirname(__file__)
 
+# Default directory for the compiled metadata cache
+cachedir = os.path.join(thisdir, 'metadata', 'cache')
+
+# Bump this whenever the layout of the cached data or the output of
+# generate_cuds_entities() changes
+CACHE_FORMAT = 2
+
+# Process-wide memo of cache keys, models and metadata collections.
+# Maps the arguments to (stamp, value) tuples, where `stamp` is the
+# value of _get_metadata_stamp() when `value` was computed.
+_memo = {}
+
 
 class CUDSError(Exception):
     pass
 
 
+class RelationIndex(object):
+    """Forward and reverse adjacency index over (subject, predicate,
+    object) relations.
+
+    Lookups follow the conventions of Collection.find_relations(),
+    i.e. a predicate prefixed with "^" queries the reverse relation.
+    Objects are returned in insertion order.
+    """
+    def __init__(self, relations=()):
+        self.forward = {}  # maps (subject, predicate) to {object: None}
+        self.reverse = {}  # maps (object, predicate) to {subject: None}
+        for relation in relations:
+            self.add(*relation)
+
+    def __len__(self):
+        return sum(len(v) for v in self.forward.values())
+
+    def add(self, subject, predicate, object_):
+        """Adds relation (`subject`, `predicate`, `object_`)."""
+        self.forward.setdefault((subject, predicate), {})[object_] = None
+        self.reverse.setdefault((object_, predicate), {})[subject] = None
+
+    def find(self, subject, predicate):
+        """Returns a list with all objects related to `subject` via
+        `predicate`.  If `predicate` starts with "^", the subjects
+        related to `subject` via the reverse predicate are returned."""
+        if predicate.startswith('^'):
+            return list(self.reverse.get((subject, predicate[1:]), ()))
+        return list(self.forward.get((subject, predicate), ()))
+
+
+def find_relations(collection, subject, predicate):
+    """Returns a list of the objects related to `subject` via
+    `predicate` in `collection`.
+
+    The RelationIndex attached to collections created by this module
+    is used when available, otherwise this falls back to
+    `collection.find_relations()`.
+    """
+    index = getattr(collection, 'relation_index', None)
+    if index is not None:
+        return index.find(subject, predicate)
+    return list(collection.find_relations(subject, predicate))
+
+
+def parse_label(label):
+    """Returns instance label `label` parsed into a path tuple of
+    (name, index) pairs, where `index` is None for scalar attributes.
+
+    E.g. "CELL.POINT[3].X" is parsed into
+    ``(('CELL', None), ('POINT', 3), ('X', None))``.  Multidimensional
+    indices, like "[1, 2]", are returned as tuples."""
+    return tuple(_parse_label_part(part) for part in label.split('.'))
+
+
+def _parse_label_part(part):
+    """Returns a (name, index) pair for a dot-separated part of a
+    label."""
+    if not part.endswith(']'):
+        return (part, None)
+    name, _, index = part[:-1].partition('[')
+    if ',' in index:
+        return (name, tuple(int(i) for i in index.split(',')))
+    return (name, int(index))
+
+
+def format_label(path):
+    """Returns the instance label of path tuple `path`.  This is the
+    inverse of parse_label()."""
+    parts = []
+    for name, index in path:
+        if index is None:
+            parts.append(name)
+        elif isinstance(index, tuple):
+            parts.append('%s%r' % (name, list(index)))
+        else:
+            parts.append('%s[%d]' % (name, index))
+    return '.'.join(parts)
+
+
+class LabelNode(object):
+    """Node in a LabelTrie.
+
+    `label` is the instance label of the node or None if the node only
+    is an intermediate path component.  `children` maps attribute names
+    to dicts mapping indices (None for scalar attributes) to nodes."""
+    __slots__ = ('key', 'label', 'parent', 'children')
+
+    def __init__(self, key=None, parent=None):
+        self.key = key
+        self.label = None
+        self.parent = parent
+        self.children = {}
+
+    def iter_nodes(self):
+        """Yields all nodes below this node in depth-first order."""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node is not self:
+                yield node
+            for items in reversed(list(node.children.values())):
+                stack.extend(items[i] for i in sorted(
+                    items, key=_index_key, reverse=True))
+
+
+def _index_key(index):
+    # Sort key placing scalar attributes (index None) first
+    return (-1, ) if index is None else (
+        index if isinstance(index, tuple) else (index, ))
+
+
+class LabelTrie(object):
+    """Prefix trie of instance labels parsed with parse_label().
+
+    Finding a label, its parent, its children or the indices of an array
+    attribute only depends on the depth of the label, and the
+    descendants of a label are found without scanning other labels.
+    """
+    def __init__(self, labels=()):
+        self.root = LabelNode()
+        self.nodes = {}  # maps labels to nodes
+        for label in labels:
+            self.add(label)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, label):
+        return label in self.nodes
+
+    def add(self, label):
+        """Adds instance label `label` and returns its node."""
+        node = self.nodes.get(label)
+        if node is not None:
+            return node
+        node = self.root
+        for key in parse_label(label):
+            name, index = key
+            items = node.children.get(name)
+            if items is None:
+                items = node.children[name] = {}
+            child = items.get(index)
+            if child is None:
+                child = items[index] = LabelNode(key, node)
+            node = child
+        node.label = label
+        self.nodes[label] = node
+        return node
+
+    def find(self, label):
+        """Returns the node of `label` or None if it is not indexed."""
+        return self.nodes.get(label)
+
+    def _get_node(self, label):
+        node = self.nodes.get(label)
+        if node is None:
+            raise KeyError('no such label: %r' % (label, ))
+        return node
+
+    def get_parent(self, label):
+        """Returns the label of the closest ancestor of `label` or None
+        if it has none."""
+        node = self._get_node(label).parent
+        while node is not None and node.label is None:
+            node = node.parent
+        return None if node is None else node.label
+
+    def get_children(self, label):
+        """Returns a list with the labels of the attributes of `label`.
+        Array attributes are sorted by index."""
+        return [node.label for node in self._iter_children(
+            self._get_node(label)) if node.label is not None]
+
+    def _iter_children(self, node):
+        for items in node.children.values():
+            for index in sorted(items, key=_index_key):
+                yield items[index]
+
+    def iter_descendants(self, label):
+        """Yields the labels of all (nested) attributes of `label` in
+        depth-first order."""
+        for node in self._get_node(label).iter_nodes():
+            if node.label is not None:
+                yield node.label
+
+    def get_indices(self, label, attr):
+        """Returns a sorted list with the indices of array attribute
+        `attr` of `label`."""
+        items = self._get_node(label).children.get(attr, {})
+        return sorted((i for i in items if i is not None), key=_index_key)
+
+    def get_array(self, label, attr):
+        """Returns a list with the labels of array attribute `attr` of
+        `label`, sorted by index."""
+        items = self._get_node(label).children.get(attr, {})
+        return [items[i].label for i in sorted(
+            (i for i in items if i is not None), key=_index_key)]
+
+
+def get_label_index(collection):
+    """Returns the LabelTrie of instance collection `collection`.
+
+    The trie is built from the labels of the collection on the first
+    call and attached as its `label_index` attribute.  Labels added
+    afterwards with the functions in this module are added to the trie
+    as well."""
+    index = getattr(collection, 'label_index', None)
+    if index is None:
+        index = LabelTrie(collection.get_labels())
+        try:
+            collection.label_index = index
+        except AttributeError:
+            pass
+    return index
+
+
+def find_parent(collection, label):
+    """Returns the label of the instance in `collection` that `label` is
+    an attribute of, or None."""
+    return get_label_index(collection).get_parent(label)
+
+
+def find_children(collection, label):
+    """Returns a list with the labels of the attributes of `label` in
+    `collection`."""
+    return get_label_index(collection).get_children(label)
+
+
+def find_descendants(collection, label):
+    """Returns a list with the labels of all (nested) attributes of
+    `label` in `collection`, in depth-first order."""
+    return list(get_label_index(collection).iter_descendants(label))
+
+
+def find_indices(collection, label, attr):
+    """Returns a sorted list with the indices of array attribute `attr`
+    of `label` in `collection`."""
+    return get_label_index(collection).get_indices(label, attr)
+
+
+# intern() is a builtin in Python 2
+_intern_str = sys.intern if sys.version_info.major >= 3 else intern
+
+
+def _intern(value):
+    """Returns `value` interned if it is a string."""
+    if isinstance(value, str):
+        return _intern_str(value)
+    return value
+
+
+class Dimension(object):
+    """Compact record of an entity dimension."""
+    __slots__ = ('name', 'description')
+
+    def __init__(self, name, description):
+        self.name = _intern(name)
+        self.description = _intern(description)
+
+    def __eq__(self, other):
+        return (isinstance(other, Dimension) and
+                self.name == other.name and
+                self.description == other.description)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Dimension(%r)' % self.name
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['name'], d.get('description'))
+
+    def to_dict(self):
+        return dict(name=self.name, description=self.description)
+
+
+class Property(object):
+    """Compact record of an entity property.
+
+    `dims` and `unit` are None if the property has no such key."""
+    __slots__ = ('name', 'type', 'unit', 'dims', 'description')
+
+    # Keys of the dict representation, in order
+    keys = ('name', 'type', 'unit', 'dims', 'description')
+
+    def __init__(self, name, type, description, dims=None, unit=None):
+        self.name = _intern(name)
+        self.type = _intern(type)
+        self.unit = _intern(unit)
+        self.dims = None if dims is None else tuple(_intern(d) for d in dims)
+        self.description = _intern(description)
+
+    def __eq__(self, other):
+        return (isinstance(other, Property) and
+                all(getattr(self, k) == getattr(other, k)
+                    for k in self.__slots__))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Property(%r)' % self.name
+
+    @classmethod
+    def from_dict(cls, d):
+        unknown = set(d).difference(cls.keys)
+        if unknown:
+            raise CUDSError('unsupported keys in property %r: %s' % (
+                d.get('name'), ', '.join(sorted(unknown))))
+        return cls(d['name'], d['type'], d.get('description'),
+                   d.get('dims'), d.get('unit'))
+
+    def to_dict(self):
+        d = dict(name=self.name, type=self.type)
+        if self.unit is not None:
+            d['unit'] = self.unit
+        if self.dims is not None:
+            d['dims'] = list(self.dims)
+        d['description'] = self.description
+        return d
+
+
+class Entity(object):
+    """Compact record of an entity description."""
+    __slots__ = ('name', 'version', 'namespace', 'description',
+                 'dimensions', 'properties')
+
+    # Keys of the dict representation, in order
+    keys = ('name', 'version', 'namespace', 'description', 'dimensions',
+            'properties')
+
+    def __init__(self, name, version, namespace, description,
+                 dimensions=(), properties=()):
+        self.name = _intern(name)
+        self.version = _intern(version)
+        self.namespace = _intern(namespace)
+        self.description = _intern(description)
+        self.dimensions = tuple(dimensions)
+        self.properties = tuple(properties)
+
+    def __eq__(self, other):
+        return (isinstance(other, Entity) and
+                all(getattr(self, k) == getattr(other, k)
+                    for k in self.__slots__))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Entity(%r, %r, %r)' % (self.name, self.version,
+                                       self.namespace)
+
+    @property
+    def key(self):
+        """The (name, version, namespace) tuple identifying this
+        entity."""
+        return (self.name, self.version, self.namespace)
+
+    @classmethod
+    def from_dict(cls, d):
+        unknown = set(d).difference(cls.keys)
+        if unknown:
+            raise CUDSError('unsupported keys in entity %r: %s' % (
+                d.get('name'), ', '.join(sorted(unknown))))
+        return cls(d['name'], d['version'], d['namespace'],
+                   d.get('description'),
+                   [Dimension.from_dict(x) for x in d.get('dimensions', ())],
+                   [Property.from_dict(x) for x in d.get('properties', ())])
+
+    def to_dict(self):
+        return dict(
+            name=self.name,
+            version=self.version,
+            namespace=self.namespace,
+            description=self.description,
+            dimensions=[x.to_dict() for x in self.dimensions],
+            properties=[x.to_dict() for x in self.properties],
+        )
+
+
+class RelationTable(object):
+    """Compact sequence of (subject, predicate, object) relations.
+
+    Subjects and objects are interned and predicates are stored as
+    integer codes into the `predicates` list.  Iterating yields the
+    relations as tuples in insertion order."""
+    __slots__ = ('predicates', '_codes', 'subjects', 'codes', 'objects')
+
+    def __init__(self, relations=()):
+        from array import array
+        self.predicates = []
+        self._codes = {}
+        self.subjects = []
+        self.codes = array('H')
+        self.objects = []
+        for relation in relations:
+            self.add(*relation)
+
+    def __getstate__(self):
+        return (self.predicates, self.subjects, self.codes, self.objects)
+
+    def __setstate__(self, state):
+        self.predicates, self.subjects, self.codes, self.objects = state
+        self._codes = {p: i for i, p in enumerate(self.predicates)}
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def __iter__(self):
+        predicates = self.predicates
+        for s, c, o in zip(self.subjects, self.codes, self.objects):
+            yield (s, predicates[c], o)
+
+    def get_code(self, predicate):
+        """Returns the integer code of `predicate`, adding it if it is
+        new."""
+        code = self._codes.get(predicate)
+        if code is None:
+            code = self._codes[predicate] = len(self.predicates)
+            self.predicates.append(_intern(predicate))
+        return code
+
+    def add(self, subject, predicate, object_):
+        """Adds relation (`subject`, `predicate`, `object_`)."""
+        self.codes.append(self.get_code(predicate))
+        self.subjects.append(_intern(subject))
+        self.objects.append(_intern(object_))
+
+
+class CUDSModel(object):
+    """Compact representation of the CUDS entities and relations
+    returned by generate_cuds_entities().
+
+    Attributes
+    ----------
+    version : string
+        CUDS version.
+    entities : tuple
+        Entity records.
+    relations : RelationTable
+        The relations.
+    """
+    __slots__ = ('version', 'entities', 'relations')
+
+    def __init__(self, version, entities, relations):
+        self.version = _intern(version)
+        self.entities = tuple(entities)
+        self.relations = relations
+
+    def __repr__(self):
+        return '<%s %s: %d entities, %d relations>' % (
+            self.__class__.__name__, self.version, len(self.entities),
+            len(self.relations))
+
+    @classmethod
+    def from_dicts(cls, version, entities, relations):
+        """Returns a new CUDSModel from entity dicts and relation
+        tuples."""
+        return cls(version, [Entity.from_dict(d) for d in entities],
+                   RelationTable(relations))
+
+    def to_dicts(self):
+        """Returns a (version, entities, relations) tuple with the
+        entities as dicts and the relations as tuples, like
+        get_cuds_entities()."""
+        return (self.version, [e.to_dict() for e in self.entities],
+                list(self.relations))
+
 
 def generate_cuds_entities(cuds, cuba, namespace='https://emmc.info/metadata',
-                           include_parent=True):
+                           include_parent=True, keys=None):
     """Convert `cuds` and `cuba` to entities and relations.
 
     Parameters
@@ -39,6 +525,9 @@ def generate_cuds_entities(cuds, cuba, namespace='https://emmc.info/metadata',
     include_parent : bool
         Whether to include the attributes of the parents in the generated
         entities.
+    keys : None | sequence
+        If given, only generate the entities and relations of these CUDS
+        keys.
 
     Returns
     -------
@@ -64,9 +553,14 @@ def generate_cuds_entities(cuds, cuba, namespace='https://emmc.info/metadata',
 
     relations = []
     entities = []
+    resolved = resolve_cuds_elements(cuds, include_parent)
+    if keys is not None:
+        keys = set(keys)
 
     for key in cuds['CUDS_KEYS'].keys():
-        d = get_element_dict(cuds, key, include_parent)
+        if keys is not None and key not in keys:
+            continue
+        d = resolved[key].copy()
         dim_descr = {}  # maps dimension names to descriptions
         properties = []
         description = d.pop('definition')
@@ -159,22 +653,69 @@ def generate_cuds_entities(cuds, cuba, namespace='https://emmc.info/metadata',
     return entities, relations
 
 
+def resolve_cuds_elements(cuds, include_parent=True):
+    """Returns a dict mapping all CUDS keys to their element dicts.
+
+    If `include_parent` is true, the attributes of parent elements are
+    also included, with attributes defined closer to the element taking
+    precedence.  The elements are resolved in topological order from
+    the root downwards, such that the inherited attributes of each
+    element are only flattened once.
+
+    A CUDSError is raised if a parent does not exist or if the parent
+    chain contains a cycle.
+    """
+    cudsdict = cuds['CUDS_KEYS']
+    resolved = {}
+    for key in cudsdict:
+        _resolve_cuds_element(cudsdict, key, resolved, include_parent)
+    return resolved
+
+
+def _resolve_cuds_element(cudsdict, key, resolved, include_parent):
+    """Resolves CUDS element `key` and its parents that are not already
+    in the dict `resolved`, and adds them to it.  See
+    resolve_cuds_elements()."""
+    # Walk up the parent chain until we hit the root or an already
+    # resolved element
+    chain = []
+    k = key
+    while k is not None and k not in resolved:
+        if k not in cudsdict:
+            raise CUDSError('Parent %r of CUDS element %r is not defined'
+                            % (k, chain[-1]))
+        if k in chain:
+            raise CUDSError('Cyclic parent chain for CUDS element %r: %s'
+                            % (k, ' -> '.join(chain[chain.index(k):] +
+                                              [k])))
+        chain.append(k)
+        parent = cudsdict[k].get('parent')
+        k = stripname(parent) if parent else None
+
+    # Resolve the chain from the top and down
+    for k in reversed(chain):
+        element_dict = cudsdict[k].copy()
+        parent = element_dict.setdefault('parent', None)
+        if include_parent and parent:
+            for attr, v in resolved[stripname(parent)].items():
+                if attr != 'parent':
+                    element_dict.setdefault(attr, v)
+        resolved[k] = element_dict
+
+
 def get_element_dict(cuds, key, include_parent):
     """Returns a dict with the content of the CUDS element `key`.  If
     `include_parent` is true, the attributes of parent elements will
-    also be included."""
+    also be included.
+
+    Only `key` and its parents are resolved.  Use
+    resolve_cuds_elements() when resolving all elements."""
     cudsdict = cuds['CUDS_KEYS']
-    element_dict = cudsdict[key].copy()
-    parentname = element_dict['parent']
-    if include_parent:
-        parent = element_dict.pop('parent')
-        while parent:
-            parentdict = cudsdict[stripname(parent)]
-            for k, v in parentdict.items():
-                element_dict.setdefault(k, v)
-            parent = element_dict.pop('parent')
-    element_dict['parent'] = parentname
-    return element_dict
+    if key not in cudsdict:
+        raise KeyError(key)
+    resolved = {}
+    _resolve_cuds_element(cudsdict, key, resolved, include_parent)
+    return resolved[key]
 
 
 def stripname(name):
@@ -247,7 +788,256 @@ def get_dims(key, shape, from_cuba=False):
     return dims, dim_descr
 
 
-def write_cuds_entities(path, include_parent=True):
+def get_metadata_paths():
+    """Returns a (cuba_path, cuds_path) tuple with the paths to the CUBA
+    and CUDS metadata YAML files."""
+    return (os.path.join(thisdir, 'metadata', 'cuba.yml'),
+            os.path.join(thisdir, 'metadata', 'simphony_metadata.yml'))
+
+
+def load_cuds_metadata():
+    """Reads and returns the CUBA and CUDS definitions as a (cuds, cuba)
+    tuple of dicts."""
+    import yaml
+    Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    cuba_path, cuds_path = get_metadata_paths()
+    with open(cuba_path) as f:
+        cuba = yaml.load(f.read(), Loader=Loader)
+    with open(cuds_path) as f:
+        cuds = yaml.load(f.read(), Loader=Loader)
+    return cuds, cuba
+
+
+def _get_metadata_stamp():
+    """Returns a tuple with the modification times and sizes of the
+    metadata YAML files, which changes when they are modified."""
+    stamp = []
+    for path in get_metadata_paths():
+        st = os.stat(path)
+        stamp.append((st.st_mtime, st.st_size))
+    return tuple(stamp)
+
+
+def _memoize(key, compute):
+    """Returns the value memoized under `key` in _memo if the metadata
+    files are unchanged since, otherwise the value returned by calling
+    `compute`, which is memoized."""
+    stamp = _get_metadata_stamp()
+    cached = _memo.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    value = compute()
+    _memo[key] = (stamp, value)
+    return value
+
+
+def get_cache_key(include_parent=True,
+                  namespace='https://emmc.info/metadata'):
+    """Returns a hex digest identifying the current content of the
+    metadata YAML files together with the arguments passed to
+    generate_cuds_entities().
+
+    The digest is memoized until the files are modified."""
+    return _memoize(('cache_key', bool(include_parent), namespace),
+                    lambda: _get_cache_key(include_parent, namespace))
+
+
+def _get_cache_key(include_parent, namespace):
+    import hashlib
+    h = hashlib.sha256()
+    h.update(('%d:%s:%s:' % (CACHE_FORMAT, bool(include_parent),
+                             namespace)).encode('utf-8'))
+    for path in get_metadata_paths():
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def generate_cuds_model(cuds, cuba, namespace='https://emmc.info/metadata',
+                        include_parent=True):
+    """Like generate_cuds_entities(), but returns a CUDSModel."""
+    entities, relations = generate_cuds_entities(
+        cuds, cuba, namespace=namespace, include_parent=include_parent)
+    return CUDSModel.from_dicts(cuds['VERSION'], entities, relations)
+
+
+def read_cached_cuds_model(include_parent=True,
+                           namespace='https://emmc.info/metadata',
+                           cache_dir=None):
+    """Returns the CUDSModel stored by get_cuds_model() in `cache_dir`
+    for the current metadata, or None if it is not cached."""
+    import pickle
+    if cache_dir is None:
+        cache_dir = cachedir
+    key = get_cache_key(include_parent, namespace)
+    fname = os.path.join(cache_dir, 'cuds-%s.pickle' % key)
+    try:
+        with open(fname, 'rb') as f:
+            model = pickle.load(f)
+        if isinstance(model, CUDSModel):
+            return model
+    except (IOError, OSError, EOFError, ValueError, AttributeError,
+            pickle.UnpicklingError):
+        pass
+    return None
+
+
+def get_cuds_model(include_parent=True,
+                   namespace='https://emmc.info/metadata',
+                   use_cache=True, cache_dir=None):
+    """Returns a CUDSModel for the bundled CUDS and CUBA metadata.
+
+    The model is stored in a compiled cache in `cache_dir` (defaults to
+    `metadata/cache`).  The cache is keyed by a content hash of both
+    YAML files, `include_parent` and `namespace`, so it is
+    automatically invalidated when the metadata changes.  If
+    `use_cache` is false, the YAML files are always parsed.
+
+    Failure to write the cache (e.g. a read-only installation) is not
+    an error, the metadata is then just regenerated next time.
+
+    With `use_cache`, the model is also memoized in the process until
+    the YAML files are modified, so repeated calls neither read nor
+    hash them.
+    """
+    if use_cache:
+        return _memoize(
+            ('model', bool(include_parent), namespace, cache_dir),
+            lambda: _get_cuds_model(include_parent, namespace, cache_dir))
+    cuds, cuba = load_cuds_metadata()
+    return generate_cuds_model(cuds, cuba, namespace=namespace,
+                               include_parent=include_parent)
+
+
+def _get_cuds_model(include_parent, namespace, cache_dir):
+    """Returns the CUDSModel from the compiled cache in `cache_dir`,
+    generating and storing it if needed.  See get_cuds_model()."""
+    import pickle
+    if cache_dir is None:
+        cache_dir = cachedir
+    model = read_cached_cuds_model(include_parent, namespace, cache_dir)
+    if model is not None:
+        return model
+
+    model = get_cuds_model(include_parent, namespace, use_cache=False)
+    fname = os.path.join(cache_dir, 'cuds-%s.pickle' % get_cache_key(
+        include_parent, namespace))
+
+    # Write to a temporary file first such that concurrent workers
+    # never see a partially written cache
+    import tempfile
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmpname = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpname, fname)
+    except (IOError, OSError):
+        pass
+
+    return model
+
+
+def get_cuds_entities(include_parent=True,
+                      namespace='https://emmc.info/metadata',
+                      use_cache=True, cache_dir=None):
+    """Returns a (version, entities, relations) tuple for the bundled
+    CUDS and CUBA metadata, with the entities as dicts and the
+    relations as tuples.
+
+    This is the dict representation of get_cuds_model(), see it for
+    the arguments and caching."""
+    return get_cuds_model(include_parent, namespace, use_cache,
+                          cache_dir).to_dicts()
+
+
+# Bump this whenever the layout of the manifest written by
+# write_cuds_entities() changes
+MANIFEST_FORMAT = 1
+
+
+def _hash_value(value):
+    """Returns a hex digest of the JSON representation of `value`."""
+    import hashlib
+    data = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def _write_atomic(fname, data):
+    """Writes string `data` to `fname` via a temporary file, such that
+    readers never see a partially written file.  Returns false if the
+    file already has this content."""
+    try:
+        with open(fname) as f:
+            if f.read() == data:
+                return False
+    except (IOError, OSError):
+        pass
+    import tempfile
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(fname) or '.',
+                                   suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.replace(tmpname, fname)
+    except BaseException:
+        os.remove(tmpname)
+        raise
+    return True
+
+
+def get_dirty_keys(cuds, cuba, manifest, include_parent=True):
+    """Returns the set of CUDS keys whose entities and relations must be
+    regenerated since the run described by `manifest`.
+
+    These are the new and changed CUDS keys, the keys referring to
+    changed, new or removed CUBA or CUDS keys and all descendants of
+    these through the parent chain.  If `manifest` is None or
+    incompatible, all keys are returned."""
+    cudsdict = cuds['CUDS_KEYS']
+    cubadict = cuba['CUBA_KEYS']
+    if (not manifest or manifest.get('format') != MANIFEST_FORMAT or
+            manifest.get('include_parent') != bool(include_parent)):
+        return set(cudsdict)
+    old_cuds = manifest['cuds_keys']
+    old_cuba = manifest['cuba_keys']
+
+    changed = set(old_cuds).difference(cudsdict)
+    changed.update(k for k, v in cudsdict.items()
+                   if old_cuds.get(k, {}).get('hash') != _hash_value(v))
+    names = set(changed)
+    names.update(set(old_cuba).symmetric_difference(cubadict))
+    names.update(k for k, v in cubadict.items()
+                 if k in old_cuba and old_cuba[k] != _hash_value(v))
+
+    resolved = resolve_cuds_elements(cuds, include_parent)
+    childs = {}
+    dirty = set()
+    for key, d in resolved.items():
+        if d['parent']:
+            childs.setdefault(stripname(d['parent']), []).append(key)
+        if key in changed or names.intersection(_get_element_deps(d)):
+            dirty.add(key)
+
+    stack = list(dirty)
+    while stack:
+        for child in childs.get(stack.pop(), ()):
+            if child not in dirty:
+                dirty.add(child)
+                stack.append(child)
+    return dirty
+
+
+def _get_element_deps(element):
+    """Returns a list with the names of the CUBA and CUDS keys referred
+    to by resolved CUDS element dict `element`."""
+    deps = [stripname(v) for v in element.get('variables', ())]
+    deps.extend(stripname(k) for k in element if k.startswith('CUBA.'))
+    return deps
+
+
+def write_cuds_entities(path, include_parent=True, incremental=False):
     """Write all CUDS entities to directory
 
          `path`/`version`/
@@ -261,33 +1051,201 @@ def write_cuds_entities(path, include_parent=True):
 
     If `include_parent` is true, the generated CUDS element entities
     will also include attributes of their parent.
-    """
-    # Read CUBA and CUDS definitions
-    with open(os.path.join(thisdir, 'metadata', 'cuba.yml')) as f:
-        cuba = yaml.load(f.read())
-    with open(os.path.join(thisdir, 'metadata', 'simphony_metadata.yml')) as f:
-        cuds = yaml.load(f.read())
 
-    # Crate CUDS entities and relations
-    entities, relations = generate_cuds_entities(
-        cuds, cuba, include_parent=include_parent)
+    A manifest with content hashes of the CUDS and CUBA keys and the
+    relations of each CUDS key is written to
 
-    # Create directories
+        `path`/manifest-`version`.json
+
+    If `incremental` is true, it is compared with the current metadata
+    and only the entities of the changed keys (see get_dirty_keys())
+    are written.  They are taken from the model cached by
+    get_cuds_model() if it is current, and are otherwise regenerated.
+    In any case, only files whose content changes are rewritten, and
+    they are replaced atomically.
+
+    Returns a list with the names of the files written or removed.
+    """
+    namespace = 'https://emmc.info/metadata'
+    cuds, cuba = load_cuds_metadata()
     version = cuds['VERSION']
+    cudsdict = cuds['CUDS_KEYS']
     dirname = os.path.join(path, version)
+    manifest_name = os.path.join(path, 'manifest-%s.json' % version)
+
+    manifest = None
+    if incremental:
+        try:
+            with open(manifest_name) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+        if manifest and manifest.get('namespace') != namespace:
+            manifest = None
+    dirty = get_dirty_keys(cuds, cuba, manifest, include_parent)
+    old_cuds = manifest['cuds_keys'] if manifest else {}
+
+    # Create directories
     if not os.path.exists(dirname):
         os.makedirs(dirname)
 
-    # Write CUDS element entities
-    for entity in entities:
-        fname = entity['name'] + '.json'
-        with open(os.path.join(path, version, fname), 'w') as f:
-            json.dump(entity, f, indent=4)
+    # The entities and relations of the dirty keys are taken from the
+    # compiled model if it is cached for the current metadata.  Else
+    # only the dirty keys are generated in incremental mode, while the
+    # full model is generated and cached otherwise.
+    model = read_cached_cuds_model(include_parent, namespace)
+    if model is None and not incremental:
+        model = get_cuds_model(include_parent, namespace)
+    if model is not None:
+        entities = [e.to_dict() for e in model.entities if e.name in dirty]
+        relations = [r for r in model.relations
+                     if r[0].split('.', 1)[0] in dirty]
+    else:
+        entities, relations = generate_cuds_entities(
+            cuds, cuba, namespace=namespace, include_parent=include_parent,
+            keys=dirty)
 
-    # Write relations
-    fname = 'relations-%s.json' % version
-    with open(os.path.join(path, fname), 'w') as f:
-        json.dump(relations, f, indent=4)
+    # Write the CUDS element entities of the dirty keys
+    written = []
+    for entity in entities:
+        fname = os.path.join(dirname, entity['name'] + '.json')
+        if _write_atomic(fname, json.dumps(entity, indent=4)):
+            written.append(fname)
+    for key in set(old_cuds).difference(cudsdict):
+        fname = os.path.join(dirname, key + '.json')
+        if os.path.exists(fname):
+            os.remove(fname)
+            written.append(fname)
+
+    # Relations, with those of unchanged keys taken from the manifest
+    key_relations = {key: [] for key in dirty}
+    for relation in relations:
+        key_relations[relation[0].split('.', 1)[0]].append(list(relation))
+    cuds_keys = {}
+    all_relations = []
+    for key, element in cudsdict.items():
+        rels = key_relations.get(key)
+        if rels is None:
+            rels = old_cuds[key]['relations']
+        cuds_keys[key] = dict(hash=_hash_value(element), relations=rels)
+        all_relations.extend(rels)
+    fname = os.path.join(path, 'relations-%s.json' % version)
+    if _write_atomic(fname, json.dumps(all_relations, indent=4)):
+        written.append(fname)
+
+    manifest = dict(
+        format=MANIFEST_FORMAT,
+        include_parent=bool(include_parent),
+        namespace=namespace,
+        cuds_keys=cuds_keys,
+        cuba_keys={k: _hash_value(v) for k, v in cuba['CUBA_KEYS'].items()},
+    )
+    _write_atomic(manifest_name, json.dumps(manifest, indent=1))
+    return written
+
+
+class MetadataRegistry(object):
+    """Process-wide registry of entity descriptions.
+
+    The entities are indexed by (name, version, namespace).  Registering
+    entities that are already registered with the same description is
+    free, and only new or changed entities are registered with softpy,
+    so the metadata databases of softpy do not pile up when collections
+    are built repeatedly.  The Python classes of the entities are
+    created once and cached.
+
+    The entities are held as compact Entity records.
+
+    A complete set of entities, like the CUDS entities with or without
+    the attributes of their parents, can be registered under a key
+    identifying the variant and content of the set.  Registering the
+    current set again then returns immediately, while switching to
+    another set registers all of its entities with softpy, such that
+    softpy always describes the current variant.  The classes are
+    cached per key.
+
+    Attributes
+    ----------
+    entities : dict
+        Maps (name, version, namespace) to Entity records.
+    classes : dict
+        Maps (name, version, namespace) to entity classes.
+    key : None | hashable
+        The key of the current set of entities, see register().
+    """
+    def __init__(self):
+        self.entities = {}
+        self.classes = {}
+        self.key = None
+        self._classes = {}  # maps keys to their classes dicts
+
+    def __len__(self):
+        return len(self.entities)
+
+    def __contains__(self, key):
+        return key in self.entities
+
+    def register(self, entities, key=None):
+        """Registers the sequence of entity dicts or Entity records
+        `entities` and returns a list of the new or changed ones as
+        Entity records.
+
+        If `key` is given, e.g. (include_parent, cache key), `entities`
+        is the set of entities identified by `key`.  Nothing is done if
+        it is the current key, otherwise all of them are registered
+        with softpy and returned.
+
+        Requires softpy."""
+        if key is not None and key == self.key:
+            return []
+        entities = [e if isinstance(e, Entity) else Entity.from_dict(e)
+                    for e in entities]
+        if key is None:
+            new = []
+            for e in entities:
+                old = self.entities.get(e.key)
+                if old is None or (old is not e and old != e):
+                    self.entities[e.key] = e
+                    new.append(e)
+            changed = set(e.key for e in new)
+            self.classes = {k: v for k, v in self.classes.items()
+                            if k not in changed}
+        else:
+            new = entities
+            self.entities.update((e.key, e) for e in entities)
+            self.classes = self._classes.setdefault(key, {})
+        self.key = key
+        if new:
+            import softpy
+            s = StringIO() if sys.version_info.major >= 3 else BytesIO()
+            json.dump([e.to_dict() for e in new], s)
+            s.seek(0)
+            softpy.register_metadb(softpy.JSONMetaDB(s))
+            s.close()
+        return new
+
+    def get(self, name, version, namespace):
+        """Returns the dict describing the given entity."""
+        try:
+            return self.entities[name, version, namespace].to_dict()
+        except KeyError:
+            raise CUDSError('no registered entity %s/%s/%s' % (
+                namespace, version, name))
+
+    def get_entity(self, name, version, namespace):
+        """Returns the class of the given entity.
+
+        Requires softpy."""
+        key = (name, version, namespace)
+        entity = self.classes.get(key)
+        if entity is None:
+            import softpy
+            entity = self.classes[key] = softpy.entity(self.get(*key))
+        return entity
+
+
+# The process-wide metadata registry
+metadata_registry = MetadataRegistry()
 
 
 def get_cuds_collection(include_parent=True):
@@ -296,38 +1254,54 @@ def get_cuds_collection(include_parent=True):
     If `include_parent` is true, the generated CUDS element entities
     will also include attributes of their parent.
 
+    The entities are registered in `metadata_registry`.  The collection
+    is memoized in the process until the metadata YAML files are
+    modified, so repeated calls return the same collection.
+
     Note, this requires softpy.
     """
-    import softpy
-    with open(os.path.join(thisdir, 'metadata', 'cuba.yml')) as f:
-        cuba = yaml.load(f.read())
-    with open(os.path.join(thisdir, 'metadata', 'simphony_metadata.yml')) as f:
-        cuds = yaml.load(f.read())
-    entities, relations = generate_cuds_entities(cuds, cuba,
-                                                 include_parent=include_parent)
+    model = get_cuds_model(include_parent=include_parent)
+
+    # Save all metadata in a database, unless this variant is the
+    # current one
+    metadata_registry.register(model.entities, (
+        bool(include_parent), get_cache_key(include_parent)))
+
+    return _memoize(('collection', bool(include_parent)),
+                    lambda: _new_cuds_collection(model))
+
 
+def _new_cuds_collection(model):
+    """Returns a new Collection holding the entities and relations of
+    CUDSModel `model`, which must be registered in `metadata_registry`.
+    """
+    import softpy
     uuid = softpy.uuid_from_entity('CUDS', '1.0', 'http://emmc.info/meta')
     c = softpy.Collection(uuid=uuid)
     c.name = 'CUDS'
-    c.version = cuds['VERSION']
-    for jsondict in entities:
-        entity = softpy.entity(jsondict)
+    c.version = model.version
+    for e in model.entities:
+        entity = metadata_registry.get_entity(*e.key)
         c.add(entity.name, entity)
-    for relation in relations:
+    for relation in model.relations:
         c.add_relation(*relation)
+    c.relation_index = RelationIndex(model.relations)
+    c.element_plans = {}
+    c.graphs = {}
+    return c
 
-    # Save all metadata in a database
-    s = StringIO() if sys.version_info.major >= 3 else BytesIO()
-    json.dump(entities, s)
-    s.seek(0)
-    softpy.register_metadb(softpy.JSONMetaDB(s))
-    s.close()
 
-    return c
+def add_relation(collection, subject, predicate, object_):
+    """Adds relation (`subject`, `predicate`, `object_`) to `collection`
+    and to its RelationIndex, if it has one."""
+    collection.add_relation(subject, predicate, object_)
+    index = getattr(collection, 'relation_index', None)
+    if index is not None:
+        index.add(subject, predicate, object_)
 
 
 def get_cuds_instance_collection(cuds_collection, name, dimensions={},
-                                 initial_values={}, childs={}):
+                                 initial_values={}, childs={}, lazy=False):
     """Returns a collection with an instances of the CUDS element `name`
     and all its (nested) attributes.
 
@@ -353,6 +1327,9 @@ def get_cuds_instance_collection(cuds_collection, name, dimensions={},
         to instansiate instead of a default CUDS element.  Example:
         {'CRYSTAL_STRUCTURE.ATOM_SITES.ATOM_SITE[0].ATOM_COORDINATES':
          'ATOM_SCALED_COORDINATES'}
+    lazy : bool
+        If true, a LazyCUDSInstanceCollection is returned, in which the
+        instances are only created when they are first accessed.
 
     Notes
     -----
@@ -370,321 +1347,1211 @@ def get_cuds_instance_collection(cuds_collection, name, dimensions={},
 
     Requires softpy.
     """
-    import softpy
-
     e = cuds_collection.get_instance(name)
-    c = softpy.Collection(uuid=e.soft_metadata.get_uuid())  # returned
-
-    def get_shape(base, name, attr):
-        """Returns the shape of attribute `attr` of element `name` (under
-        `base`)"""
-        shapes = cuds_collection.find_relations(name + '.' + attr, 'has-shape')
-        if not shapes:
-            return ()
-        assert len(shapes) == 1
-        shape = shapes.pop()
-        if ':' in shape:
-            ind = base + name + '.' + attr
-            if not ind in dimensions:
-                raise KeyError('Dimension of "%s" must be provided in '
-                               '`dimensions`' % ind)
-            return dimensions[ind]
-        else:
-            return ase.literal_eval(shape)
+    if lazy:
+        c = LazyCUDSInstanceCollection(cuds_collection,
+                                       uuid=e.soft_metadata.get_uuid())
+    else:
+        import softpy
+        c = softpy.Collection(uuid=e.soft_metadata.get_uuid())  # returned
+        c.relation_index = RelationIndex()
+    add_cuds_instance(c, cuds_collection, name, dimensions=dimensions,
+                      childs=childs)
+    return c
 
-    def get_attr_element_name(base, name, attr, shape=()):
-        """Returns CUDS element name of attribute `attr`.
 
-        If a child of `attr` is specified by the `child` argument or
-        via a default value in the definition of CUDS, return the CUDS
-        element name of the child.  Otherwise `attr` is returned."""
-        label = base + name + '.' + attr
-        while True:
-            if label in childs:
-                return childs[label]
-            if not '.' in label:
-                break
-            label = label[label.index('.') + 1: ]
-
-        defaults = cuds_collection.find_relations(
-            name + '.' + attr, 'has-default')
-        if defaults:
-            assert len(defaults) == 1
-            default = defaults.pop()
-            if shape:
-                return [k[5:] if k.startswith('CUBA.') else attr
-                        for kn in ast.literate_eval(default)]
-            elif default.startswith('CUBA.'):
-                return default[5:]
-
-        return attr
-
-    #def get_value(base, name, attr, shape=(), index=None):
-    #    """Returns initial value of `attr` or None."""
-    #    label = base + name '.' + attr
-    #    ilabel = '%s[%s]' % (label, index) if index else label
-    #    while True:
-    #        if label in initial_values:
-    #            return initial_values[label]
-    #        elif ilabel in initial_values:
-    #            return initial_values[ilabel]
-    #        if not '.' in label:
-    #            break
-    #        label = label[label.index('.') + 1: ]
-    #
-    #    defaults = cuds_collection.find_relations(
-    #        name + '.' + attr, 'has-default')
-    #    if defaults:
-    #        assert len(defaults) == 1
-    #        default = defaults.pop()
-    #        if shape:
-    #            return [k[5:] if k.startswith('CUBA.') else attr
-    #                    for kn in ast.literate_eval(default)]
-    #        elif default.startswith('CUBA.'):
-    #            return default[5:]
-    #
-    #    return None
-
-    def add_cuds_element(base, name, index=None, defaults={}):
-        """Create an instance of CUDS element `name` with label base.name or
-        base.name[index] depending on whether `index` ig given."""
-        label = base + name + repr(list(index)) if index else base + name
-        entity = cuds_collection.get_instance(name)
-        instance = entity()
-        #for k, v in defaults.items():
-        #    instance.soft_set_property(k, v)
+def add_cuds_instance(c, cuds_collection, name, parent=None, index=None,
+                      dimensions={}, childs={}):
+    """Adds an instance of CUDS element `name` and all its (nested)
+    attributes to the instance collection `c`.
+
+    The instance is labeled `parent`.`name`, or `parent`.`name`[i] if
+    `index` is given as a one-element list ``[i]``.  If `parent` is
+    given, a has-attribute relation from `parent` to the new instance is
+    added as well.  See get_cuds_instance_collection() for the other
+    arguments.
+
+    If `c` is a LazyCUDSInstanceCollection, the instances are only
+    registered and will be created on first access.
+
+    Returns the label of the new instance.
+    """
+    elements, relations = layout_cuds_instance(
+        cuds_collection, name, parent=parent, index=index,
+        dimensions=dimensions, childs=childs)
+    if isinstance(c, LazyCUDSInstanceCollection):
+        c.add_elements(elements)
+    else:
+        for label, element in elements:
+            c.add(label, new_cuds_instance(cuds_collection, element, label))
+        index = getattr(c, 'label_index', None)
+        if index is not None:
+            for label, element in elements:
+                index.add(label)
+    for relation in relations:
+        add_relation(c, *relation)
+    return elements[0][0]
+
+
+def new_cuds_instance(cuds_collection, name, label):
+    """Returns a new instance of CUDS element `name` with the basic
+    properties (UID, NAME, DESCRIPTION and data) initialised for an
+    instance labeled `label`."""
+    return get_element_plan(cuds_collection, name).new_instance(label)
+
+
+class ElementPlan(object):
+    """A precompiled plan for instantiating CUDS element `name`.
+
+    The plan holds everything that can be derived from the CUDS metadata
+    collection alone, i.e. the entity, the attributes with their shapes
+    and default element names and the basic properties to initialise.
+    It is compiled once per element and shared by all instances.
+
+    Attributes
+    ----------
+    name : string
+        Name of the CUDS element.
+    entity : class
+        The entity of the CUDS element.
+    attributes : list
+        List of (attr, shape, element) tuples for each CUDS attribute.
+        `shape` is a tuple or a string like "(:)" for shapes that must
+        be given as dimensions.  `element` is the default element name,
+        or a list of element names for arrays with per-index defaults.
+    """
+    def __init__(self, cuds_collection, name):
+        self.name = name
+        self.entity = cuds_collection.get_instance(name)
+        self.attributes = []
+        self._properties = None
+        self._description = None
+
+        def find_one(subject, predicate):
+            objects = find_relations(cuds_collection, subject, predicate)
+            if not objects:
+                return None
+            assert len(objects) == 1
+            return objects[0]
+
+        for attr in find_relations(cuds_collection, name, 'has-attribute'):
+            key = name + '.' + attr
+            shape = find_one(key, 'has-shape')
+            if not shape:
+                shape = ()
+            elif ':' not in shape:
+                shape = tuple(ast.literal_eval(shape))
+            element = attr
+            default = find_one(key, 'has-default')
+            if default:
+                if shape and default.startswith('['):
+                    element = [k[5:] if k.startswith('CUBA.') else attr
+                               for k in ast.literal_eval(default)] or attr
+                elif default.startswith('CUBA.'):
+                    element = default[5:]
+            self.attributes.append((attr, shape, element))
+
+    def new_instance(self, label):
+        """Returns a new instance labeled `label`."""
+        instance = self.entity()
+        if self._properties is None:
+            self._description = instance.soft_get_meta_description()
+            self._properties = [k for k in ('data', 'UID', 'NAME',
+                                            'DESCRIPTION')
+                                if hasattr(instance, k)]
 
         # Assign default values to some basic properties
-        defaults = dict(data='',
-                        UID=instance.soft_get_id(),
-                        NAME=label,
-                        DESCRIPTION=instance.soft_get_meta_description())
-        for k, v in defaults.items():
-            if hasattr(instance, k):
-                setattr(instance, k, v)
-
-        c.add(label, instance)
-        for attr in cuds_collection.find_relations(name, 'has-attribute'):
-            shape = get_shape(base, name, attr)
+        for k in self._properties:
+            if k == 'UID':
+                v = instance.soft_get_id()
+            elif k == 'NAME':
+                v = label
+            elif k == 'DESCRIPTION':
+                v = self._description
+            else:
+                v = ''
+            setattr(instance, k, v)
+        return instance
+
+
+def get_element_plan(cuds_collection, name):
+    """Returns the ElementPlan for CUDS element `name`.
+
+    The plans are cached in the `element_plans` attribute of
+    collections returned by get_cuds_collection()."""
+    plans = getattr(cuds_collection, 'element_plans', None)
+    if plans is None:
+        return ElementPlan(cuds_collection, name)
+    plan = plans.get(name)
+    if plan is None:
+        plan = plans[name] = ElementPlan(cuds_collection, name)
+    return plan
+
+
+def layout_cuds_instance(cuds_collection, name, parent=None, index=None,
+                         dimensions={}, childs={}):
+    """Returns the layout of an instance of CUDS element `name` and all
+    its (nested) attributes without creating any instances.
+
+    See add_cuds_instance() for the arguments.
+
+    Returns
+    -------
+    elements : list
+        List of (label, element name) tuples, starting with the
+        instance of `name` itself and followed by its attributes in
+        depth-first order.
+    relations : list
+        The has-attribute relations between the instances.
+
+    Notes
+    -----
+    All indices of an array attribute share the same layout, unless
+    `dimensions` or `childs` refer to labels with indices.  Hence the
+    first index is laid out from the element plans and the rest are
+    copied from it with new label prefixes.
+    """
+    elements = []
+    relations = []
+    plans = {}
+    uniform = not any('[' in k for k in dimensions) and not any(
+        '[' in k for k in childs)
+    child_paths = {parse_label(k): v for k, v in childs.items()}
+
+    def get_plan(name):
+        plan = plans.get(name)
+        if plan is None:
+            plan = plans[name] = get_element_plan(cuds_collection, name)
+        return plan
+
+    def get_shape(path, attr, shape):
+        """Returns the actual shape of attribute `attr` of the element
+        with unindexed label `path`."""
+        if isinstance(shape, tuple):
+            return shape
+        ind = path + '.' + attr
+        if not ind in dimensions:
+            raise KeyError('Dimension of "%s" must be provided in '
+                           '`dimensions`' % ind)
+        return dimensions[ind]
+
+    def get_attr_element_name(path, label, attr, element):
+        """Returns CUDS element name of attribute `attr`.
+
+        If a child of `attr` is specified by the `child` argument, return
+        the CUDS element name of the child.  Otherwise the default
+        `element` is returned."""
+        for l in (label + '.' + attr, path + '.' + attr):
+            p = parse_label(l)
+            for i in range(len(p)):
+                if p[i:] in child_paths:
+                    return child_paths[p[i:]]
+        return element
+
+    def add_cuds_element(base, name, index=None):
+        """Lay out an instance of CUDS element `name` with label base.name
+        or base.name[index] depending on whether `index` ig given."""
+        path = base + name
+        label = path + repr(list(index)) if index else path
+        elements.append((label, name))
+        for attr, shape, element in get_plan(name).attributes:
+            shape = get_shape(path, attr, shape)
             assert len(shape) < 2, 'only scalar and 1D shapes are supported'
-            aname = get_attr_element_name(base, name, attr, shape)
-            #value = get_value(base, name, attr)
+            if childs:
+                element = get_attr_element_name(path, label, attr, element)
             if len(shape) == 0:
-                add_cuds_element(label + '.', aname)
-                c.add_relation(label, 'has-attribute', label + '.' + aname)
+                add_cuds_element(label + '.', element)
+                relations.append(
+                    (label, 'has-attribute', label + '.' + element))
             elif len(shape) == 1:
-                for i in range(shape[0]):
-                    add_cuds_element(label + '.', aname, index=[i])
-                    c.add_relation(
-                        label, 'has-attribute', '%s.%s[%d]' % (label, aname, i))
+                add_cuds_array(label, element, shape[0])
             else:
                 raise NotImplementedError(
                     'only 0D and 1D attribute shapes are supported')
+        return label
+
+    def add_cuds_array(label, element, n):
+        """Lay out `n` instances of CUDS element(s) `element` as an array
+        attribute of `label`."""
+        if isinstance(element, list) or not uniform or n < 2:
+            for i in range(n):
+                iname = element[i] if isinstance(element, list) else element
+                ilabel = add_cuds_element(label + '.', iname, index=[i])
+                relations.append((label, 'has-attribute', ilabel))
+            return
+
+        # Lay out the first index and copy it for the remaining
+        ne, nr = len(elements), len(relations)
+        label0 = add_cuds_element(label + '.', element, index=[0])
+        relations.append((label, 'has-attribute', label0))
+        n0 = len(label0)
+        template = [(l[n0:], e) for l, e in elements[ne:]]
+        rtemplate = [(s[n0:], p, o[n0:]) for s, p, o in relations[nr:-1]]
+        for i in range(1, n):
+            ilabel = '%s.%s[%d]' % (label, element, i)
+            elements.extend([(ilabel + l, e) for l, e in template])
+            relations.extend([(ilabel + s, p, ilabel + o)
+                              for s, p, o in rtemplate])
+            relations.append((label, 'has-attribute', ilabel))
+
+    label = add_cuds_element(parent + '.' if parent else '', name, index)
+    if parent:
+        relations.append((parent, 'has-attribute', label))
+    return elements, relations
+
+
+class LazyCUDSInstanceCollection(object):
+    """A CUDS instance collection that creates its instances on demand.
+
+    All labels and relations are known as soon as the collection is laid
+    out, but an instance is only created when it is first accessed with
+    get_instance(), e.g. during serialization.  Instances that are
+    never accessed are never created.
+
+    The collection supports the parts of the softpy Collection API used
+    by this module and cifdata.  Use get_collection() to obtain a fully
+    materialized softpy Collection, e.g. for saving.
+    """
+    def __init__(self, cuds_collection, uuid=None):
+        self.cuds_collection = cuds_collection
+        self.uuid = uuid
+        self.relation_index = RelationIndex()
+        self.elements = {}   # maps all labels to CUDS element names
+        self.instances = {}  # maps labels to created instances
+        self.label_index = None  # LabelTrie, built on first query
+
+    def __len__(self):
+        return len(self.elements)
+
+    def __contains__(self, label):
+        return label in self.elements
+
+    def get_uuid(self):
+        """Returns the UUID of this collection."""
+        return self.uuid
+
+    def add_elements(self, elements):
+        """Registers a sequence of (label, element name) tuples to be
+        created on demand."""
+        if self.label_index is not None:
+            elements = list(elements)
+            for label, element in elements:
+                self.label_index.add(label)
+        self.elements.update(elements)
+
+    def add(self, label, instance):
+        """Adds `instance` with the given label."""
+        if self.label_index is not None:
+            self.label_index.add(label)
+        self.elements.setdefault(label, None)
+        self.instances[label] = instance
+
+    def add_relation(self, subject, predicate, object_):
+        """Adds relation (`subject`, `predicate`, `object_`)."""
+        self.relation_index.add(subject, predicate, object_)
+
+    def find_relations(self, subject, predicate):
+        """Returns a set with the objects related to `subject` via
+        `predicate`."""
+        return set(self.relation_index.find(subject, predicate))
+
+    def get_labels(self):
+        """Returns a list of all labels, including those of instances that
+        are not yet created."""
+        return list(self.elements)
+
+    def find_parent(self, label):
+        """Returns the label of the instance that `label` is an
+        attribute of, or None."""
+        return find_parent(self, label)
+
+    def find_children(self, label):
+        """Returns a list with the labels of the attributes of
+        `label`."""
+        return find_children(self, label)
+
+    def find_descendants(self, label):
+        """Returns a list with the labels of all (nested) attributes of
+        `label`."""
+        return find_descendants(self, label)
+
+    def find_indices(self, label, attr):
+        """Returns a sorted list with the indices of array attribute
+        `attr` of `label`."""
+        return find_indices(self, label, attr)
+
+    def is_materialized(self, label):
+        """Returns whether the instance labeled `label` has been
+        created."""
+        return label in self.instances
+
+    def get_instance(self, label):
+        """Returns the instance labeled `label`, creating it if needed."""
+        instance = self.instances.get(label)
+        if instance is None:
+            instance = new_cuds_instance(
+                self.cuds_collection, self.elements[label], label)
+            self.instances[label] = instance
+        return instance
+
+    def get_collection(self):
+        """Returns a new softpy Collection with all instances (which are
+        created if needed) and relations."""
+        import softpy
+        c = softpy.Collection(uuid=self.uuid)
+        c.relation_index = RelationIndex()
+        for label in self.elements:
+            c.add(label, self.get_instance(label))
+        for (subject, predicate), objects in (
+                self.relation_index.forward.items()):
+            for object_ in objects:
+                add_relation(c, subject, predicate, object_)
+        return c
+
+
+def serialize_cuds_instance_collection(ci, format='yaml'):
+    """Returns serialized string representation of CUDS instance
+    collection `ci`.
+
+    `format` may be either "yaml" or "json".  See
+    write_cuds_instance_collection()."""
+    f = StringIO()
+    write_cuds_instance_collection(ci, f, format=format)
+    return f.getvalue()
+
+
+# Tokens yielded by iter_cuds_instance_tokens()
+(SEQUENCE_START, SEQUENCE_END, MAPPING_START, MAPPING_END, KEY,
+ SCALAR) = range(6)
+
+
+# Kinds of mapping values returned by _get_instance_items(), in addition
+# to SCALAR
+_NODE, _LIST = 'node', 'list'
+
+
+def _get_instance_items(ci, label, sort_keys=True):
+    """Returns a list of (key, kind, value) tuples for the items of the
+    mapping representing the instance labeled `label` in CUDS instance
+    collection `ci`.
+
+    `kind` is SCALAR for properties, with their string value as value,
+    _NODE for attributes, with the label of the attribute instance as
+    value, and _LIST for array attributes, with a list of labels as
+    value."""
+    inst = ci.get_instance(label)
+    d = {k: (SCALAR, str(inst.soft_get_property(k)))
+         for k in inst.soft_get_property_names()}
+    dd = {}
+    for attr_label in find_relations(ci, label, 'has-attribute'):
+        attr, n = _parse_label_part(attr_label.rpartition('.')[2])
+        if n is not None:
+            if not attr in dd:
+                dd[attr] = {}
+            dd[attr][n] = attr_label
+        else:
+            d[attr] = (_NODE, attr_label)
+    for attr in dd:
+        d[attr] = (_LIST, [dd[attr][n] for n in sorted(dd[attr])])
+    items = sorted(d.items()) if sort_keys else list(d.items())
+    return [(k, kind, v) for k, (kind, v) in items]
 
-    add_cuds_element('', name)
-    return c
 
+def iter_cuds_instance_tokens(ci, sort_keys=True):
+    """Yields (token, value) tuples describing the nested structure of
+    CUDS instance collection `ci`.
 
-def serialize_cuds_instance_collection(ci):
-    """Returns serialized string representation of CUDS instance
-    collection `ci`."""
-    baselist = []
-    root_elements = [l for l in ci.get_labels() if '.' not in l]
-
-    def dictrepr(label):
-        """Returns a nested dict representation of given instance."""
-        inst = ci.get_instance(label)
-        d = {k: str(inst.soft_get_property(k))
-             for k in inst.soft_get_property_names()}
-        dd = {}
-        for attr_label in ci.find_relations(label, 'has-attribute'):
-            attr = attr_label[attr_label.rindex('.') + 1: ]
-            if attr.endswith(']'):
-                attr, n = re.match(r'([^[]+)\[(\d+)\]', attr).groups()
-                if not attr in dd:
-                    dd[attr] = {}
-                dd[attr][int(n)] = dictrepr(attr_label)
-            else:
-                d[attr] = dictrepr(attr_label)
-        for attr in dd:
-            d[attr] = [dd[attr][n] for n in range(len(dd[attr]))]
-        return d
+    The collection is represented as a list of the root instances.
+    Each instance is a mapping of its property names to their string
+    values and of its attribute names to either nested instances or, for
+    array attributes, lists of nested instances.
+
+    The tokens are SEQUENCE_START and MAPPING_START (with the number of
+    items as value), SEQUENCE_END and MAPPING_END (with value None),
+    KEY (with the key as value) and SCALAR (with the string as value).
+
+    The collection is walked iteratively, so the depth of the nesting
+    is not limited by the recursion limit.  If `sort_keys` is true,
+    the keys of each mapping are sorted.
+    """
+    def expand(label):
+        """Returns a list of (token, value) tuples for the items of the
+        mapping representing the instance labeled `label`."""
+        items = _get_instance_items(ci, label, sort_keys)
+        tokens = []
+        for k, kind, v in items:
+            tokens.append((KEY, k))
+            tokens.append((kind, v))
+        return len(items), tokens
+
+    roots = [l for l in ci.get_labels() if '.' not in l]
+    yield SEQUENCE_START, len(roots)
+    stack = [(iter([(_NODE, root) for root in roots]), SEQUENCE_END)]
+    while stack:
+        it, end = stack[-1]
+        token = next(it, None)
+        if token is None:
+            stack.pop()
+            yield end, None
+            continue
+        kind, value = token
+        if kind is _NODE:
+            n, tokens = expand(value)
+            yield MAPPING_START, n
+            stack.append((iter(tokens), MAPPING_END))
+        elif kind is _LIST:
+            yield SEQUENCE_START, len(value)
+            stack.append((iter([(_NODE, l) for l in value]), SEQUENCE_END))
+        else:
+            yield kind, value
 
-    for root in root_elements:
-        baselist.append(dictrepr(root))
-    return yaml.dump(baselist, default_flow_style=False)
-    #return json.dumps(baselist, indent=4)
 
+def write_cuds_instance_collection(ci, f, format='yaml'):
+    """Writes CUDS instance collection `ci` to file object `f`.
 
-def get_cuds_graph(cuds_collection, subgraph=None, show_compositions=True,
-                   show_parents=True):
-    """Returns a pydot graph object for visualising a CUDS graph.
+    The output is written incrementally while walking the collection,
+    so the full nested representation of the collection is never held
+    in memory.
 
     Parameters
     ----------
-    cuds_collection : Collection
-        A CUDS metadata collection as returned by
-        get_cuds_collection(include_parent=False).
-    subgraph : string
-        If given, only output the CUDS element `subgraph` and its
-        childs will be included.
-    show_compositions : bool
-        Whether to also show compositions.
-    show_parents : bool
-        Whehter to include parents in combination with `subgraph`.
+    ci : Collection
+        The CUDS instance collection to write.
+    f : file object
+        A text stream to write to.
+    format : "yaml" | "json"
+        Output format.  The YAML output is the same as
+        ``yaml.dump(data, default_flow_style=False)`` and the JSON output
+        the same as ``json.dumps(data, indent=4)``, where `data` is the
+        list of root instances represented as nested dicts.  The C
+        accelerated YAML emitter is used when available.
 
     Notes
     -----
-    Requires that you have pydot installed.
-
-    Examples
-    --------
-    >>> cuds_collection = get_cuds_collection(include_parent=False)
-    >>> graph = get_cuds_graph(cuds_collection)
-    >>> graph.write_png('CUDS.png')
+    If a string with characters outside printable ASCII is encountered
+    while writing YAML with the C emitter, the collection is walked
+    again and written with the pure Python emitter, which line-wraps such
+    strings differently.
     """
-    import pydot
+    import instrument
+    with instrument.phase('emit'):
+        if format == 'yaml':
+            _write_yaml(ci, f)
+        elif format == 'json':
+            _write_json(iter_cuds_instance_tokens(ci, sort_keys=False), f)
+        else:
+            raise ValueError('unknown serialization format: %r' % format)
+
+
+# Matches strings that the YAML emitter may render double-quoted.  The C
+# and pure Python emitters line-wrap such strings differently.
+_needs_double_quotes = re.compile(r'[^\x20-\x7e]').search
+
+
+class _CountingWriter(object):
+    """Forwards writes to `f` while counting the written characters."""
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        self.f.write(data)
+
+
+class _SkippingWriter(object):
+    """Forwards writes to `f`, except for the first `skip` characters."""
+    def __init__(self, f, skip):
+        self.f = f
+        self.skip = skip
+
+    def write(self, data):
+        if self.skip:
+            n = min(self.skip, len(data))
+            data = data[n:]
+            self.skip -= n
+        if data:
+            self.f.write(data)
+
+
+def _write_yaml(ci, f):
+    """Writes CUDS instance collection `ci` to `f` as YAML.
+
+    The C accelerated emitter is used if available.  Since it line-wraps
+    double-quoted strings differently from the pure Python emitter used
+    by yaml.dump(), we fall back to the pure Python emitter if such a
+    string is encountered.  The output written so far is then identical
+    and is skipped when the collection is written again."""
+    import yaml
+    if hasattr(yaml, 'CDumper'):
+        out = _CountingWriter(f)
+        tokens = iter_cuds_instance_tokens(ci, sort_keys=True)
+        if _emit_yaml(tokens, out, yaml.CDumper, safe_only=True):
+            return
+        f = _SkippingWriter(f, out.count)
+    _emit_yaml(iter_cuds_instance_tokens(ci, sort_keys=True), f, yaml.Dumper)
+
+
+def _emit_yaml(tokens, f, Dumper, safe_only=False):
+    """Emits the tokens from iter_cuds_instance_tokens() to `f` as YAML.
+
+    If `safe_only` is true, the emission is aborted and False is
+    returned if a scalar that may be double-quoted is encountered.
+    Otherwise True is returned."""
+    from yaml.events import (
+        StreamStartEvent, StreamEndEvent, DocumentStartEvent,
+        DocumentEndEvent, SequenceStartEvent, SequenceEndEvent,
+        MappingStartEvent, MappingEndEvent, ScalarEvent)
+    from yaml.nodes import ScalarNode
+
+    dumper = Dumper(f, default_flow_style=False)
+    emit = dumper.emit
+    resolve = dumper.resolve
+    str_tag = 'tag:yaml.org,2002:str'
+    seq_tag = 'tag:yaml.org,2002:seq'
+    map_tag = 'tag:yaml.org,2002:map'
+    try:
+        emit(StreamStartEvent())
+        emit(DocumentStartEvent(explicit=False))
+        for kind, value in tokens:
+            if kind == SCALAR or kind == KEY:
+                if safe_only and _needs_double_quotes(value):
+                    return False
+                implicit = resolve(ScalarNode, value, (True, False)) == str_tag
+                emit(ScalarEvent(None, str_tag, (implicit, True), value))
+            elif kind == MAPPING_START:
+                emit(MappingStartEvent(None, map_tag, True, flow_style=False))
+            elif kind == MAPPING_END:
+                emit(MappingEndEvent())
+            elif kind == SEQUENCE_START:
+                emit(SequenceStartEvent(None, seq_tag, True,
+                                        flow_style=False))
+            elif kind == SEQUENCE_END:
+                emit(SequenceEndEvent())
+        emit(DocumentEndEvent(explicit=False))
+        emit(StreamEndEvent())
+    finally:
+        dumper.dispose()
+    return True
+
+
+def _write_json(tokens, f, indent=4):
+    """Writes the tokens from iter_cuds_instance_tokens() to `f` as
+    indented JSON."""
+    write = f.write
+    encode = json.encoder.encode_basestring_ascii
+    stack = []  # list of [number of items written, is mapping]
+
+    def newline(top):
+        write(',\n' if top[0] else '\n')
+        write(' ' * (indent * len(stack)))
+        top[0] += 1
+
+    for kind, value in tokens:
+        if kind == KEY:
+            newline(stack[-1])
+            write(encode(value))
+            write(': ')
+            continue
+        if kind == SEQUENCE_END or kind == MAPPING_END:
+            top = stack.pop()
+            if top[0]:
+                write('\n' + ' ' * (indent * len(stack)))
+            write(']' if kind == SEQUENCE_END else '}')
+            continue
+        if stack and not stack[-1][1]:
+            newline(stack[-1])
+        if kind == SCALAR:
+            write(encode(value))
+        elif kind == SEQUENCE_START:
+            write('[')
+            stack.append([0, False])
+        elif kind == MAPPING_START:
+            write('{')
+            stack.append([0, True])
+
+
+def _emit_yaml_text(tokens):
+    """Returns the YAML text for the list of tokens `tokens`.
+
+    The C accelerated emitter is used unless a scalar that may be
+    double-quoted is encountered.  See _write_yaml()."""
+    import yaml
+    if hasattr(yaml, 'CDumper'):
+        f = StringIO()
+        if _emit_yaml(tokens, f, yaml.CDumper, safe_only=True):
+            return f.getvalue()
+    f = StringIO()
+    _emit_yaml(tokens, f, yaml.Dumper)
+    return f.getvalue()
+
+
+class CUDSInstanceSerializer(object):
+    """Incremental serializer of a CUDS instance collection.
+
+    The serialized text of each instance subtree is cached as a template
+    of text pieces with slots for the nested attribute instances.  When
+    instances are marked as dirty with mark_dirty() (or updated with
+    set_property()), only the templates of the dirty instances are
+    re-emitted and only the cached fragments of them and their
+    ancestors are re-joined on the next call to serialize().  The
+    output is always identical to serialize_cuds_instance_collection().
+
+    Parameters
+    ----------
+    ci : Collection
+        The CUDS instance collection to serialize.
+    format : "yaml" | "json"
+        Output format.
 
+    Notes
+    -----
+    Changes to properties must be reported with mark_dirty(), unless
+    they are made with set_property().  Added instances and relations
+    below a dirty instance are picked up automatically.  Call
+    invalidate() after other structural changes, like adding root
+    instances.
+    """
+    def __init__(self, ci, format='yaml'):
+        if format not in ('yaml', 'json'):
+            raise ValueError('unknown serialization format: %r' % format)
+        self.ci = ci
+        self.format = format
+        self.invalidate()
+
+    def invalidate(self):
+        """Discards all cached fragments.  The next serialization walks
+        the whole collection."""
+        self.roots = None
+        self.parents = {}     # maps labels to (parent label, key)
+        self.items = {}       # maps labels to _get_instance_items()
+        self.templates = {}   # maps labels to lists of pieces
+        self.fragments = {}   # maps labels to serialized text
+        self.dirty = set()
+
+    def mark_dirty(self, label):
+        """Marks instance `label` as changed."""
+        if self.roots is None:
+            return
+        if label not in self.parents:
+            raise KeyError('no instance labeled %r' % (label, ))
+        self.dirty.add(label)
+        while label is not None and label in self.fragments:
+            del self.fragments[label]
+            label = self.parents[label][0]
+
+    def set_property(self, label, name, value):
+        """Sets property `name` of instance `label` to `value` and marks
+        the instance as dirty."""
+        inst = self.ci.get_instance(label)
+        inst.soft_set_property(name, value)
+        self.ci.add(label, inst)
+        self.mark_dirty(label)
+
+    def serialize(self):
+        """Returns the serialized collection."""
+        if self.roots is None:
+            self._build()
+        elif self.dirty:
+            self._update()
+        if self.format == 'json':
+            if not self.roots:
+                return '[]'
+            return '[\n    %s\n]' % ',\n    '.join(
+                self._get_fragment(root) for root in self.roots)
+        if not self.roots:
+            return '[]\n'
+        return ''.join(self._get_fragment(root) for root in self.roots)
+
+    def write(self, f):
+        """Writes the serialized collection to file object `f`."""
+        f.write(self.serialize())
+
+    def _expand(self, label):
+        """Updates the items of instance `label` and registers its
+        children.  Returns a list with the labels of children that have
+        no template."""
+        items = _get_instance_items(self.ci, label,
+                                    sort_keys=self.format == 'yaml')
+        self.items[label] = items
+        new = []
+        for key, kind, value in items:
+            if kind == SCALAR:
+                continue
+            for child in (value if kind == _LIST else [value]):
+                self.parents[child] = (label, key)
+                if child not in self.templates:
+                    new.append(child)
+        return new
+
+    def _get_fragment(self, label):
+        """Returns the serialized subtree of instance `label`."""
+        fragment = self.fragments.get(label)
+        if fragment is not None:
+            return fragment
+        # Join the templates in post order
+        stack = [(label, False)]
+        while stack:
+            label, visited = stack.pop()
+            if label in self.fragments:
+                continue
+            pieces = self.templates[label]
+            if visited:
+                self.fragments[label] = ''.join(
+                    piece if isinstance(piece, str) else
+                    piece[1].join(self.fragments[l] for l in piece[0])
+                    for piece in pieces)
+            else:
+                stack.append((label, True))
+                for piece in pieces:
+                    if not isinstance(piece, str):
+                        stack.extend((l, False) for l in piece[0]
+                                     if l not in self.fragments)
+        return self.fragments[label]
+
+    def _build(self):
+        """Serializes the whole collection and builds all templates."""
+        self.invalidate()
+        self.roots = [l for l in self.ci.get_labels() if '.' not in l]
+        stack = [(root, None) for root in self.roots]
+        while stack:
+            label, parent = stack.pop()
+            if parent is None:
+                self.parents[label] = (None, None)
+            stack.extend((child, label) for child in self._expand(label))
+            self.templates[label] = None
+        if self.format == 'json':
+            for label in self.items:
+                self.templates[label] = self._json_template(label)
+        else:
+            self._slice_yaml()
+
+    def _update(self):
+        """Re-emits the templates of all dirty instances."""
+        dirty = set()
+        stack = list(self.dirty)
+        while stack:
+            label = stack.pop()
+            if label in dirty:
+                continue
+            dirty.add(label)
+            for child in self._expand(label):
+                self.templates[child] = None
+                stack.append(child)
+        for label in dirty:
+            self.fragments.pop(label, None)
+            if self.format == 'json':
+                self.templates[label] = self._json_template(label)
+            else:
+                self.templates[label] = self._yaml_template(label)
+        self.dirty = set()
+
+    def _get_depth(self, label):
+        """Returns the nesting depth of instance `label` in the JSON
+        output."""
+        depth = 1
+        parent, key = self.parents[label]
+        while parent is not None:
+            depth += 1
+            for k, kind, value in self.items[parent]:
+                if k == key and kind == _LIST:
+                    depth += 1
+                    break
+            parent, key = self.parents[parent]
+        return depth
+
+    def _json_template(self, label):
+        """Returns the JSON template of instance `label`."""
+        items = self.items[label]
+        if not items:
+            return ['{}']
+        encode = json.encoder.encode_basestring_ascii
+        depth = self._get_depth(label)
+        indent = '\n' + ' ' * (4 * (depth + 1))
+        pieces = []
+        text = ['{']
+        for i, (key, kind, value) in enumerate(items):
+            text.append(',' + indent if i else indent)
+            text.append(encode(key) + ': ')
+            if kind == SCALAR:
+                text.append(encode(value))
+            elif kind == _NODE:
+                pieces.append(''.join(text))
+                pieces.append(([value], ''))
+                text = []
+            elif not value:
+                text.append('[]')
+            else:
+                sub = indent + '    '
+                text.append('[' + sub)
+                pieces.append(''.join(text))
+                pieces.append((value, ',' + sub))
+                text = [indent + ']']
+        text.append(indent[:-4] + '}')
+        pieces.append(''.join(text))
+        return pieces
+
+    def _yaml_template(self, label):
+        """Returns the YAML template of instance `label`, emitted in the
+        context of its ancestors."""
+        items = self.items[label]
+        placeholder = '__cuds_fragment__'
+        while any(kind == SCALAR and value == placeholder
+                  for key, kind, value in items):
+            placeholder += '_'
+
+        # Tokens of the path from the root to `label`
+        path = []
+        child, (parent, key) = label, self.parents[label]
+        while parent is not None:
+            in_list = any(k == key and kind == _LIST
+                          for k, kind, value in self.items[parent])
+            path.append((key, in_list))
+            child, (parent, key) = parent, self.parents[parent]
+        tokens = [(SEQUENCE_START, 1)]
+        for key, in_list in reversed(path):
+            tokens.extend([(MAPPING_START, 1), (KEY, key)])
+            if in_list:
+                tokens.append((SEQUENCE_START, 1))
+        tokens.append((MAPPING_START, len(items)))
+        slots = []
+        for key, kind, value in items:
+            tokens.append((KEY, key))
+            if kind == SCALAR:
+                tokens.append((SCALAR, value))
+            elif value and (kind == _LIST or self.items[value]):
+                tokens.append((SCALAR, placeholder))
+                slots.append((value if kind == _LIST else [value], ''))
+            elif kind == _LIST:
+                tokens.extend([(SEQUENCE_START, 0), (SEQUENCE_END, None)])
+            else:
+                tokens.extend([(MAPPING_START, 0), (MAPPING_END, None)])
+        tokens.append((MAPPING_END, None))
+        for key, in_list in path:
+            if in_list:
+                tokens.append((SEQUENCE_END, None))
+            tokens.append((MAPPING_END, None))
+        tokens.append((SEQUENCE_END, None))
+
+        lines = _emit_yaml_text(tokens).splitlines(True)[len(path):]
+        pieces = []
+        text = []
+        suffix = ': %s\n' % placeholder
+        slots = iter(slots)
+        for line in lines:
+            if line.endswith(suffix):
+                text.append(line[:-len(suffix)] + ':\n')
+                pieces.append(''.join(text))
+                pieces.append(next(slots))
+                text = []
+            else:
+                text.append(line)
+        pieces.append(''.join(text))
+        return pieces
+
+    def _slice_yaml(self):
+        """Serializes the whole collection as YAML and slices the output
+        into the templates of all instances."""
+        f = StringIO()
+        _write_yaml(self.ci, f)
+        lines = f.getvalue().splitlines(True)
+        nlines = len(lines)
+
+        def indent(line):
+            return len(line) - len(line.lstrip(' '))
+
+        # Each instance is sliced with its column and a text buffer.  The
+        # value lines of a property end at the first non-blank line that
+        # is not indented more than its key.
+        pos = 0
+        stack = [(root, 2, None) for root in reversed(self.roots)]
+        while stack:
+            label, column, state = stack.pop()
+            if state is None:
+                state = [iter(self.items[label]), [], []]
+            items, pieces, text = state
+            for key, kind, value in items:
+                text.append(lines[pos])
+                pos += 1
+                if kind == SCALAR or not value or not (
+                        kind == _LIST or self.items[value]):
+                    while pos < nlines and (not lines[pos].strip() or
+                                            indent(lines[pos]) > column):
+                        text.append(lines[pos])
+                        pos += 1
+                    continue
+                pieces.append(''.join(text))
+                del text[:]
+                children = value if kind == _LIST else [value]
+                pieces.append((children, ''))
+                stack.append((label, column, state))
+                stack.extend((child, column + 2, None)
+                             for child in reversed(children))
+                break
+            else:
+                pieces.append(''.join(text))
+                self.templates[label] = pieces
+
+
+# Attributes of the DOT graph, nodes and edges of CUDS graphs
+_graph_attrs = (
+    ('fontname', 'Bitstream Vera Sans'),
+    ('fontsize', 8),
+    ('rankdir', 'BT'),
+    ('splines', 'ortho'),
+)
+_node_attrs = (
+    ('shape', 'record'),
+    ('fontname', 'Bitstream Vera Sans'),
+    ('fontsize', 8),
+    ('style', 'filled'),
+    ('fillcolor', '#ffffe0'),
+)
+_inheritance_attrs = (
+    ('arrowhead', 'empty'),
+)
+_composition_attrs = (
+    ('fontname', 'Bitstream Vera Sans'),
+    ('fontsize', 8),
+    ('arrowhead', 'diamond'),
+    ('color', '#0000ff'),
+)
+
+# Regular expression matching DOT identifiers that need no quoting
+_dot_id_re = re.compile(
+    r'^(?:[A-Za-z_][A-Za-z0-9_]*|-?(?:\.\d+|\d+(?:\.\d*)?))$')
+
+
+def _dot_quote(value):
+    """Returns `value` as a DOT identifier, quoted if needed."""
+    value = str(value)
+    if _dot_id_re.match(value):
+        return value
+    return '"%s"' % value.replace('"', r'\"')
+
+
+def _dot_attrs(attrs):
+    """Returns DOT attribute list for the (name, value) pairs `attrs`."""
+    return ', '.join('%s=%s' % (k, _dot_quote(v)) for k, v in attrs)
+
+
+class CUDSGraph(object):
+    """Index of the nodes and edges of a CUDS graph.
+
+    The graph is built by walking the relations of `cuds_collection`
+    once, keeping the nodes and edges in dicts, such that membership
+    tests are constant time and each element is only expanded once.
+    See get_cuds_graph() for the arguments.
+
+    Attributes
+    ----------
+    nodes : dict
+        Maps node names to a list of (name, value) attribute pairs.
+    edges : dict
+        Maps (tail, head, shape) tuples to a list of (name, value)
+        attribute pairs.  `shape` is None for inheritance edges and
+        the shape of the attribute (or '') for composition edges.
+    """
+    def __init__(self, cuds_collection, subgraph=None,
+                 show_compositions=True, show_parents=True):
+        self.cuds_collection = cuds_collection
+        self.root = subgraph if subgraph else 'CUDS_ITEM'
+        self.show_compositions = show_compositions
+        self.show_parents = show_parents
+        self.nodes = {}
+        self.edges = {}
+        self._childs_added = set()
+        self._compositions_added = set()
+
+        self.add_node(self.root)
+        self.add_childs(self.root)
+        if show_parents:
+            self.add_parents(self.root)
+        if show_compositions:
+            self.add_compositions(self.root)
+
+    @staticmethod
     def get_nodename(element):
+        """Returns the node name of CUDS element `element`."""
         if element.lower() in ('node', 'edge'):
             return element + '_'
         return element
 
-    def get_node(element):
-        e = cuds_collection.get_instance(element)
-        attrs = cuds_collection.find_relations(element, 'has-attribute')
-        names = e.soft_get_property_names() + list(attrs)
+    def has_node(self, element):
+        """Returns true if CUDS element `element` is in the graph."""
+        return self.get_nodename(element) in self.nodes
+
+    def add_node(self, element):
+        """Adds a node for CUDS element `element`."""
+        e = self.cuds_collection.get_instance(element)
+        attrs = find_relations(self.cuds_collection, element,
+                               'has-attribute')
+        names = e.soft_get_property_names() + attrs
         s = ''.join(r'+ %s\l' % prop for prop in names)
-        node = pydot.Node(get_nodename(element),
-                          label=r'{%s|%s}' % (element, s),
-                          shape='record',
-                          fontname='Bitstream Vera Sans',
-                          fontsize=8,
-                          style='filled',
-                          fillcolor='#ffffe0',
-                      )
-        return node
+        self.nodes[self.get_nodename(element)] = [
+            ('label', r'{%s|%s}' % (element, s))] + list(_node_attrs)
 
-    def get_inheritance_edge(child, parent):
-        edge = pydot.Edge(child, parent,
-                          arrowhead='empty',
-                          #fontname='Bitstream Vera Sans',
-                          #fontsize=8,
-        )
-        return edge
+    def add_inheritance_edge(self, child, parent):
+        """Adds an inheritance edge from `child` to `parent`."""
+        self.edges[(self.get_nodename(child), self.get_nodename(parent),
+                    None)] = list(_inheritance_attrs)
 
-    def get_composition_edge(part, composite, shape=None):
-        kw = {}
+    def add_composition_edge(self, part, composite, shape=None):
+        """Adds a composition edge from `part` to `composite`."""
+        attrs = list(_composition_attrs)
         if shape == '(:)':
-            #kw['headlabel'] = '0..*'
-            #kw['headlabel'] = '*'
-            kw['taillabel'] = '0..*'
+            attrs.append(('taillabel', '0..*'))
         elif shape:
-            #kw['headlabel'] = shape.lstrip('[').rstrip(']')
-            kw['taillabel'] = shape.lstrip('[').rstrip(']')
-        edge = pydot.Edge(part, composite,
-                          fontname='Bitstream Vera Sans',
-                          fontsize=8,
-                          arrowhead='diamond',
-                          #arrowtail='none',
-                          #dir='both',
-                          color='#0000ff',
-                          **kw)
-        return edge
-
-    def add_parents(graph, node):
-        element = node.get_name().rstrip('_')
-        parents = cuds_collection.find_relations(element, 'has-parent')
+            attrs.append(('taillabel', shape.lstrip('[').rstrip(']')))
+        self.edges[(self.get_nodename(part), self.get_nodename(composite),
+                    shape or '')] = attrs
+
+    def add_parents(self, element):
+        """Adds the parent chain of `element`."""
+        parents = find_relations(self.cuds_collection, element, 'has-parent')
         if parents:
             assert len(parents) == 1
-            parent = parents.pop()
-            parentnodes = graph.get_node(get_nodename(parent))
-            if parentnodes:
-                assert len(parentnodes) == 1
-                parentnode = parentnodes[0]
-            else:
-                parentnode = get_node(parent)
-                graph.add_node(parentnode)
-                #if show_compositions:
-                #    add_compositions(graph, parentnode)
-                add_parents(graph, parentnode)
-            graph.add_edge(get_inheritance_edge(node, parentnode))
-
-    def add_childs(graph, node):
-        element = node.get_name().rstrip('_')
-        for child in cuds_collection.find_relations(element, '^has-parent'):
-            childnode = get_node(child)
-            graph.add_node(childnode)
-            graph.add_edge(get_inheritance_edge(childnode, node))
-            add_childs(graph, childnode)
-
-    def add_compositions(graph, node):
-        element = node.get_name().rstrip('_')
-        for attr in cuds_collection.find_relations(element, 'has-attribute'):
-            shapes = cuds_collection.find_relations(
-                '%s.%s' % (element, attr), 'has-shape')
+            parent = parents[0]
+            if not self.has_node(parent):
+                self.add_node(parent)
+                self.add_parents(parent)
+            self.add_inheritance_edge(element, parent)
+
+    def add_childs(self, element):
+        """Adds all descendants of `element`."""
+        if element in self._childs_added:
+            return
+        self._childs_added.add(element)
+        for child in find_relations(self.cuds_collection, element,
+                                    '^has-parent'):
+            if not self.has_node(child):
+                self.add_node(child)
+            self.add_inheritance_edge(child, element)
+            self.add_childs(child)
+
+    def add_compositions(self, element):
+        """Adds the attributes of `element` and its descendants."""
+        if element in self._compositions_added:
+            return
+        self._compositions_added.add(element)
+        for attr in find_relations(self.cuds_collection, element,
+                                   'has-attribute'):
+            shapes = find_relations(
+                self.cuds_collection, '%s.%s' % (element, attr), 'has-shape')
             if shapes:
                 assert len(shapes) == 1
-                shape = shapes.pop()
+                shape = shapes[0]
             else:
                 shape = None
-            attrnodes = graph.get_node(get_nodename(attr))
-            if not attrnodes:
-                attrnode = get_node(attr)
-                graph.add_node(attrnode)
-                add_childs(graph, attrnode)
-                if show_parents:
-                    add_parents(graph, attrnode)
-                add_compositions(graph, attrnode)
-
-            else:
-                assert len(attrnodes) == 1
-                attrnode = attrnodes[0]
-            graph.add_edge(get_composition_edge(attrnode, node, shape))
-        for child in cuds_collection.find_relations(element, '^has-parent'):
-            childnodes = graph.get_node(get_nodename(child))
-            assert len(childnodes) == 1
-            add_compositions(graph, childnodes[0])
-
-
-    root = subgraph if subgraph else 'CUDS_ITEM'
-    graph = pydot.Dot(graph_type='digraph',
-                      fontname='Bitstream Vera Sans',
-                      fontsize=8,
-                      rankdir='BT',
-                      #splines='line',
-                      #splines='polyline',
-                      splines='ortho',
-                  )
-    rootnode = get_node(root)
-    graph.add_node(rootnode)
-    add_childs(graph, rootnode)
-    if show_parents:
-        add_parents(graph, rootnode)
-    if show_compositions:
-        add_compositions(graph, rootnode)
+            if not self.has_node(attr):
+                self.add_node(attr)
+                self.add_childs(attr)
+                if self.show_parents:
+                    self.add_parents(attr)
+                self.add_compositions(attr)
+            self.add_composition_edge(attr, element, shape)
+        for child in find_relations(self.cuds_collection, element,
+                                    '^has-parent'):
+            self.add_compositions(child)
+
+    def to_dot(self):
+        """Returns the graph as a string in DOT format."""
+        lines = ['digraph G {']
+        lines.extend('%s=%s;' % (k, _dot_quote(v)) for k, v in _graph_attrs)
+        for name, attrs in self.nodes.items():
+            lines.append('%s [%s];' % (_dot_quote(name), _dot_attrs(attrs)))
+        for (tail, head, _), attrs in self.edges.items():
+            lines.append('%s -> %s [%s];' % (
+                _dot_quote(tail), _dot_quote(head), _dot_attrs(attrs)))
+        lines.append('}')
+        return '\n'.join(lines) + '\n'
+
+    def to_pydot(self):
+        """Returns the graph as a new pydot graph object.
+
+        Requires pydot."""
+        import pydot
+        graph = pydot.Dot(graph_type='digraph', **dict(_graph_attrs))
+        for name, attrs in self.nodes.items():
+            graph.add_node(pydot.Node(name, **dict(attrs)))
+        for (tail, head, _), attrs in self.edges.items():
+            graph.add_edge(pydot.Edge(tail, head, **dict(attrs)))
+        return graph
+
+
+def get_cuds_graph_index(cuds_collection, subgraph=None,
+                         show_compositions=True, show_parents=True):
+    """Returns a CUDSGraph instance for the given arguments, see
+    get_cuds_graph().
+
+    The graphs are cached by root and options in the `graphs`
+    attribute of collections returned by get_cuds_collection()."""
+    args = (subgraph, show_compositions, show_parents)
+    graphs = getattr(cuds_collection, 'graphs', None)
+    if graphs is None:
+        return CUDSGraph(cuds_collection, *args)
+    key = (subgraph or 'CUDS_ITEM', bool(show_compositions),
+           bool(show_parents))
+    graph = graphs.get(key)
+    if graph is None:
+        graph = graphs[key] = CUDSGraph(cuds_collection, *args)
     return graph
 
 
+def get_cuds_dot(cuds_collection, subgraph=None, show_compositions=True,
+                 show_parents=True):
+    """Returns a CUDS graph as a string in DOT format without
+    creating any pydot objects.  The arguments are the same as for
+    get_cuds_graph().
+
+    Examples
+    --------
+    >>> cuds_collection = get_cuds_collection(include_parent=False)
+    >>> with open('CUDS.dot', 'w') as f:
+    ...     f.write(get_cuds_dot(cuds_collection))
+    """
+    return get_cuds_graph_index(cuds_collection, subgraph,
+                                show_compositions, show_parents).to_dot()
+
+
+def get_cuds_graph(cuds_collection, subgraph=None, show_compositions=True,
+                   show_parents=True):
+    """Returns a pydot graph object for visualising a CUDS graph.
 
+    Parameters
+    ----------
+    cuds_collection : Collection
+        A CUDS metadata collection as returned by
+        get_cuds_collection(include_parent=False).
+    subgraph : string
+        If given, only output the CUDS element `subgraph` and its
+        childs will be included.
+    show_compositions : bool
+        Whether to also show compositions.
+    show_parents : bool
+        Whehter to include parents in combination with `subgraph`.
 
-if __name__ == '__main__':
+    Notes
+    -----
+    Requires that you have pydot installed.  Use get_cuds_dot() to get
+    the DOT text without pydot.
 
-    # Directory holding this file
-    thisdir = os.path.dirname(__file__)
+    Examples
+    --------
+    >>> cuds_collection = get_cuds_collection(include_parent=False)
+    >>> graph = get_cuds_graph(cuds_collection)
+    >>> graph.write_png('CUDS.png')
+    """
+    return get_cuds_graph_index(cuds_collection, subgraph,
+                                show_compositions, show_parents).to_pydot()
 
-    # Read CUBA and CUDS definitions
-    with open(os.path.join(thisdir, 'metadata', 'cuba.yml')) as f:
-        cuba = yaml.load(f.read())
-    with open(os.path.join(thisdir, 'metadata', 'simphony_metadata.yml')) as f:
-        cuds = yaml.load(f.read())
 
-    # Crate CUDS entities and relations
-    entities, relations = generate_cuds_entities(cuds, cuba)
 
+if __name__ == '__main__':
 
     # Write CUDS entities and relations
-    write_cuds_entities(os.path.join(thisdir, 'metadata', 'cuds_entities'))
+    write_cuds_entities(os.path.join(thisdir, 'metadata', 'cuds_entities'),
+                        incremental=True)
 
     import softpy
 
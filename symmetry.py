@@ -0,0 +1,313 @@
+"""Space-group symmetry expansion of atom sites.
+
+The atom sites of a CIF file usually only cover the asymmetric unit.
+This module expands them to the full unit cell by applying the
+space-group operations to all sites at once as batched NumPy matrix
+operations.  Images of a site that coincide within a tolerance are
+merged, and the number of remaining images can be checked against the
+multiplicities given in the CIF file.
+
+The symmetry operations are taken from the symmetry operation loop of
+the CIF data block (`_space_group_symop_operation_xyz` or
+`_symmetry_equiv_pos_as_xyz`).  If the block has none, they can be
+looked up with spglib, if installed, from the Hall symbol, the
+Hermann-Mauguin symbol or the number of the space group.  A number only
+identifies the standard setting, which may differ from the setting used
+in the CIF file, and is rejected for space groups with two origin
+choices.
+
+An operation is represented by a rotation matrix R and a translation
+vector t acting on fractional coordinates as ``x' = R x + t``.
+
+Requires NumPy.
+"""
+import re
+from fractions import Fraction
+
+import numpy as np
+
+
+# CIF tags holding symmetry operations, in order of preference
+SYMOP_TAGS = ('_space_group_symop_operation_xyz',
+              '_symmetry_equiv_pos_as_xyz')
+
+# CIF tags identifying the space group, in order of preference
+SPACEGROUP_TAGS = ('_space_group_name_hall',
+                   '_symmetry_space_group_name_hall',
+                   '_space_group_name_h-m_alt',
+                   '_symmetry_space_group_name_h-m',
+                   '_space_group_it_number',
+                   '_symmetry_int_tables_number')
+
+# Default tolerance for merging images, in fractional coordinates or,
+# if a lattice matrix is given, in Angstrom
+TOLERANCE = 1e-3
+
+# Maximum number of elements of the temporary image distance arrays
+_CHUNK_ELEMENTS = 1 << 22
+
+_term_re = re.compile(r'([+-]?)([^+-]+)')
+
+# Descriptions of the Hall settings, see _get_spacegroup_types()
+_spacegroup_types = None
+
+
+def parse_symop(xyz):
+    """Parses the symmetry operation `xyz` given in CIF notation, like
+    "-x+1/2,y,-z", and returns a (rotation, translation) tuple."""
+    parts = xyz.replace(' ', '').lower().split(',')
+    if len(parts) != 3:
+        raise ValueError('invalid symmetry operation: %r' % xyz)
+    rotation = np.zeros((3, 3))
+    translation = np.zeros(3)
+    for i, part in enumerate(parts):
+        pos = 0
+        for m in _term_re.finditer(part):
+            if m.start() != pos:
+                raise ValueError('invalid symmetry operation: %r' % xyz)
+            pos = m.end()
+            sign = -1.0 if m.group(1) == '-' else 1.0
+            term = m.group(2)
+            coef = 1.0
+            if '*' in term:
+                c, term = term.split('*', 1)
+                coef = float(Fraction(c))
+            elif term[-1:] in 'xyz' and len(term) > 1:
+                coef, term = float(Fraction(term[:-1])), term[-1]
+            if term in ('x', 'y', 'z'):
+                rotation[i, 'xyz'.index(term)] += sign * coef
+            else:
+                try:
+                    translation[i] += sign * coef * float(Fraction(term))
+                except ValueError:
+                    raise ValueError('invalid symmetry operation: %r' % xyz)
+        if pos != len(part) or not part:
+            raise ValueError('invalid symmetry operation: %r' % xyz)
+    return rotation, translation
+
+
+def get_block_symops(block):
+    """Returns a (rotations, translations) tuple with the symmetry
+    operations in CIF data block `block` or None if it has none.
+
+    `rotations` is a M x 3 x 3 and `translations` a M x 3 array."""
+    keys = {k.lower(): k for k in block.keys()}
+    for tag in SYMOP_TAGS:
+        if tag in keys:
+            values = block[keys[tag]]
+            if isinstance(values, str):
+                values = [values]
+            ops = [parse_symop(v) for v in values]
+            return (np.array([r for r, t in ops]),
+                    np.array([t for r, t in ops]))
+    return None
+
+
+def _get_spacegroup_types():
+    """Returns a list with a dict describing each of the 530 Hall settings
+    in the spglib database, in order of Hall number."""
+    global _spacegroup_types
+    if _spacegroup_types is None:
+        import spglib
+        types = []
+        for hall in range(1, 531):
+            sgtype = spglib.get_spacegroup_type(hall)
+            if not isinstance(sgtype, dict):
+                sgtype = {key: getattr(sgtype, key) for key in (
+                    'number', 'hall_symbol', 'international',
+                    'international_full', 'international_short', 'choice')}
+            types.append(dict(sgtype, hall_number=hall))
+        _spacegroup_types = types
+    return _spacegroup_types
+
+
+def _normalize_symbol(symbol):
+    """Returns space-group symbol `symbol` without spaces and underscores,
+    such that e.g. "P 42/m n m" and "P4_2/mnm" compare equal."""
+    return re.sub(r'[\s_]', '', symbol)
+
+
+def _select_setting(candidates, spacegroup):
+    """Returns the Hall number of the standard setting among the Hall
+    settings `candidates` of a single space-group type.
+
+    Raises ValueError if the candidates differ in origin choice, since
+    neither origin is more standard than the other."""
+    if len(set(c['number'] for c in candidates)) > 1:
+        raise ValueError('space group %r is ambiguous, matches %s' % (
+            spacegroup, ', '.join(sorted(set(
+                c['international'] for c in candidates)))))
+    choices = set(c['choice'] for c in candidates)
+    if '1' in choices and '2' in choices:
+        raise ValueError(
+            'space group %r has two origin choices, give the Hall symbol '
+            'or the Hermann-Mauguin symbol with the origin choice, like '
+            '"%s:2"' % (spacegroup, candidates[0]['international']))
+    return candidates[0]['hall_number']
+
+
+def get_hall_number(spacegroup):
+    """Returns the Hall number (1-530) in the spglib database of
+    `spacegroup`, which is either a space-group number, a Hall symbol
+    or a Hermann-Mauguin symbol, optionally followed by ":" and the
+    setting, like "F d -3 m :2".
+
+    For space-group numbers and symbols that match several settings, the
+    standard setting of the International Tables is chosen, i.e. unique
+    axis b, cell choice 1 and hexagonal axes.  A ValueError is raised if
+    the settings differ in origin choice.
+
+    Requires spglib."""
+    types = _get_spacegroup_types()
+    if isinstance(spacegroup, str) and not spacegroup.strip().isdigit():
+        symbol = _normalize_symbol(spacegroup)
+        candidates = [t for t in types
+                      if _normalize_symbol(t['hall_symbol']) == symbol]
+        if not candidates:
+            name, _, choice = symbol.partition(':')
+            candidates = [t for t in types if name in (
+                _normalize_symbol(t['international']),
+                _normalize_symbol(t['international_full']),
+                _normalize_symbol(t['international_short']))]
+            if choice:
+                candidates = [t for t in candidates if t['choice'] == choice]
+        if not candidates:
+            raise ValueError('unknown space-group symbol: %r' % spacegroup)
+        return _select_setting(candidates, spacegroup)
+    number = int(spacegroup)
+    if not 1 <= number <= 230:
+        raise ValueError('invalid space-group number: %d' % number)
+    return _select_setting([t for t in types if t['number'] == number],
+                           number)
+
+
+def get_spacegroup_symops(spacegroup):
+    """Returns a (rotations, translations) tuple with the symmetry
+    operations of `spacegroup`, which is a space-group number, Hall
+    symbol or Hermann-Mauguin symbol.  See get_hall_number() for how
+    the setting is chosen.
+
+    Requires spglib."""
+    import spglib
+    symmetry = spglib.get_symmetry_from_database(get_hall_number(spacegroup))
+    return (np.asarray(symmetry['rotations'], dtype=float),
+            np.asarray(symmetry['translations'], dtype=float))
+
+
+def get_symops(block=None, spacegroup=None):
+    """Returns a (rotations, translations) tuple with the symmetry
+    operations of CIF data block `block`, falling back to the operations
+    of space group `spacegroup` looked up with spglib.
+
+    If `spacegroup` is not given, the space group of `block` is taken
+    from the first of SPACEGROUP_TAGS it has, i.e. the Hall symbol is
+    preferred over the Hermann-Mauguin symbol and the number."""
+    if block is not None:
+        symops = get_block_symops(block)
+        if symops is not None:
+            return symops
+        if spacegroup is None:
+            keys = {k.lower(): k for k in block.keys()}
+            for tag in SPACEGROUP_TAGS:
+                if tag in keys and block[keys[tag]] not in ('?', '.'):
+                    spacegroup = block[keys[tag]]
+                    break
+    if spacegroup is None:
+        raise ValueError('no symmetry operations or space group given')
+    try:
+        return get_spacegroup_symops(spacegroup)
+    except ImportError:
+        raise ImportError('spglib is required to look up the symmetry '
+                          'operations of space group %s' % spacegroup)
+
+
+def cell_to_lattice(a, b, c, alpha, beta, gamma):
+    """Returns the 3 x 3 lattice matrix, with the lattice vectors as rows,
+    for the cell lengths `a`, `b`, `c` and angles `alpha`, `beta`,
+    `gamma` (in degree).  The a vector is along x and b in the xy
+    plane."""
+    alpha, beta, gamma = np.radians([alpha, beta, gamma])
+    cosa, cosb, cosg = np.cos(alpha), np.cos(beta), np.cos(gamma)
+    sing = np.sin(gamma)
+    cx = c * cosb
+    cy = c * (cosa - cosb * cosg) / sing
+    cz = np.sqrt(max(c * c - cx * cx - cy * cy, 0.0))
+    return np.array([[a, 0.0, 0.0],
+                     [b * cosg, b * sing, 0.0],
+                     [cx, cy, cz]])
+
+
+def expand_positions(positions, rotations, translations, tol=TOLERANCE,
+                     lattice=None):
+    """Applies the symmetry operations to fractional coordinates
+    `positions` and returns a (positions, index) tuple.
+
+    The returned positions are the unique images of the given sites,
+    wrapped into [0, 1), and `index` maps each of them to the index of
+    the site it was generated from.  Images of the same site closer
+    than `tol` are merged, measured in fractional coordinates or, if
+    the 3 x 3 `lattice` matrix (with the lattice vectors as rows) is
+    given, in Cartesian coordinates.
+    """
+    positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+    rotations = np.asarray(rotations, dtype=float).reshape(-1, 3, 3)
+    translations = np.asarray(translations, dtype=float).reshape(-1, 3)
+    n, m = len(positions), len(rotations)
+
+    # All images, shape (n, m, 3)
+    images = np.einsum('mij,nj->nmi', rotations, positions) + translations
+    images -= np.floor(images)
+    images[images >= 1.0 - 1e-12] = 0.0
+
+    # Mark images equal to an earlier image of the same site.  The
+    # pairwise distances are computed in chunks of sites, such that
+    # memory use stays bounded for structures with many sites.
+    keep = np.ones((n, m), dtype=bool)
+    if m > 1:
+        later = np.triu(np.ones((m, m), dtype=bool), 1)
+        chunk = max(1, _CHUNK_ELEMENTS // (m * m * 3))
+        for start in range(0, n, chunk):
+            im = images[start:start + chunk]
+            d = im[:, :, None, :] - im[:, None, :, :]
+            d -= np.round(d)
+            if lattice is not None:
+                d = np.dot(d, lattice)
+            close = np.einsum('...i,...i->...', d, d) < tol * tol
+            keep[start:start + chunk] = ~np.any(close & later, axis=1)
+
+    index = np.nonzero(keep)[0]
+    return images[keep], index
+
+
+def check_multiplicities(index, multiplicities, nsites=None, labels=None):
+    """Raises ValueError if the number of images of each site, as given
+    by `index` returned by expand_positions(), differs from
+    `multiplicities`.  Multiplicities that are zero or None are
+    considered unknown and not checked."""
+    multiplicities = [0 if m is None else int(m) for m in multiplicities]
+    counts = np.bincount(index, minlength=nsites or len(multiplicities))
+    bad = [i for i, mult in enumerate(multiplicities)
+           if mult and counts[i] != mult]
+    if bad:
+        raise ValueError(
+            'expanded multiplicities differ from the given: %s' % ', '.join(
+                '%s: %d != %d' % (labels[i] if labels else i, counts[i],
+                                  multiplicities[i]) for i in bad))
+
+
+def expand_sites(sites, rotations, translations, tol=TOLERANCE,
+                 lattice=None, multiplicities=None, labels=None):
+    """Returns a (sites, index) tuple with a new atomsites.AtomSites
+    instance holding the symmetry expansion of `sites` and an array
+    mapping each new site to the index of the site in `sites` it was
+    generated from.
+
+    If `multiplicities` is given, the number of images of each site is
+    checked against it, see check_multiplicities()."""
+    from atomsites import AtomSites
+    positions, index = expand_positions(sites.positions, rotations,
+                                        translations, tol, lattice)
+    if multiplicities is not None:
+        check_multiplicities(index, multiplicities, len(sites), labels)
+    return AtomSites(positions, sites.symbols[index],
+                     sites.occupancies[index]), index
@@ -0,0 +1,517 @@
+"""Validation of entities and collections against the bundled schemas.
+
+The schemas in schemas/ describe an object by a list of properties,
+each with a name, a type and optionally dimensions.  The type is either
+the URL of a basic type or of a form defined in the same schema, which
+again describes a nested object.  A schema is compiled once into nested
+checking functions with get_validator(), such that validating many
+objects only costs a few dict and isinstance() checks per value.
+
+The schema semantics are interpreted as follows:
+
+  - Objects are dicts.  All properties are required, unless their
+    description says "Optional" or they are listed in OPTIONAL, and
+    keys that are not properties are errors.
+  - The alphanumeric basic type is a string.  Other basic types and
+    forms not defined in the schema are not checked.
+  - Forms are matched by namespace and name, the version is ignored.
+  - Properties with dimensions or whose description starts with
+    "Array of" are lists of values of the given type.
+
+The property values of the instances in a CUDS instance collection are
+checked against their entities with validate_instances(), and the
+serialized YAML or JSON output of a collection against the collection
+itself with validate_document().
+
+Errors are reported as (path, message) tuples, where `path` locates the
+offending value, like "properties[2].dims".
+"""
+import os
+import json
+
+
+# Directory holding this file
+thisdir = os.path.dirname(os.path.abspath(__file__))
+
+# Directory with the bundled schemas
+schemadir = os.path.join(thisdir, 'schemas')
+
+# Type URL of strings
+ALPHANUMERIC = 'http://meta.emmc.eu/basic_type/alphanumeric/1.0'
+
+# Maps schema name to a dict mapping form names (None for the top-level
+# object) to names of optional properties not marked as optional in the
+# schema.  SOFT treats a missing unit as dimensionless.
+OPTIONAL = {
+    'entity_schema': {'property': ('unit', )},
+}
+
+# Maps SOFT property types to the Python types of their values.  The
+# values of other types are not checked.
+PROPERTY_TYPES = {
+    'string': (str, ),
+    'bool': (bool, ),
+    'float': (float, int),
+    'double': (float, int),
+    'int': (int, ),
+    'int32': (int, ),
+    'int64': (int, ),
+    'uint32': (int, ),
+    'uint64': (int, ),
+}
+
+# Compiled validators, see get_validator()
+_validators = {}
+
+# Maps entity keys to (entity, checker) tuples, see _get_entity_checker()
+_entity_checkers = {}
+
+# Marks a missing value
+_missing = object()
+
+
+class ValidationError(ValueError):
+    """Raised when validation fails.
+
+    The `errors` attribute is a list of (path, message) tuples."""
+    def __init__(self, errors):
+        self.errors = list(errors)
+        lines = ['%s: %s' % (path or '<root>', msg)
+                 for path, msg in self.errors[:10]]
+        if len(self.errors) > 10:
+            lines.append('... and %d more' % (len(self.errors) - 10))
+        ValueError.__init__(self, '%d validation error%s:\n  %s' % (
+            len(self.errors), '' if len(self.errors) == 1 else 's',
+            '\n  '.join(lines)))
+
+
+def format_path(path):
+    """Returns linked path tuple `path` as a string."""
+    parts = []
+    while path:
+        path, part = path
+        parts.append(part)
+    s = ''
+    for part in reversed(parts):
+        if isinstance(part, int):
+            s += '[%d]' % part
+        elif s:
+            s += '.' + part
+        else:
+            s = part
+    return s
+
+
+def _typename(value):
+    return type(value).__name__
+
+
+def _check_string(value, path, errors):
+    if not isinstance(value, str):
+        errors.append((path, 'expected a string, got %s' % _typename(value)))
+
+
+def _array_checker(check):
+    """Returns a function checking a list of values with `check`."""
+    def check_array(value, path, errors):
+        if not isinstance(value, (list, tuple)):
+            errors.append((path, 'expected an array, got %s' %
+                           _typename(value)))
+        elif check is not None:
+            for i, v in enumerate(value):
+                check(v, (path, i), errors)
+    return check_array
+
+
+class SchemaValidator(object):
+    """Validator compiled from `schema`, a dict in the format of the
+    files in schemas/.
+
+    `optional` maps form names (None for the top-level object) to names
+    of additional optional properties."""
+    def __init__(self, schema, optional=None):
+        self.name = schema['schema_name']
+        optional = optional or {}
+        self.forms = {}
+        forms = [(form['schema_namespace'] + '/' + form['schema_name'],
+                  form) for form in schema.get('schema_forms', ())]
+        # Register all forms first, such that forms can refer to each
+        # other and to themselves
+        for key, form in forms:
+            self.forms[key] = None
+        for key, form in forms:
+            self.forms[key] = self._compile_object(
+                form.get('schema_properties', ()),
+                optional.get(form['schema_name'], ()))
+        self._check = self._compile_object(
+            schema.get('schema_properties', ()), optional.get(None, ()))
+
+    def _compile_type(self, url):
+        """Returns a checker for type `url` or None if values of this
+        type are not checked."""
+        if url == ALPHANUMERIC:
+            return _check_string
+        key = url.rsplit('/', 1)[0]
+        if key in self.forms:
+            forms = self.forms
+            return lambda value, path, errors: forms[key](value, path, errors)
+        return None
+
+    def _compile_object(self, properties, optional=()):
+        """Returns a checker for objects with `properties`."""
+        checks = []
+        required = set()
+        for prop in properties:
+            name = prop['schema_name']
+            descr = prop.get('schema_description', prop.get('description',
+                                                            ''))
+            check = self._compile_type(prop['schema_type'])
+            if prop.get('schema_dimensions') or descr.startswith('Array of'):
+                check = _array_checker(check)
+            if 'Optional' not in descr and name not in optional:
+                required.add(name)
+            checks.append((name, check))
+        names = frozenset(name for name, _ in checks)
+        required = frozenset(required)
+        checks = [(name, check) for name, check in checks if check]
+
+        def check_object(value, path, errors):
+            if not isinstance(value, dict):
+                errors.append((path, 'expected an object, got %s' %
+                               _typename(value)))
+                return
+            keys = value.keys()
+            if not required <= keys:
+                for name in sorted(required - keys):
+                    errors.append((path, 'missing property %r' % name))
+            if not keys <= names:
+                for name in sorted(keys - names, key=str):
+                    errors.append(((path, str(name)), 'unexpected property'))
+            for name, check in checks:
+                v = value.get(name, _missing)
+                if v is not _missing:
+                    check(v, (path, name), errors)
+        return check_object
+
+    def iter_errors(self, value):
+        """Returns a list of (path, message) tuples for the errors in
+        `value`."""
+        errors = []
+        self._check(value, None, errors)
+        return [(format_path(path), msg) for path, msg in errors]
+
+    def is_valid(self, value):
+        """Returns whether `value` is valid."""
+        errors = []
+        self._check(value, None, errors)
+        return not errors
+
+    def validate(self, value):
+        """Raises ValidationError if `value` is invalid."""
+        errors = self.iter_errors(value)
+        if errors:
+            raise ValidationError(errors)
+
+    def validate_many(self, values, labels=None):
+        """Validates the sequence `values` and raises ValidationError
+        with all errors if any of them is invalid.
+
+        The paths of the errors are prefixed with the corresponding
+        element of `labels` or the index of the value."""
+        errors = []
+        check = self._check
+        for i, value in enumerate(values):
+            check(value, (None, labels[i] if labels else i), errors)
+        if errors:
+            raise ValidationError([(format_path(path), msg)
+                                   for path, msg in errors])
+
+
+def load_schema(name):
+    """Returns the bundled schema `name` (e.g. "entity_schema") as a
+    dict."""
+    with open(os.path.join(schemadir, name + '.json')) as f:
+        return json.load(f)
+
+
+def get_validator(name):
+    """Returns the SchemaValidator for bundled schema `name`.
+
+    The validator is compiled on the first call."""
+    validator = _validators.get(name)
+    if validator is None:
+        validator = _validators[name] = SchemaValidator(
+            load_schema(name), OPTIONAL.get(name))
+    return validator
+
+
+def validate_entities(entities):
+    """Validates a sequence of entity dicts or softcuds.Entity records
+    against the entity schema and raises ValidationError on errors.
+
+    The paths of the errors start with the entity names."""
+    entities = [e.to_dict() if hasattr(e, 'to_dict') else e
+                for e in entities]
+    labels = [e.get('name', str(i)) if isinstance(e, dict) else str(i)
+              for i, e in enumerate(entities)]
+    get_validator('entity_schema').validate_many(entities, labels)
+
+
+def _get_meta(instance):
+    """Returns a (name, version, namespace) tuple for the metadata of
+    `instance`."""
+    meta = getattr(instance, 'soft_metadata', None)
+    if meta is not None:
+        return meta.name, meta.version, meta.namespace
+    return (instance.soft_get_meta_name(), instance.soft_get_meta_version(),
+            instance.soft_get_meta_namespace())
+
+
+def collection_to_dict(ci, name='', version='', namespace='',
+                       description=''):
+    """Returns a dict representing CUDS instance collection `ci` in the
+    format described by the collection schema.
+
+    The instances of lazy collections are created."""
+    refs = []
+    for label in ci.get_labels():
+        instance = ci.get_instance(label)
+        meta_name, meta_version, meta_namespace = _get_meta(instance)
+        refs.append({
+            'label': label,
+            'guid': str(instance.soft_get_id()),
+            'name': meta_name,
+            'version': meta_version,
+            'namespace': meta_namespace,
+            'description': '',
+        })
+    relations = []
+    index = getattr(ci, 'relation_index', None)
+    if index is not None:
+        items = [(s, p, o) for (s, p), objects in index.forward.items()
+                 for o in objects]
+    else:
+        items = [(label, 'has-attribute', o) for label in ci.get_labels()
+                 for o in sorted(ci.find_relations(label, 'has-attribute'))]
+    for s, p, o in items:
+        relations.append({'subject': s, 'predicate': p, 'object': o,
+                          'description': ''})
+    return {
+        'name': name,
+        'version': version,
+        'namespace': namespace,
+        'description': description,
+        'dimensions': [],
+        'instance-refs': refs,
+        'dim-maps': [],
+        'relations': relations,
+    }
+
+
+def validate_collection(collection):
+    """Validates `collection` against the collection schema and raises
+    ValidationError on errors.
+
+    `collection` is either a dict in the format of the schema or a CUDS
+    instance collection, which is converted with
+    collection_to_dict()."""
+    if not isinstance(collection, dict):
+        collection = collection_to_dict(collection)
+    get_validator('collection_schema').validate(collection)
+
+
+def _compile_property(prop):
+    """Returns a checker for the values of entity property `prop`.
+
+    The checker takes the additional argument `sizes`, a dict mapping
+    dimension names to the sizes seen so far in the instance, such that
+    dimensions shared by several properties are checked for consistency.
+    """
+    types = PROPERTY_TYPES.get(prop.type)
+    dims = prop.dims or ()
+    typename = prop.type
+
+    def check_scalar(value, path, errors):
+        if types is not None and (not isinstance(value, types) or (
+                isinstance(value, bool) and bool not in types)):
+            errors.append((path, 'expected a value of type %s, got %s' % (
+                typename, _typename(value))))
+
+    def check_property(value, path, errors, sizes):
+        if hasattr(value, 'tolist') and not isinstance(value, list):
+            value = value.tolist()  # NumPy arrays and scalars
+        if value is None:
+            errors.append((path, 'missing value'))
+            return
+        level = [(value, path)]
+        for dim in dims:
+            size = None
+            next_level = []
+            for v, p in level:
+                if not isinstance(v, (list, tuple)):
+                    errors.append((p, 'expected an array of dimension %s, '
+                                   'got %s' % (dim, _typename(v))))
+                    return
+                if size is None:
+                    size = len(v)
+                elif len(v) != size:
+                    errors.append((p, 'ragged array, dimension %s has '
+                                   'sizes %d and %d' % (dim, size, len(v))))
+                    return
+                next_level.extend((x, (p, i)) for i, x in enumerate(v))
+            if size is not None:
+                if sizes.setdefault(dim, size) != size:
+                    errors.append((path, 'dimension %s has size %d, but '
+                                   '%d in another property' % (
+                                       dim, size, sizes[dim])))
+            level = next_level
+        for v, p in level:
+            check_scalar(v, p, errors)
+    return check_property
+
+
+def _compile_entity(entity):
+    """Returns a checker for the instances of softcuds.Entity record
+    `entity`."""
+    checks = [(prop.name, _compile_property(prop))
+              for prop in entity.properties]
+
+    def check_instance(instance, path, errors):
+        sizes = {}
+        for name, check in checks:
+            try:
+                value = instance.soft_get_property(name)
+            except (KeyError, AttributeError):
+                errors.append(((path, name), 'missing property'))
+            else:
+                check(value, (path, name), errors, sizes)
+    return check_instance
+
+
+def _get_entity_checker(entity):
+    """Returns the compiled checker for `entity`, compiling it on the
+    first call or when the entity has changed."""
+    cached = _entity_checkers.get(entity.key)
+    if cached is None or cached[0] is not entity:
+        cached = _entity_checkers[entity.key] = (entity,
+                                                 _compile_entity(entity))
+    return cached[1]
+
+
+def validate_instances(ci, entities=None):
+    """Validates the property values of all instances in CUDS instance
+    collection `ci` against their entities and raises ValidationError on
+    errors.
+
+    The values must be of the property type, arrays must have one
+    nesting level per dimension and dimensions shared by several
+    properties of an instance must have the same size.  `entities` maps
+    (name, version, namespace) to softcuds.Entity records and defaults
+    to the entities in softcuds.metadata_registry.
+
+    The paths of the errors start with the instance labels."""
+    if entities is None:
+        import softcuds
+        entities = softcuds.metadata_registry.entities
+    errors = []
+    for label in ci.get_labels():
+        instance = ci.get_instance(label)
+        path = (None, label)
+        key = _get_meta(instance)
+        entity = entities.get(key)
+        if entity is None:
+            errors.append((path, 'unknown entity %s/%s/%s' % key[::-1]))
+        else:
+            _get_entity_checker(entity)(instance, path, errors)
+    if errors:
+        raise ValidationError([(format_path(path), msg)
+                               for path, msg in errors])
+
+
+def _tokens_to_data(tokens):
+    """Returns the nested lists and dicts described by the tokens from
+    softcuds.iter_cuds_instance_tokens()."""
+    import softcuds
+    stack = [[]]
+    key = None
+    keys = []
+    for kind, value in tokens:
+        if kind == softcuds.KEY:
+            key = value
+            continue
+        if kind in (softcuds.SEQUENCE_END, softcuds.MAPPING_END):
+            value = stack.pop()
+            key = keys.pop()
+        elif kind == softcuds.SEQUENCE_START:
+            stack.append([])
+            keys.append(key)
+            continue
+        elif kind == softcuds.MAPPING_START:
+            stack.append({})
+            keys.append(key)
+            continue
+        top = stack[-1]
+        if isinstance(top, dict):
+            top[key] = value
+        else:
+            top.append(value)
+    return stack[0][0]
+
+
+def _compare(value, expected, path, errors):
+    """Appends an error to `errors` for each difference between the
+    nested lists and dicts `value` and `expected`."""
+    if isinstance(expected, dict):
+        if not isinstance(value, dict):
+            errors.append((path, 'expected an object, got %s' %
+                           _typename(value)))
+            return
+        for key in sorted(set(expected).difference(value)):
+            errors.append((path, 'missing key %r' % key))
+        for key in sorted(set(value).difference(expected), key=str):
+            errors.append(((path, str(key)), 'unexpected key'))
+        for key in expected:
+            if key in value:
+                _compare(value[key], expected[key], (path, key), errors)
+    elif isinstance(expected, list):
+        if not isinstance(value, list):
+            errors.append((path, 'expected an array, got %s' %
+                           _typename(value)))
+        elif len(value) != len(expected):
+            errors.append((path, 'expected %d items, got %d' % (
+                len(expected), len(value))))
+        else:
+            for i, (v, e) in enumerate(zip(value, expected)):
+                _compare(v, e, (path, i), errors)
+    elif value != expected:
+        errors.append((path, 'expected %r, got %r' % (expected, value)))
+
+
+def validate_document(document, ci, format='yaml'):
+    """Validates `document`, the YAML or JSON text returned by
+    softcuds.serialize_cuds_instance_collection() for CUDS instance
+    collection `ci`, and raises ValidationError if it cannot be parsed
+    or does not represent `ci`.
+
+    Parsing YAML requires PyYAML."""
+    import softcuds
+    if format == 'yaml':
+        import yaml
+        loads = lambda text: yaml.load(
+            text, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+        parse_errors = (yaml.YAMLError, )
+    elif format == 'json':
+        loads, parse_errors = json.loads, (ValueError, )
+    else:
+        raise ValueError('unknown serialization format: %r' % format)
+    try:
+        data = loads(document)
+    except parse_errors as exc:
+        raise ValidationError([('', 'invalid %s document: %s' % (
+            format, exc))])
+    expected = _tokens_to_data(softcuds.iter_cuds_instance_tokens(ci))
+    errors = []
+    _compare(data, expected, None, errors)
+    if errors:
+        raise ValidationError([(format_path(path), msg)
+                               for path, msg in errors])